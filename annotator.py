@@ -7,20 +7,58 @@ Miscellaneous utilities for assisting in processing assignments
 
 __author__ = "Fil Zembowicz (fil@filosophy.org)"
 
-import os, sys, re
+import os, sys, json, time
+from collections import namedtuple
+from bisect import bisect_left
 from subprocess import Popen, PIPE
-from features import test_feature_list, production_feature_list, FeatureIndentation
-from utils.code_features import get_indent_levels, get_ignore_lines
-from utils.line_features import strip
-from utils.deadline import TimedOutExc
-from mako.template import Template
+from features import test_feature_list, production_feature_list, FeatureIndentation, get_fingerprint
+from utils.code_features import update_indent_levels, IndentLevels
+from utils.lexer import lex, update_ignore, StrippedLines
+from utils.deadline import TimedOutExc, Budget
+from utils.batch import run_batch
+from utils.archives import is_archive, iter_archives, ArchiveError
+from utils.source import map_text, Lines
+from utils.cache import Cache, hash_text
+from utils.manifest import Manifest
+from utils.preprocessor import Preprocessor
+from utils.templates import write_annotated
+from utils import profiling, vectorized, parsing
+
+CACHE_DIR = os.path.expanduser("~/.style-annotator/cache") # annotation cache for batch runs
+CACHE_VERSION = 2 # bump when the format of cached results changes
+COSTS_FILE = os.path.expanduser("~/.style-annotator/costs.json") # measured feature costs
+GATE_MAX_ERRORS = 10 # errors a file may have and still pass the gate
+MANIFEST_NAME = ".manifest.json" # kept in the target directory of render_features
+SLOW_FILE_SECONDS = 0.5 # files slower than this get a cProfile dump when profiling
+BACKENDS = ("python", "numpy") # ways of running the features, see run_feature
+DEFAULT_BACKEND = "python"
 
 #
 # INPUT MANIPULATION
 #
 
+# the parts of a Code object features can depend on, see Feature.requires
+CODE_VIEWS = ("text", "lines", "indent", "whitespace", "comment", "levels", "stripped", "ast")
+
+# the attributes of a Code object that make up each view
+VIEW_ATTRIBUTES = {"text": ("text",),
+                   "lines": ("lines",),
+                   "indent": ("table",),
+                   "whitespace": ("table",),
+                   "comment": ("table",),
+                   "levels": ("levels",),
+                   "stripped": ("stripped",),
+                   "ast": ("ast",)}
+
+# an edit replaced lines first to old_end (exclusive) with first to new_end;
+# lines from new_end to dirty_end have new ignore flags or levels
+Edit = namedtuple("Edit", "first old_end new_end dirty_end changed")
+
 class Code:
-  """Wrapper for holding information about a single file of code."""
+  """Wrapper for holding information about a single file of code.
+
+  Everything but the text is computed from it the first time it is read
+  (see LAZY_ATTRIBUTES), so features only pay for what they use."""
 
   def __init__(self, text=None, filename=None):
     if filename == None and text == None:
@@ -28,51 +66,158 @@ class Code:
       return
     if filename:
       self.filename = filename
-      self.text = get_text(filename)
-    elif text:
+      self.text = map_text(filename) # an mmap, which reads like a string
+    else:
       self.text = text
-    self.lines = self.text.split("\n")
-    self.linebreak_indices = get_linebreak_indices(self.text)
-    self.levels = get_indent_levels(self.lines)
-    self.ignore_lines = get_ignore_lines(self.lines)
-
-    self.stripped = [] # lines without whitespace or comments
-    for line_no, line in enumerate(self.lines):
-      if self.ignore_lines[line_no]:
-        self.stripped.append("")
-      else:
-        self.stripped.append(strip(line))
+
+  def __getattr__(self, name):
+    # only called for attributes that aren't set yet
+    compute = LAZY_ATTRIBUTES.get(name)
+    if compute is None:
+      raise AttributeError(name)
+    value = compute(self)
+    setattr(self, name, value)
+    return value
+
+  def has(self, name):
+    """Whether an attribute has been computed yet"""
+    return name in self.__dict__
+
+  def prepare(self, views):
+    """Computes the attributes the views (see CODE_VIEWS) are made of"""
+    for view in views:
+      for name in VIEW_ATTRIBUTES[view]:
+        getattr(self, name)
+
+  def edit(self, start, end, replacement):
+    """Replaces the text from index start to end (exclusive) with replacement
+
+    Only the edited lines are lexed again, and the ignored lines and indent
+    levels are only recomputed from the first edited line until they come
+    out the same as before the edit. Indent levels that haven't been
+    computed yet are left to be computed from the new text. Returns an Edit."""
+    self.prepare(("lines", "indent", "stripped"))
+    has_levels = self.has("levels")
+    self.__dict__.pop("ast", None) # parsed again when next read
+    first = self.get_line_for_offset(start)
+    last = self.get_line_for_offset(end)
+    if last < len(self.linebreak_indices):
+      segment_end = self.linebreak_indices[last]
+    else:
+      segment_end = len(self.text)
+    segment_start = self.get_offset_for_line(first)
+    char_delta = len(replacement) - (end - start)
+
+    # the edited lines, from the start of the first to the end of the last
+    self.text = self.text[:start] + replacement + self.text[end:]
+    self.lines = list(self.lines)
+    segment = self.text[segment_start:segment_end + char_delta]
+    new_lines = segment.split("\n")
+    old_end = last + 1
+    new_end = first + len(new_lines)
+
+    old_table = self.table
+    old_rows = dict((name, getattr(old_table, name)[first:old_end])
+                    for name in ("indent", "whitespace", "comment"))
+    if has_levels:
+      old_levels = self.levels[first:old_end]
+    old_stripped = self.stripped[first:old_end]
+
+    self.lines[first:old_end] = new_lines
+    breaks = [segment_start + index for index in get_linebreak_indices(segment)]
+    self.linebreak_indices = (self.linebreak_indices[:first] + breaks +
+                              [index + char_delta for index in self.linebreak_indices[last:]])
+
+    self.table.splice(first, old_end, lex(new_lines))
+    ignore_end = update_ignore(self.table, first, new_end)
+
+    levels_end = new_end
+    if has_levels:
+      self.levels.splice(first, old_end, len(new_lines))
+      # the levels depend on the ignore flags, so go at least as far
+      levels_end = update_indent_levels(self.table, self.levels,
+                                        first, max(ignore_end, new_end))
+    dirty_end = max(ignore_end, levels_end, new_end)
+
+    # which of the views of the code changed; levels and ignore flags that
+    # had to be recomputed past the edited lines are taken to have changed
+    changed = set(["text", "lines", "ast"])
+    if new_end != old_end:
+      changed.update(CODE_VIEWS)
+    else:
+      for name, rows in old_rows.iteritems():
+        if getattr(self.table, name)[first:new_end] != rows:
+          changed.add(name)
+      if not has_levels or levels_end > new_end or self.levels[first:new_end] != old_levels:
+        changed.add("levels")
+      if ignore_end > new_end or self.stripped[first:new_end] != old_stripped:
+        changed.add("stripped")
+
+    return Edit(first, old_end, new_end, dirty_end, changed)
+
+  def get_line_for_offset(self, offset):
+    """Finds the line no. of the character at an index into the code"""
+    return bisect_left(self.linebreak_indices, offset)
+
+  def get_offset_for_line(self, line_no):
+    """Finds the index into the code at which a line starts"""
+    if line_no == 0:
+      return 0
+    return self.linebreak_indices[line_no - 1] + 1
 
   def get_lines_for_span(self, span):
     """Given a span of character indices (start, end) into the code, finds the line nos."""
     start, end = span
-    startline = 0
-    for line_index, char_index in enumerate(self.linebreak_indices):
-      if char_index > start:
-        startline = line_index 
-      if char_index > end:
-        return (startline, line_index)
-    return startline, len(self.linebreak_indices)
+    return self.get_line_for_offset(start), self.get_line_for_offset(max(start, end - 1))
+
+  def get_lines_for_spans(self, spans):
+    """Finds the (start, end) line nos. of many spans at once
+
+    Spans sorted by position, as re.finditer gives them, are looked up
+    without restarting each search from the top of the file."""
+    indices = self.linebreak_indices
+    lines = []
+    lo = 0
+    last = 0
+    for start, end in spans:
+      if start < last:
+        lo = 0
+      last = start
+      lo = startline = bisect_left(indices, start, lo)
+      endline = bisect_left(indices, max(start, end - 1), lo)
+      lines.append((startline, endline))
+    return lines
 
   def get_ast(self):
-    """Get the AST for the code."""
-    if not self.ast:
-      self.ast = get_ast_from_file(self.filename)
+    """Get the AST for the code: a pycparser tree, or None if the code
+    doesn't parse or pycparser isn't installed (see utils.parsing)."""
     return self.ast
 
-  ast = property(get_ast)
+def _get_levels(code):
+  levels = IndentLevels(len(code.table))
+  update_indent_levels(code.table, levels)
+  return levels
+
+# how each attribute of a Code object is computed when first read
+LAZY_ATTRIBUTES = {
+  "linebreak_indices": lambda code: get_linebreak_indices(code.text),
+  "lines": lambda code: Lines(code.text, code.linebreak_indices), # sliced out as needed
+  "table": lambda code: lex(code.lines), # single pass over the lines
+  "ignore_lines": lambda code: code.table.ignore,
+  "levels": _get_levels,
+  "stripped": lambda code: StrippedLines(code.table), # lines without whitespace or comments
+  "ast": lambda code: parsing.get_ast(code.text, preprocess), # None if it doesn't parse
+}
 
 def get_linebreak_indices(text):
   """Finds the indices in text at which linebreaks happen
 
   This is useful to find what lines a particular text appears on"""
-  chunks = re.split(r"(\n)", text)
-  chars = 0
   indices = []
-  for index, chunk in enumerate(chunks):
-    if index % 2 == 1: #newline
-      indices.append(chars)
-    chars += len(chunk)
+  index = text.find("\n")
+  while index != -1:
+    indices.append(index)
+    index = text.find("\n", index + 1)
   return indices
 
 def get_text(filename):
@@ -92,21 +237,293 @@ def get_cpp(filename, cpp_path='cpp', cpp_args=''):
                 universal_newlines=True)
   return pipe.communicate()[0]
 
+preprocessor = Preprocessor() # preprocesses code for parsing in this process
+
+def preprocess(text):
+  """Preprocesses code for parsing, see utils.parsing.get_ast"""
+  return preprocessor.preprocess(text)
+
 #
 # FILE MANIPULATION
 #
 
-def annotate(code, feature_list=production_feature_list):
-  """Takes a Code object and a feature list and returns all of the features"""
-  annotations = {}
+def iter_annotations(code, feature_list=production_feature_list, timeouts=None, cache=None,
+                     backend=DEFAULT_BACKEND):
+  """Takes a Code object and a feature list and yields a features.Diagnostic
+  for each problem as the features find them
+
+  Each feature gets its own time budget (see utils.deadline), which doesn't
+  run while the caller holds a diagnostic; a feature that runs out is
+  reported and skipped, and the remaining features still run.
+  If timeouts is a list, the TimedOutExc of each such feature is appended.
+
+  If a utils.cache.Cache is given, results are looked up by the hash of the
+  code and the feature list fingerprint. They are stored once every feature
+  has run to completion, so runs with timeouts or that the caller stops
+  early aren't cached.
+
+  backend is one of BACKENDS, see run_feature. Both give the same results."""
+  check_backend(backend)
+  if cache is not None:
+    key = get_cache_key(code, feature_list)
+    cached = cache.get(key)
+    if cached is not None:
+      for diagnostic in cached:
+        yield diagnostic
+      return
+
+  diagnostics = []
+  _timeouts = []
+  start = time.time()
   for feature in feature_list:
-    f = feature()
-    try: 
-      f.compute(code, annotations)
-    except TimedOutExc as e:
-      print "Timed out execution"
+    for diagnostic in run_feature(feature, code, _timeouts, backend=backend):
+      diagnostics.append(diagnostic)
+      yield diagnostic
+  profiling.profile.record_file(getattr(code, "filename", None) or "<code>",
+                                time.time() - start, len(code.lines))
+
+  if timeouts is not None:
+    timeouts.extend(_timeouts)
+  if cache is not None and not _timeouts:
+    cache.put(key, diagnostics)
+
+def run_feature(feature, code, timeouts=None, lines=None, backend=DEFAULT_BACKEND,
+                instance=None, edit=None, previous=None):
+  """Yields the diagnostics of a single feature, within its time budget
+
+  If the feature times out, this is reported, its TimedOutExc is appended
+  to timeouts (if it is a list), and no further diagnostics are yielded.
+  For local features, lines can be a (start, end) range of lines to check.
+  With the "numpy" backend, features that have a check_vectorized method
+  run that instead of check. The run is recorded in utils.profiling.profile,
+  and its cost, with the time taken to build the views it needed that
+  weren't built yet, in FEATURE_COSTS.
+
+  instance is the instance of feature to run, by default a new one. For
+  features with an update method, pass the instance that ran before an
+  edit, the Edit and the diagnostics from before it to have them updated
+  rather than found afresh (see IncrementalAnnotator)."""
+  # not on the feature's time budget, but part of its cost, since a feature
+  # that runs first and needs views nothing else does has to build them
+  start = time.time()
+  code.prepare(feature.requires)
+  prepare_seconds = time.time() - start
+  f = instance if instance is not None else feature()
+  f.budget = budget = Budget(f.timeout, repr(f), getattr(code, "filename", None))
+  if edit is not None:
+    diagnostics = f.update(code, edit, previous)
+    num_lines = edit.dirty_end - edit.first
+  elif lines is None and backend == "numpy" and hasattr(f, "check_vectorized"):
+    diagnostics = f.check_vectorized(code)
+    num_lines = len(code.lines)
+  elif lines is None:
+    diagnostics = f.check(code)
+    num_lines = len(code.lines)
+  else:
+    diagnostics = f.check_lines(code, *lines)
+    num_lines = lines[1] - lines[0]
+  timed_out = False
+  try: 
+    for diagnostic in diagnostics:
+      budget.pause()
+      yield diagnostic
+      budget.resume()
+  except TimedOutExc as e:
+    timed_out = True
+    print >> sys.stderr, "Timed out execution: %s" % e
+    if timeouts is not None:
+      timeouts.append(e)
+  record_cost(feature, prepare_seconds + budget.elapsed(), num_lines)
+  profiling.profile.record_feature(feature.__name__, budget.elapsed(),
+                                   budget.cpu_elapsed(), num_lines, timed_out)
+
+def annotate(code, feature_list=production_feature_list, timeouts=None, cache=None,
+             backend=DEFAULT_BACKEND):
+  """Takes a Code object and a feature list and returns all of the features
+  as a {line: [errors]} dict. See iter_annotations."""
+  return get_annotations(iter_annotations(code, feature_list, timeouts, cache, backend))
+
+def check_backend(backend):
+  """Raises ValueError if backend can't be used"""
+  if backend not in BACKENDS:
+    raise ValueError("unknown backend %r, use one of %s" % (backend, ", ".join(BACKENDS)))
+  if backend == "numpy" and not vectorized.available():
+    raise ValueError("the numpy backend needs numpy installed")
+
+def get_annotations(diagnostics):
+  """Collects diagnostics into a {line: [errors]} dict"""
+  annotations = {}
+  for diagnostic in diagnostics:
+    if diagnostic.line not in annotations:
+      annotations[diagnostic.line] = []
+    annotations[diagnostic.line].append(diagnostic.message)
   return annotations
 
+def get_required_views(feature_list):
+  """The union of the views of the code (see CODE_VIEWS) the features read"""
+  views = set()
+  for feature in feature_list:
+    views.update(feature.requires)
+  return views
+
+def get_cache_key(code, feature_list):
+  """The key the diagnostics for code with feature_list are cached under"""
+  return hash_text("%s|%s|%s" % (CACHE_VERSION, get_fingerprint(feature_list),
+                                 hash_text(code.text)))
+
+#
+# INCREMENTAL ANNOTATION
+#
+
+class IncrementalAnnotator:
+  """Keeps the diagnostics of a Code object up to date as it is edited
+
+  After an edit, local features are only run on the lines that changed,
+  and other features are only run again if a view of the code they
+  require changed. Features with an update method keep an instance for
+  the whole session, which updates its diagnostics after each edit."""
+
+  def __init__(self, code, feature_list=production_feature_list):
+    self.code = code
+    self.feature_list = feature_list
+    self.diagnostics = {} # feature -> list of diagnostics
+    self.instances = {} # feature -> instance kept, for features with update
+    for feature in feature_list:
+      self.diagnostics[feature] = self.run(feature)
+
+  def run(self, feature, edit=None):
+    """Runs a feature on the whole code, or updates its diagnostics after
+       an edit if it can"""
+    instance = None
+    if hasattr(feature, "update"):
+      instance = self.instances.get(feature)
+      if instance is None:
+        instance = self.instances[feature] = feature()
+        edit = None
+    else:
+      edit = None
+    timeouts = []
+    diagnostics = list(run_feature(feature, self.code, timeouts, instance=instance,
+                                   edit=edit, previous=self.diagnostics.get(feature)))
+    if timeouts:
+      self.instances.pop(feature, None) # left half done, so start afresh next time
+    return diagnostics
+
+  def edit(self, start, end, replacement):
+    """Applies an edit to the code (see Code.edit) and updates the diagnostics.
+
+    Returns the features that were run again."""
+    edit = self.code.edit(start, end, replacement)
+    shift = edit.new_end - edit.old_end
+    old_dirty_end = edit.dirty_end - shift # in line numbers from before the edit
+
+    rerun = []
+    for feature in self.feature_list:
+      diagnostics = self.diagnostics[feature]
+      if feature.local:
+        before = [d for d in diagnostics if d.line < edit.first]
+        after = [d._replace(line=d.line + shift) for d in diagnostics
+                 if d.line >= old_dirty_end]
+        lines = (edit.first, edit.dirty_end)
+        diagnostics = before + list(run_feature(feature, self.code, lines=lines)) + after
+      elif edit.changed.intersection(feature.requires):
+        diagnostics = self.run(feature, edit)
+      else:
+        continue
+      self.diagnostics[feature] = diagnostics
+      rerun.append(feature)
+    return rerun
+
+  def __iter__(self):
+    """Iterates over all of the diagnostics, in the order annotate() gives them"""
+    for feature in self.feature_list:
+      for diagnostic in self.diagnostics[feature]:
+        yield diagnostic
+
+  def annotate(self):
+    """Returns the diagnostics as a {line: [errors]} dict, like annotate()"""
+    return get_annotations(self)
+
+#
+# GATE MODE
+#
+
+FEATURE_COSTS = {} # feature name -> measured seconds per line
+COST_WEIGHT = 0.2 # weight of a new measurement in the running average
+
+GateResult = namedtuple("GateResult", "passed diagnostics")
+
+def record_cost(feature, seconds, num_lines):
+  """Adds a measurement of how long a feature took on a file"""
+  cost = seconds / max(num_lines, 1)
+  name = feature.__name__
+  if name in FEATURE_COSTS:
+    FEATURE_COSTS[name] += COST_WEIGHT * (cost - FEATURE_COSTS[name])
+  else:
+    FEATURE_COSTS[name] = cost
+
+def order_by_cost(feature_list):
+  """Sorts features cheapest first. Features not yet measured go first."""
+  return sorted(feature_list, key=lambda feature: FEATURE_COSTS.get(feature.__name__, 0.0))
+
+def load_costs(filename=COSTS_FILE):
+  """Loads feature costs measured by earlier runs, if there are any"""
+  try:
+    FEATURE_COSTS.update(json.load(open(filename)))
+  except (IOError, ValueError):
+    pass
+
+def save_costs(filename=COSTS_FILE):
+  dirname = os.path.dirname(filename)
+  if dirname and not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  json.dump(FEATURE_COSTS, open(filename, "w"))
+
+def gate(code, max_errors=GATE_MAX_ERRORS, feature_list=production_feature_list,
+         backend=DEFAULT_BACKEND):
+  """Checks whether code has at most max_errors errors
+
+  Runs the cheapest features first and stops as soon as there are more
+  than max_errors errors. Returns a GateResult with the verdict and the
+  diagnostics found until then."""
+  diagnostics = []
+  results = iter_annotations(code, order_by_cost(feature_list), backend=backend)
+  for diagnostic in results:
+    diagnostics.append(diagnostic)
+    if len(diagnostics) > max_errors:
+      results.close()
+      break
+  return GateResult(len(diagnostics) <= max_errors, diagnostics)
+
+def calibrate(base, feature_list=production_feature_list):
+  """Measures the cost of each feature on the files in a directory"""
+  for c_file in find_c_files(base):
+    code = Code(filename=c_file)
+    for diagnostic in iter_annotations(code, feature_list):
+      pass
+
+def profile_features(base, feature_list=production_feature_list,
+                     dump_dir=None, threshold=SLOW_FILE_SECONDS, backend=DEFAULT_BACKEND):
+  """Annotates the files in a directory in this process, and returns the
+     resulting utils.profiling.Profile
+
+     If dump_dir is given, the cProfile stats of each file that takes
+     longer than threshold seconds are dumped there as <file>.prof"""
+  profiling.profile.clear()
+  for c_file in find_c_files(base):
+    code = Code(filename=c_file)
+    if not dump_dir:
+      annotate(code, feature_list, backend=backend)
+      continue
+    start = time.time()
+    _, profiler = profiling.run_profiled(annotate, code, feature_list, backend=backend)
+    if time.time() - start > threshold:
+      if not os.path.isdir(dump_dir):
+        os.makedirs(dump_dir)
+      relpath = os.path.relpath(c_file, base).replace(os.sep, "_")
+      profiler.dump_stats(os.path.join(dump_dir, relpath + ".prof"))
+  return profiling.profile
+
 def find_c_files(base):
   """Yields the (full) filenames of each .c file in a dir"""
   for path, dirs, files in os.walk(base):
@@ -116,80 +533,326 @@ def find_c_files(base):
       if ext == ".c":
         yield abspath
 
-def try_features(base):
+def try_features(base, processes=None, cache_dir=CACHE_DIR, manifest_file=None):
   """Tries the features in test_feature_list on all of the files in a directory.
     
-     Prints the resulting annotations"""
+     Prints the resulting annotations. If manifest_file is given, only the
+     files that changed since the last run with it are tried."""
+  fingerprint = get_fingerprint(test_feature_list)
+  manifest = None
+  if manifest_file:
+    manifest = Manifest(manifest_file)
+  stats = {}
+  relpaths = []
   for c_file in find_c_files(base):
-    try:
-      code = Code(filename=c_file)
-    except TimedOutExc:
-      print "timed out parsing code"
+    relpath = os.path.relpath(c_file, base)
+    relpaths.append(relpath)
+    if manifest and manifest.is_fresh(relpath, c_file, fingerprint):
       continue
-    annotations = annotate(code, feature_list=test_feature_list)
+    stats[c_file] = os.stat(c_file)
+  if manifest:
+    manifest.remove_missing(relpaths)
+
+  results = annotate_files(sorted(stats), feature_list=test_feature_list,
+                           processes=processes, cache_dir=cache_dir)
+  for c_file, annotations, error in results:
+    if error:
+      print c_file
+      print error
+      continue
+    if manifest:
+      manifest.record(os.path.relpath(c_file, base), c_file, fingerprint, None,
+                      (stats[c_file].st_size, stats[c_file].st_mtime))
     if annotations:
       print c_file
       print annotations
       print
+  if manifest:
+    manifest.save()
 
-def render_features(base, target):
+def render_features(base, target, processes=None, cache_dir=CACHE_DIR, incremental=True):
   """Tries the features in test_feature_list on all of the files in a directory.
   
-     Renders annotated code to files"""
+     Renders annotated code to files. A manifest of what was rendered is
+     kept in the target directory (see utils.manifest), so with incremental
+     only the files that changed since the last run are rendered again,
+     and the pages of files that were removed are deleted."""
+  fingerprint = get_fingerprint(production_feature_list)
+  manifest = Manifest(os.path.join(target, MANIFEST_NAME))
+  jobs = []
+  stats = {}
+  relpaths = []
   for c_file in find_c_files(base):
+    relpath = os.path.relpath(c_file, base)
+    relpaths.append(relpath)
+    # rename to .html
+    target_fname = os.path.splitext(os.path.join(target, relpath))[0] + ".html"
+    if incremental and manifest.is_fresh(relpath, c_file, fingerprint) and \
+       (manifest.entries[relpath]["output"] is None or os.path.exists(target_fname)):
+      continue
+    stats[c_file] = os.stat(c_file)
+    jobs.append((c_file, target_fname))
+
+  for relpath, entry in manifest.remove_missing(relpaths).iteritems():
+    if entry["output"] and os.path.exists(entry["output"]):
+      os.remove(entry["output"])
+
+  results = run_batch(_render_file, jobs, processes=processes, ordered=False,
+                      initializer=_init_batch,
+                      initargs=(production_feature_list, cache_dir))
+  for job, target_fname, error in results:
+    if error:
+      print job[0]
+      print error
+      continue
+    c_file = job[0]
+    manifest.record(os.path.relpath(c_file, base), c_file, fingerprint, target_fname,
+                    (stats[c_file].st_size, stats[c_file].st_mtime))
+  manifest.save()
+  #TODO: chmod 755 dirs and 644 files
+
+#
+# BATCH PROCESSING
+#
+
+_batch_feature_list = production_feature_list # features run by batch workers
+_batch_cache = None # annotation cache used by batch workers
+_batch_backend = DEFAULT_BACKEND # backend used by batch workers
+
+def _init_batch(feature_list, cache_dir=None, backend=DEFAULT_BACKEND):
+  """Sets the features to run, the cache and the backend to use in a batch worker"""
+  global _batch_feature_list, _batch_cache, _batch_backend
+  _batch_feature_list = feature_list
+  _batch_backend = backend
+  if cache_dir:
+    _batch_cache = Cache(cache_dir)
+  else:
+    _batch_cache = None
+  preprocessor.cache = _batch_cache
+
+def _annotate_file(job):
+  """Batch worker: annotates a single file, from a (filename, None) job,
+     which can carry the file preprocessed ahead of time like the jobs of
+     _annotate_record"""
+  _use_prefetched(job)
+  code = Code(filename=job[0])
+  return annotate(code, feature_list=_batch_feature_list, cache=_batch_cache,
+                  backend=_batch_backend)
+
+def _render_file(job):
+  """Batch worker: annotates a single file and renders it to target_fname.
+
+     Returns target_fname, or None if the file couldn't be rendered"""
+  c_file, target_fname = job
+  code = Code(filename=c_file)
+  annotations = annotate(code, feature_list=_batch_feature_list, cache=_batch_cache,
+                         backend=_batch_backend)
+
+  # make directory if necessary
+  target_dir = os.path.dirname(target_fname)
+  if target_dir and not os.path.exists(target_dir):
     try:
-      code = Code(filename=os.path.join(base, c_file))
-      annotations = annotate(code)
+      os.makedirs(target_dir)
+    except OSError:
+      # another worker got there first
+      if not os.path.isdir(target_dir):
+        raise
 
-      relpath = c_file[len(base):]
+  # stream into a temporary file, so a failed render leaves nothing behind
+  tmp_fname = target_fname + ".tmp"
+  f = open(tmp_fname, "w")
+  try:
+    write_annotated(f, code.lines, annotations)
+  except UnicodeDecodeError:
+    f.close()
+    os.remove(tmp_fname)
+    if os.path.exists(target_fname):
+      os.remove(target_fname) # rendered from an older version of the file
+    return None
+  f.close()
+  os.rename(tmp_fname, target_fname)
+  return target_fname
 
-      template = Template(filename="templates/annotated.txt",
-                          default_filters=['decode.utf8'],
-                          input_encoding='utf-8',
-                          output_encoding='utf8')
-      try:
-        html = template.render(lines=code.lines, annotations=annotations)
-      except UnicodeDecodeError:
-        continue
+def annotate_files(filenames, feature_list=production_feature_list,
+                   processes=None, ordered=True, cache_dir=None, backend=DEFAULT_BACKEND):
+  """Annotates many files across a pool of worker processes.
 
-      # rename to .html, make directory if necessary
-      target_fname = os.path.splitext(os.path.join(target, relpath))[0] + ".html"
-      target_dir = os.path.dirname(target_fname)
-      if target_dir and not os.path.exists(target_dir):
-        os.makedirs(os.path.join(target, target_dir))
+     Yields (filename, annotations, error) for each file; error is None
+     unless annotating that file failed. See utils.batch.run_batch.
+     If cache_dir is given, the workers share an annotation cache there."""
+  check_backend(backend)
+  jobs = prefetch_sources(((c_file, None) for c_file in filenames), feature_list, cache_dir)
+  results = run_batch(_annotate_file, jobs, processes=processes,
+                      ordered=ordered, initializer=_init_batch,
+                      initargs=(feature_list, cache_dir, backend))
+  return ((job[0], annotations, error) for job, annotations, error in results)
 
-      f = open(target_fname, "w")
-      f.write(html)
+#
+# JSON OUTPUT
+#
 
-    except TimedOutExc:
-      print "timed out parsing code"
-      continue
-  #TODO: chmod 755 dirs and 644 files
+def get_record(name, code, feature_list=production_feature_list, cache=None,
+               backend=DEFAULT_BACKEND):
+  """Annotates code into a JSON-ready dict:
+     {"file": name, "diagnostics": [...], "timeouts": [...], "indent_unit": ...}
+
+     Each diagnostic is a dict with the fields of features.Diagnostic;
+     timeouts lists the features that ran out of time, and indent_unit is
+     what the file indents with (see get_indent_unit), or None if the
+     features don't include FeatureIndentation."""
+  timeouts = []
+  diagnostics = list(iter_annotations(code, feature_list, timeouts, cache, backend))
+  return {"file": name,
+          "diagnostics": [diagnostic._asdict() for diagnostic in diagnostics],
+          "timeouts": [e.feature for e in timeouts],
+          "indent_unit": get_indent_unit(code, feature_list, cache)}
+
+def get_indent_unit(code, feature_list, cache=None):
+  """What the code indents with, if the features check indentation.
+     With a cache it's kept next to the diagnostics, so a file found in
+     the cache isn't lexed for it"""
+  if FeatureIndentation not in feature_list:
+    return None
+  if cache is not None:
+    key = hash_text("indent_unit|%s" % get_cache_key(code, feature_list))
+    cached = cache.get(key)
+    if cached is not None:
+      return cached[0]
+  indent_unit = FeatureIndentation().get_indent_unit(code)
+  if cache is not None:
+    cache.put(key, (indent_unit,)) # in a tuple, as None means a miss
+  return indent_unit
+
+def _annotate_record(job):
+  """Batch worker: annotates a (name, text) pair into a record.
+     If text is None, name is a filename to read, and if it's an
+     exception, the file couldn't be read and it's raised. The job can
+     carry a third item, the (source, output) of preprocessing it ahead
+     of time"""
+  name, text = job[:2]
+  if isinstance(text, Exception):
+    raise text
+  _use_prefetched(job)
+  if text is None:
+    code = Code(filename=name)
+  else:
+    code = Code(text=text)
+  return get_record(name, code, _batch_feature_list, _batch_cache, _batch_backend)
+
+def annotate_json(files, feature_list=production_feature_list,
+                  processes=None, ordered=True, cache_dir=None, backend=DEFAULT_BACKEND):
+  """Annotates many (name, text) pairs, yielding a record for each.
+
+     See get_record; if annotating a file failed, its record is
+     {"file": name, "error": traceback} instead. So is the record of a
+     pair whose text is an exception, a file that couldn't be read."""
+  check_backend(backend)
+  files = prefetch_sources(files, feature_list, cache_dir)
+  results = run_batch(_annotate_record, files, processes=processes,
+                      ordered=ordered, initializer=_init_batch,
+                      initargs=(feature_list, cache_dir, backend))
+  for job, record, error in results:
+    if error:
+      record = {"file": job[0], "error": error}
+    yield record
+
+def prefetch_sources(files, feature_list, cache_dir=None):
+  """Yields (name, text, (source, output)) for each (name, text) pair,
+     where output is what the workers' preprocess will be asked for the
+     code (None if it couldn't be had). If none of the features need the
+     parse tree, the pairs are passed through as they are
+
+     cpp runs in the background a few files ahead of the files being
+     handed to the workers, so preprocessing overlaps with annotating the
+     files before them. Uses this process's preprocessor, and its cache."""
+  if "ast" not in get_required_views(feature_list) or not parsing.available():
+    for job in files:
+      yield job
+    return
+  if cache_dir and preprocessor.cache is None:
+    preprocessor.cache = Cache(cache_dir)
+  for (name, text), source, output in preprocessor.prefetch(files, _get_source):
+    yield name, text, (source, output)
+
+def _use_prefetched(job):
+  """Batch worker: hands the preprocessed code a job carries to preprocess"""
+  if len(job) > 2 and job[2][1] is not None:
+    preprocessor.put(*job[2])
+
+def _get_source(job):
+  """The code of a (name, text) pair, as preprocess will get it"""
+  name, text = job
+  if isinstance(text, Exception):
+    return None
+  try:
+    if text is None:
+      text = map_text(name)
+    return parsing.prepare_source(text)
+  except (IOError, OSError):
+    return None # the worker reports the error
+  except ValueError:
+    return None # it can't be parsed
+
+def read_ndjson(lines):
+  """Yields (name, text) from lines of {"file": name, "code": text} JSON.
+     Raises ValueError on a line that isn't one"""
+  for line in lines:
+    if line.strip():
+      entry = json.loads(line)
+      if not isinstance(entry, dict) or not isinstance(entry.get("file"), basestring) or \
+         not isinstance(entry.get("code"), basestring):
+        raise ValueError("expected {\"file\": ..., \"code\": ...} on each line")
+      yield entry["file"], entry["code"].encode("utf8")
+
+def find_json_files(paths, stdin=sys.stdin, processes=1):
+  """Yields (name, text) for the json command: each path can be a .c file,
+     a directory of them, a tar or zip archive, or - for NDJSON on stdin.
+     text is None where the workers should read the file themselves
+
+     The .c files in archives are read without extracting them, and are
+     named archive/member. With processes other than 1, the archives are
+     decompressed in parallel, see utils.archives.iter_archives. For an
+     archive that can't be read, text is the ArchiveError, which
+     annotate_json reports as the archive's error."""
+  archives = iter_archives([path for path in paths if is_archive(path)], processes)
+  for path in paths:
+    if path == "-":
+      for entry in read_ndjson(stdin):
+        yield entry
+    elif os.path.isdir(path):
+      for c_file in find_c_files(path):
+        yield c_file, None
+    elif is_archive(path):
+      _, entries = next(archives)
+      try:
+        for name, text in entries:
+          yield os.path.join(path, name), text
+      except ArchiveError as e:
+        yield path, e
+    else:
+      yield path, None
 
 def show_indent(f):
   """Utility function to show the expected and actual indents for a file"""
-  code = get_text(f)
-  lines = code.split("\n")
-  levels = get_indent_levels(lines)
-  errors = FeatureIndentation(code)
-  ignore = get_ignore_lines(lines)
-  for line_no, line in enumerate(lines):
-    
-    if line_no in errors:
-      print
-      print
-      for i in range(line_no - 3, line_no):
-        print str(levels[i]) + "\t" + lines[i]
-      print str(levels[line_no]) + "\t" + line
-      print " ^^^ "
-      print errors[line_no]
-      print
-      for i in range(line_no+1, line_no+3):
-        print str(levels[i]) + "\t" + lines[i]
-      print
-      print
- 
+  code = Code(filename=f)
+  errors = annotate(code, [FeatureIndentation])
+  print "indented with %s" % FeatureIndentation().get_indent_unit(code)
+  for line_no in sorted(errors):
+    print
+    print
+    for i in range(max(line_no - 3, 0), min(line_no + 3, len(code.lines))):
+      print str(code.levels[i]) + "\t" + code.lines[i]
+      if i == line_no:
+        print " ^^^ "
+        print errors[line_no]
+    print
+    print
+
 def main():
+  backend = DEFAULT_BACKEND
+  if "--numpy" in sys.argv:
+    sys.argv.remove("--numpy")
+    backend = "numpy"
   if len(sys.argv) > 1:
     command = sys.argv[1]
     if command == "test":
@@ -199,6 +862,37 @@ def main():
     elif command == "indent":
       filename = sys.argv[2]
       show_indent(filename)
+    elif command == "gate":
+      filename = sys.argv[2]
+      max_errors = GATE_MAX_ERRORS
+      if len(sys.argv) > 3:
+        max_errors = int(sys.argv[3])
+      load_costs()
+      result = gate(Code(filename=filename), max_errors, backend=backend)
+      for diagnostic in result.diagnostics:
+        print "%s:%i:%i: %s" % (filename, diagnostic.line + 1, diagnostic.column + 1,
+                                diagnostic.message)
+      if not result.passed:
+        print "more than %i style errors" % max_errors
+        sys.exit(1)
+    elif command == "json":
+      files = find_json_files(sys.argv[2:], processes=None)
+      for record in annotate_json(files, ordered=False,
+                                  backend=backend):
+        print json.dumps(record)
+    elif command == "profile":
+      dump_dir = None
+      threshold = SLOW_FILE_SECONDS
+      if len(sys.argv) > 3:
+        dump_dir = sys.argv[3]
+      if len(sys.argv) > 4:
+        threshold = float(sys.argv[4])
+      print profile_features(sys.argv[2], dump_dir=dump_dir, threshold=threshold,
+                             backend=backend).report()
+    elif command == "calibrate":
+      load_costs()
+      calibrate(sys.argv[2])
+      save_costs()
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,281 @@
+#!/usr/bin/python
+
+"""Benchmarks the annotator on synthetic submissions
+
+Generates C files of controllable size and pathology, and times building
+the Code, each feature in production_feature_list and rendering, so
+slowdowns show up before they ship.
+"""
+
+__author__ = "Fil Zembowicz (fil@filosophy.org)"
+
+import sys, json, time, random, multiprocessing
+from annotator import Code, CODE_VIEWS, annotate, run_feature
+from features import production_feature_list
+from utils import vectorized
+from utils.profiling import peak_rss
+from utils.templates import stream_annotated
+
+# (name, pathology, lines) of each benchmark; see generate()
+CASES = [("plain-1k", "plain", 1000),
+         ("plain-20k", "plain", 20000),
+         ("nesting", "nesting", 5000),
+         ("switch", "switch", 5000),
+         ("comments", "comments", 5000),
+         ("brackets", "brackets", 5000),
+         ("long-lines", "long_lines", 2000)]
+REPEAT = 5 # timed runs of each stage
+TOLERANCE = 0.25 # slowdown over the baseline counted as a regression
+MIN_SECONDS = 0.001 # differences smaller than this are noise
+MAX_NESTING = 40 # deepest nesting in the "nesting" pathology
+
+#
+# SYNTHETIC CORPUS
+#
+
+STATEMENTS = ["a = a + b;", "b = b * 2;", "printf(\"%d\\n\", a);",
+              "a = get_int();", "total += a;", "b--;"]
+CONDITIONS = ["a > b", "b != 0", "a % 2 == 0", "a < 100 && b > 0"]
+
+def plain_block(r, depth, size):
+  """A mix of statements, comments, loops and conditionals"""
+  indent = "    " * depth
+  out = []
+  while len(out) < size:
+    choice = r.random()
+    if choice < 0.1:
+      out.append(indent + "// " + r.choice(STATEMENTS))
+    elif choice < 0.15:
+      out.append("")
+    elif choice < 0.3 and depth < 4:
+      out.append(indent + "if (%s)" % r.choice(CONDITIONS))
+      out.append(indent + "{")
+      out.extend(plain_block(r, depth + 1, r.randint(1, 6)))
+      out.append(indent + "}")
+      if r.random() < 0.3:
+        out.append(indent + "else")
+        out.append(indent + "{")
+        out.extend(plain_block(r, depth + 1, r.randint(1, 4)))
+        out.append(indent + "}")
+    elif choice < 0.4 and depth < 4:
+      out.append(indent + "for (int i = 0; i < b; i++)")
+      out.append(indent + "{")
+      out.extend(plain_block(r, depth + 1, r.randint(1, 6)))
+      out.append(indent + "}")
+    elif choice < 0.45:
+      out.append(indent + "while (a > 0)")
+      out.append(indent + "    a--;")
+    else:
+      out.append(indent + r.choice(STATEMENTS))
+  return out
+
+def nesting_block(r, depth, size):
+  """Conditionals nested up to MAX_NESTING deep, over and over"""
+  out = []
+  while len(out) < size:
+    levels = r.randint(1, max(min(MAX_NESTING, (size - len(out)) / 2), 1))
+    for level in xrange(levels):
+      out.append("    " * (depth + level) + "if (a > %i) {" % level)
+    out.append("    " * (depth + levels) + r.choice(STATEMENTS))
+    for level in reversed(xrange(levels)):
+      out.append("    " * (depth + level) + "}")
+  return out
+
+def switch_block(r, depth, size):
+  """One huge switch statement"""
+  indent = "    " * depth
+  out = [indent + "switch (a)", indent + "{"]
+  case = 0
+  while len(out) < size:
+    out.append(indent + "    case %i:" % case)
+    out.append(indent + "        " + r.choice(STATEMENTS))
+    out.append(indent + "        break;")
+    case += 1
+  out.append(indent + "    default:")
+  out.append(indent + "        break;")
+  out.append(indent + "}")
+  return out
+
+def comments_block(r, depth, size):
+  """Long multiline comments between a few statements"""
+  indent = "    " * depth
+  out = []
+  while len(out) < size:
+    out.append(indent + "/*")
+    for _ in xrange(min(r.randint(50, 300), size - len(out))):
+      out.append(indent + " * " + " ".join(r.choice(STATEMENTS) for _ in xrange(3)))
+    out.append(indent + " */")
+    out.append(indent + r.choice(STATEMENTS))
+  return out
+
+def brackets_block(r, depth, size):
+  """Thousands of short blocks, so thousands of ") {" """
+  indent = "    " * depth
+  out = []
+  k = 0
+  while len(out) < size:
+    out.append(indent + "if (a == %i) {" % k)
+    out.append(indent + "    " + r.choice(STATEMENTS))
+    out.append(indent + "}")
+    k += 1
+  return out
+
+def long_lines_block(r, depth, size):
+  """Statements that run to hundreds or thousands of characters"""
+  indent = "    " * depth
+  out = []
+  while len(out) < size:
+    words = " ".join("word%i" % r.randint(0, 999) for _ in xrange(r.randint(20, 400)))
+    out.append(indent + "printf(\"%s\\n\");" % words)
+  return out
+
+PATHOLOGIES = {"plain": plain_block,
+               "nesting": nesting_block,
+               "switch": switch_block,
+               "comments": comments_block,
+               "brackets": brackets_block,
+               "long_lines": long_lines_block}
+
+def generate(lines=1000, pathology="plain", seed=0):
+  """Generates a synthetic C submission of about lines lines.
+     The same arguments always give the same file."""
+  r = random.Random(seed)
+  block = PATHOLOGIES[pathology]
+  out = ["/**", " * synthetic.c", " *", " * Generated by benchmark.py", " */", "",
+         "#include <stdio.h>", ""]
+  function = 0
+  while len(out) < lines:
+    out.append("int")
+    out.append("f%i(int a, int b)" % function)
+    out.append("{")
+    out.extend(block(r, 1, min(lines - len(out), 2000)))
+    out.append("    return a;")
+    out.append("}")
+    out.append("")
+    function += 1
+  return "\n".join(out) + "\n"
+
+#
+# MEASUREMENT
+#
+
+def time_runs(func, repeat=REPEAT):
+  """Sorted wall times of repeat calls of func"""
+  times = []
+  for _ in xrange(repeat):
+    start = time.time()
+    func()
+    times.append(time.time() - start)
+  return sorted(times)
+
+def summarize(times, num_lines):
+  median = times[len(times) / 2]
+  return {"min": times[0],
+          "median": median,
+          "max": times[-1],
+          "lines_per_second": num_lines / max(median, 1e-9)}
+
+def measure(case, repeat=REPEAT):
+  """Runs a benchmark case, returns its results as a JSON-ready dict
+
+     Each stage is a key of "stages": "code" is building the Code and all
+     of its views, then each feature by name (and name/numpy for the
+     numpy backend, if numpy is installed), then "render". Run each case
+     in a fresh process (see run_benchmarks), so peak_rss (kB) is that
+     case's."""
+  name, pathology, num_lines = case
+  text = generate(num_lines, pathology)
+  code = Code(text=text)
+  num_lines = len(code.lines)
+  stages = {}
+  timeouts = []
+
+  build = lambda: Code(text=text).prepare(CODE_VIEWS)
+  stages["code"] = summarize(time_runs(build, repeat), num_lines)
+  for feature in production_feature_list:
+    run = lambda: list(run_feature(feature, code, timeouts))
+    stages[feature.__name__] = summarize(time_runs(run, repeat), num_lines)
+    if vectorized.available() and hasattr(feature, "check_vectorized"):
+      run = lambda: list(run_feature(feature, code, timeouts, backend="numpy"))
+      stages[feature.__name__ + "/numpy"] = summarize(time_runs(run, repeat), num_lines)
+  annotations = annotate(code)
+  render = lambda: "".join(stream_annotated(code.lines, annotations))
+  stages["render"] = summarize(time_runs(render, repeat), num_lines)
+
+  return {"lines": num_lines, "bytes": len(text), "stages": stages,
+          "timeouts": [e.feature for e in timeouts], "peak_rss": peak_rss()}
+
+def _measure_case(case):
+  return case[0], measure(case)
+
+def run_benchmarks(cases=CASES):
+  """Measures each case in its own process, one at a time so they don't
+     compete for the CPU. Returns {case name: results}"""
+  pool = multiprocessing.Pool(1, maxtasksperchild=1)
+  try:
+    return dict(pool.imap(_measure_case, cases))
+  finally:
+    pool.close()
+    pool.join()
+
+def compare(results, baseline, tolerance=TOLERANCE):
+  """Finds the stages that got slower than the baseline by more than
+     tolerance. Returns a list of (case, stage, old median, new median)"""
+  regressions = []
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    old_stages = baseline[name]["stages"]
+    for stage, stats in sorted(results[name]["stages"].iteritems()):
+      if stage not in old_stages:
+        continue
+      old, new = old_stages[stage]["median"], stats["median"]
+      if new > old * (1 + tolerance) and new - old > MIN_SECONDS:
+        regressions.append((name, stage, old, new))
+  return regressions
+
+def report(results, baseline=None):
+  """A plain text table of the results, against the baseline if given"""
+  lines = []
+  for name in sorted(results):
+    result = results[name]
+    lines.append("%s: %i lines, %i bytes, peak memory %i kB" % (
+      name, result["lines"], result["bytes"], result["peak_rss"]))
+    if result["timeouts"]:
+      lines.append("  timed out: %s" % ", ".join(sorted(set(result["timeouts"]))))
+    for stage, stats in sorted(result["stages"].iteritems()):
+      line = "  %-32s %9.2fms %12i lines/s" % (stage, 1000 * stats["median"],
+                                               stats["lines_per_second"])
+      if baseline and name in baseline and stage in baseline[name]["stages"]:
+        old = baseline[name]["stages"][stage]["median"]
+        line += "  %+6.0f%%" % (100 * (stats["median"] - old) / max(old, 1e-9))
+      lines.append(line)
+  return "\n".join(lines)
+
+def main():
+  command = sys.argv[1] if len(sys.argv) > 1 else "run"
+  if command == "generate":
+    print generate(int(sys.argv[3]), sys.argv[2]),
+    return
+  results = run_benchmarks()
+  if command == "run":
+    print report(results)
+  elif command == "save":
+    f = open(sys.argv[2], "w")
+    json.dump(results, f, indent=1, sort_keys=True)
+    f.close()
+    print report(results)
+  elif command == "compare":
+    baseline = json.load(open(sys.argv[2]))
+    tolerance = TOLERANCE
+    if len(sys.argv) > 3:
+      tolerance = float(sys.argv[3])
+    print report(results, baseline)
+    regressions = compare(results, baseline, tolerance)
+    for name, stage, old, new in regressions:
+      print "regression: %s %s %.2fms -> %.2fms" % (name, stage, 1000 * old, 1000 * new)
+    if regressions:
+      sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -1,6 +1,8 @@
-
-import json, os, csv, sys
-from annotator import Code, annotate
+import json, os, sys
+from annotator import annotate_json, CACHE_DIR
+from utils.grades import open_grades, GradeStore
+from features import production_feature_list
+from utils.vectorized import numpy
 
 # specs for 2011 .c code
 PSET_1_SPEC = """
@@ -48,12 +50,7 @@ PSET_6_SPEC = """
 
 
 GRADES_CSV = "/home/fzembow/grades.csv"
-STATS = {
-  0:[],
-  1:[],
-  2:[],
-  3:[]
-}
+PERCENTILES = [10, 25, 50, 75, 90] # of the errors per file, reported for each feature
 
 SPECS = {
   "pset1":PSET_1_SPEC,
@@ -65,68 +62,195 @@ SPECS = {
 }
 
 def main():
-  if len(sys.argv) > 1:
-    pset = sys.argv[1]
-    grades = load_grades(GRADES_CSV, pset)
-    eval_pset(SPECS[pset], grades)
-    get_aggregate_stats(STATS)
+  """python eval.py pset1 [pset2 ...|all] [--save table.npz]
+     python eval.py report table.npz"""
+  if numpy is None:
+    print "eval.py needs numpy"
+    sys.exit(1)
+  args = sys.argv[1:]
+  save_file = None
+  if "--save" in args:
+    index = args.index("--save")
+    save_file = args[index + 1]
+    del args[index:index + 2]
+  if len(args) == 2 and args[0] == "report":
+    table = load_table(args[1])
+  elif args:
+    psets = sorted(SPECS) if args == ["all"] else args
+    table = eval_psets(psets, GRADES_CSV)
   else:
     print "please specify pset1, pset2, etc"
     sys.exit(1)
+  if save_file:
+    table.save(save_file)
+  print table.report()
 
 
 def load_grades(csv_file, pset):
-  reader = csv.reader(open(csv_file, "rbU"))
-  grades = {}
-  for row in reader:
-    assignment_pset = row[0]
-    grade = row[1]
-    student = row[3]
+  """{student: grade} for a pset, see utils.grades.open_grades"""
+  return open_grades(csv_file).for_pset(pset)
 
-    if pset == assignment_pset:
-      grades[str(student)] = grade
-  return grades
 
-
-def eval_pset(spec, grades):
-  spec = json.loads(PSET_1_SPEC)
+def find_pset_files(spec):
+  """Yields (file location, student) for each submitted file of a pset.
+     spec is a pset spec (see PSET_1_SPEC), as JSON or already loaded"""
+  if isinstance(spec, basestring):
+    spec = json.loads(spec)
   base_dir = spec["base_dir"]
-  pset_files = spec["files"]
-
-  for student in os.listdir(base_dir):
+  for student in sorted(os.listdir(base_dir)):
     user_dir = os.path.join(base_dir, student)
 
-    for pset_file in pset_files:
+    for pset_file in spec["files"]:
       pset_file_loc = os.path.join(user_dir, pset_file)
-
-      try:
-        code = Code(filename=pset_file_loc)
-        annotations = annotate(code)
-        num_errors = len(annotations)
-        try:
-          grade = grades[student]
-          try:
-            STATS[int(grade)].append(num_errors)
-          except ValueError:
-            # grade is "NULL" or not a number
-            pass
-
-        except KeyError:
-          # student doesn't have this grade
-          pass
-
-      except IOError:
+      if not os.path.exists(pset_file_loc):
         #missing assignment file
-        pass
+        continue
+      yield pset_file_loc, student
+
+
+def eval_psets(psets, grades_csv=GRADES_CSV, processes=None,
+               feature_list=production_feature_list):
+  """Annotates the files of several psets and joins them with the grades
+     into an ErrorTable. The files of all of the psets are annotated in a
+     single pool of processes, so the slow psets don't hold up the others"""
+  jobs = {} # file location -> (pset, student)
+  for pset in psets:
+    for pset_file_loc, student in find_pset_files(SPECS[pset]):
+      jobs[pset_file_loc] = (pset, student)
+  return eval_files(jobs, open_grades(grades_csv), processes, feature_list)
+
+def eval_pset(spec, grades, processes=None, feature_list=production_feature_list,
+              cache_dir=CACHE_DIR):
+  """Annotates the files of a single pset, see eval_psets.
+     grades maps student -> grade, see load_grades"""
+  jobs = dict((pset_file_loc, ("", student))
+              for pset_file_loc, student in find_pset_files(spec))
+  return eval_files(jobs, GradeStore({"": grades}), processes, feature_list, cache_dir)
+
+def eval_files(jobs, grades, processes=None, feature_list=production_feature_list,
+               cache_dir=CACHE_DIR):
+  """Annotates the files in jobs, {file location: (pset, student)}, and
+     counts the errors of each feature into an ErrorTable, along with the
+     grades, a GradeStore. The records are joined with the grades as they
+     come in"""
+  features = [repr(feature()) for feature in feature_list]
+  columns = dict((feature, column) for column, feature in enumerate(features))
+  records = annotate_json([(pset_file_loc, None) for pset_file_loc in sorted(jobs)],
+                          feature_list, processes=processes, cache_dir=cache_dir)
+
+  def count_errors():
+    """Yields a (pset, student, file location, counts) row for each record"""
+    for record in records:
+      if "error" in record:
+        print record["file"]
+        print record["error"]
+        continue
+      pset, student = jobs[record["file"]]
+      counts = [0] * len(features)
+      for diagnostic in record["diagnostics"]:
+        counts[columns[diagnostic["feature"]]] += 1
+      yield pset, student, record["file"], counts
+
+  rows = [(pset, student, path, get_grade(grade), counts)
+          for (pset, student, path, counts), grade in grades.join(count_errors())]
+  return ErrorTable(features, rows)
+
+def get_grade(grade):
+  """A grade from the CSV as a float, nan if it's missing (None), "NULL"
+     or not a number"""
+  try:
+    return float(grade)
+  except (TypeError, ValueError):
+    return float("nan")
+
+
+class ErrorTable:
+  """Per-file, per-feature error counts of graded submissions, as columns
+
+  pset, student and path are arrays of strings, grade an array of floats
+  (nan where there is no grade), and counts an array with a row for each
+  file and a column for each of features. Saved and loaded as .npz."""
+
+  def __init__(self, features, rows=(), columns=None):
+    self.features = list(features)
+    if columns is not None:
+      self.pset, self.student, self.path, self.grade, self.counts = columns
+      return
+    rows = list(rows)
+    self.pset = numpy.array([row[0] for row in rows], dtype=str)
+    self.student = numpy.array([row[1] for row in rows], dtype=str)
+    self.path = numpy.array([row[2] for row in rows], dtype=str)
+    self.grade = numpy.array([row[3] for row in rows], dtype=numpy.float64)
+    self.counts = numpy.array([row[4] for row in rows], dtype=numpy.int32)
+    self.counts.shape = (len(rows), len(self.features))
+
+  def __len__(self):
+    return len(self.grade)
+
+  def save(self, filename):
+    numpy.savez_compressed(filename, features=numpy.array(self.features, dtype=str),
+                           pset=self.pset, student=self.student, path=self.path,
+                           grade=self.grade, counts=self.counts)
+
+  def totals(self):
+    """The number of errors of each file"""
+    return self.counts.sum(axis=1)
+
+  def graded(self):
+    """A mask of the files with a grade"""
+    return ~numpy.isnan(self.grade)
+
+  def correlations(self):
+    """The (Pearson) correlation of the errors of each feature with the
+       grades, nan where it isn't defined, e.g. for features with no errors"""
+    graded = self.graded()
+    if not graded.any():
+      return numpy.full(len(self.features), numpy.nan)
+    counts = self.counts[graded].astype(numpy.float64)
+    grades = self.grade[graded]
+    counts -= counts.mean(axis=0)
+    grades = grades - grades.mean()
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+      return counts.T.dot(grades) / numpy.sqrt((counts ** 2).sum(axis=0) *
+                                               (grades ** 2).sum())
+
+  def percentiles(self, percentiles=PERCENTILES):
+    """An array with a row for each of percentiles of the errors per file,
+       and a column for each feature"""
+    if not len(self):
+      return numpy.zeros((len(percentiles), len(self.features)))
+    return numpy.percentile(self.counts, percentiles, axis=0)
+
+  def grade_means(self):
+    """Maps each grade to the mean number of errors of the files with it"""
+    graded = self.graded()
+    grades, inverse = numpy.unique(self.grade[graded], return_inverse=True)
+    totals = numpy.bincount(inverse, weights=self.totals()[graded])
+    files = numpy.bincount(inverse)
+    return dict(zip(grades.tolist(), (totals / files).tolist()))
 
+  def report(self):
+    """A plain text table of the statistics"""
+    lines = ["%i files, %i graded" % (len(self), self.graded().sum())]
+    header = "%-36s %7s" % ("feature", "r")
+    header += "".join(" %5s" % ("p%i" % percentile) for percentile in PERCENTILES)
+    lines.append(header)
+    percentiles = self.percentiles()
+    for column, (feature, r) in enumerate(zip(self.features, self.correlations())):
+      line = "%-36s %7s" % (feature[:36], "n/a" if numpy.isnan(r) else "%+.3f" % r)
+      line += "".join(" %5g" % value for value in percentiles[:, column])
+      lines.append(line)
+    lines.append("mean errors per grade:")
+    for grade, mean in sorted(self.grade_means().iteritems()):
+      lines.append("  %g: %.2f" % (grade, mean))
+    return "\n".join(lines)
 
-def get_aggregate_stats(stats):
-  for grade, errors in stats.iteritems():
-    try:
-      print grade, 1.0 * sum(errors) / len(errors)
-    except ZeroDivisionError:
-      # no assignments with this score
-      pass
+def load_table(filename):
+  """Loads an ErrorTable saved with ErrorTable.save"""
+  saved = numpy.load(filename)
+  return ErrorTable(saved["features"].tolist(),
+                    columns=[saved[name] for name in
+                             ("pset", "student", "path", "grade", "counts")])
 
 if __name__ == "__main__":
   main()
@@ -3,8 +3,8 @@
 """Style (readability) features of .c code
   
 
-Features return None if the code has the feature, or
-a dict of {line: error} if missing. Line numbers always 0-based
+Features yield a Diagnostic for each place the code is missing
+the feature. Line numbers always 0-based
 """
 
 __author__ = "Fil Zembowicz (fil@filosophy.org)"
@@ -18,105 +18,288 @@ __author__ = "Fil Zembowicz (fil@filosophy.org)"
 LINE_LENGTH_THRESHOLD = 120 # when to warn about too wide lines
 MAX_WHITESPACE_LINES = 3 # most consecutive whitespace lines to allow
 MAX_NON_WHITESPACE_LINES = 8 # most consecutive non-whitespace lines to allow
+FEATURES_VERSION = 3 # bump when the output of a feature changes, to invalidate caches
 
 import re
-from utils.deadline import deadline
-from utils.code_features import get_indent_levels
-from utils.line_features import get_indent, is_whitespace_line, is_comment
+from collections import namedtuple, Counter
+from itertools import izip
+from utils.deadline import deadline, Budget
+from utils.rules import RuleSet
+from utils.code_features import NO_LEVEL
+from utils import vectorized, parsing
+from utils.line_features import get_num_statements, get_comma_spacing
+from utils.vectorized import numpy
 ## 
 ## FEATURES
 ##
 
+INDENTED_LINE_RE = re.compile(r"^([ \t])[ \t]*\S", re.M) # group 1 is what a line indents with
+BRACKET_RE = re.compile(r"(\)\s*?{)") # the { after a ) of params, with what's between
+BRACKET_INDENT_RE = re.compile(r"\n[\ \t\r\f]*")
+BRACKET_NEWLINE_RE = re.compile(r"\)[\ \t\r\f]*?\n")
+
+Diagnostic = namedtuple("Diagnostic", "line column feature message severity")
+
 class Feature:
+  timeout = None    # seconds allowed per run, set with @deadline
+  budget = Budget() # replaced with a real budget for each run by annotate()
+  severity = "warning"
+  requires = ("text",) # the views of the code the feature reads (annotator.CODE_VIEWS)
+  local = False        # whether the errors on a line only depend on that line
+
+  # Features can also implement check_vectorized(code), which gives the
+  # same diagnostics as check(code) using numpy, for the "numpy" backend
+
+  def check(self, code):
+    """Yields a Diagnostic for each problem found in the code"""
+    if self.local:
+      return self.check_lines(code, 0, len(code.lines))
+    raise NotImplementedError
+
+  def check_lines(self, code, start, end):
+    """For local features, yields the Diagnostics of lines start to end (exclusive)"""
+    raise NotImplementedError
+
+  def compute(self, code, annotations):
+    """Runs check, adding the errors to a {line: [errors]} dict"""
+    for diagnostic in self.check(code):
+      self.add_to_annotations(diagnostic.line, diagnostic.message, annotations)
+
+  def diagnostic(self, line_no, error, column=0):
+    return Diagnostic(line_no, column, repr(self), error, self.severity)
+
   def add_to_annotations(self, line_no, error, annotations):
     if line_no not in annotations:
       annotations[line_no] = []
     annotations[line_no].append(error)
 
+class RuleFeature(Feature):
+  """A feature made of regex rules that are tried on every line
+
+  Subclasses set rules to a RuleSet (compiled once, at import), source to
+  the Code attribute holding the lines to check, and implement on_match,
+  which is called for each line that one of the rules matches and returns
+  a Diagnostic or None."""
+  source = "lines"
+  rules = None
+  local = True
+
+  def check_lines(self, code, start, end):
+    lines = getattr(code, self.source)
+    for line_no, name, match in self.rules.scan(lines, start, end):
+      self.budget.check()
+      diagnostic = self.on_match(code, line_no, name, match)
+      if diagnostic is not None:
+        yield diagnostic
+
+  def on_match(self, code, line_no, name, match):
+    raise NotImplementedError
+
 @deadline(1)
 class FeatureIndentation(Feature):
   """Finds misindended lines"""
 
+  requires = ("levels", "indent")
+
   def __repr__(self):
     return "Indentation"
 
-  def compute(self, code, annotations):
-
-    indentations = {} #how far indented levels should be
-
-    lines = code.lines
-    levels = get_indent_levels(lines)
-    # find the distribution of indentations for each indent level
-    for line_no, line in enumerate(lines):
-
-      _levels = levels[line_no]
-      if _levels == None: # lines ignored because they are comments
-        continue
-
-      indent = get_indent(line) 
-      for level in _levels:
-        if level not in indentations:
-          indentations[level] = [indent]
-        else:
-          indentations[level].append(indent)
-      
-    # find the most common indentations for each indent level
-    # ensuring that each successive level is deeper
-    try:
-      common_indentation = {}
-      for level, indents in indentations.iteritems():
-        s = set(indents)
-        if level == 0:
-          common_indentation[level] = max(s, key=indents.count)
-        else: 
-          last_indentation = common_indentation[level-1]
-          most_common = max(s, key=indents.count)
-          # if indent is not deeper
-          if most_common <= last_indentation:
-
-            # TODO(fil): pass error when indent is not deeper
-            while most_common <= last_indentation:
-              s -= set([most_common])
-              if len(s) == 0:
-                most_common = max(set(indents), key=indents.count)
-                break
-              most_common = max(s, key=indents.count)
-
-          common_indentation[level] = most_common
-    except KeyError as e:
-      print "Parsing error in feature_indentation (%s)" % e
+  def check(self, code):
+    levels = code.levels
+    line_indents = code.table.indent
+    # kept for update
+    self.histograms = self.get_histograms(levels, line_indents)
+    self.common_indentation = self.get_common_indentation(self.histograms)
+    self.line_levels = list(levels)
+    self.line_indents = line_indents[:]
+    for diagnostic in self.check_range(0, len(self.line_levels)):
+      yield diagnostic
+
+  def check_vectorized(self, code):
+    levels = code.levels
+    line_indents = code.table.indent
+    histograms = vectorized.level_histograms(code)
+    common_indentation = self.get_common_indentation(histograms)
+
+    # lines with one level are compared all at once, the others one by one
+    single = vectorized.single_levels(code)
+    keys = numpy.array(sorted(common_indentation), dtype=numpy.intc)
+    values = numpy.array([common_indentation[key] for key in keys], dtype=numpy.intc)
+    expected = vectorized.lookup(keys, values, single, NO_LEVEL)
+    indents = vectorized.indents(code)
+    wrong = (single != NO_LEVEL) & (expected != NO_LEVEL) & (indents != expected)
+    diagnostics = [self.diagnostic(line_no, "expected indent %i, got %i" % (want, indent),
+                                   indent)
+                   for line_no, want, indent in zip(numpy.flatnonzero(wrong).tolist(),
+                                                    expected[wrong].tolist(),
+                                                    indents[wrong].tolist())]
+
+    for line_no, _levels in sorted(levels.other.iteritems()):
+      self.budget.check()
+      diagnostic = self.check_line(line_no, _levels, line_indents[line_no],
+                                   common_indentation)
+      if diagnostic:
+        diagnostics.append(diagnostic)
+    diagnostics.sort(key=lambda diagnostic: diagnostic.line)
+    return diagnostics
+
+  def check_range(self, start, end):
+    """Yields the Diagnostics of lines start to end (exclusive), from the
+       levels and indents kept by check"""
+    line_levels = self.line_levels
+    line_indents = self.line_indents
+    common_indentation = self.common_indentation
 
     # find which lines don't match the expected indentation
-    for line_no, line in enumerate(lines):
-      _levels = levels[line_no]
+    for line_no in xrange(start, end):
+      self.budget.check()
+      _levels = line_levels[line_no]
       if _levels == None:
         continue
-
-      expected_indents = []
+      if len(_levels) == 1 and common_indentation.get(_levels[0], line_indents[line_no]) == \
+                               line_indents[line_no]:
+        continue # most lines, which are at their level
+      diagnostic = self.check_line(line_no, _levels, line_indents[line_no],
+                                   common_indentation)
+      if diagnostic:
+        yield diagnostic
+
+  def update(self, code, edit, diagnostics):
+    """The diagnostics after an edit (see annotator.Code.edit), from those
+       before it. Only the lines the edit changed are counted again, and
+       checked again unless that changes the common indentation"""
+    first = edit.first
+    shift = edit.new_end - edit.old_end
+    old_dirty_end = edit.dirty_end - shift
+    new_levels = code.levels[first:edit.dirty_end]
+    new_indents = code.table.indent[first:edit.dirty_end]
+    counts = {} # (level, indent) -> change in the number of lines
+    self.count(counts, self.line_levels[first:old_dirty_end],
+               self.line_indents[first:old_dirty_end], -1)
+    self.count(counts, new_levels, new_indents, 1)
+    self.line_levels[first:old_dirty_end] = new_levels
+    self.line_indents[first:old_dirty_end] = new_indents
+
+    histograms = self.histograms
+    for (level, indent), count in counts.iteritems():
+      if count:
+        histogram = histograms.setdefault(level, Counter())
+        histogram[indent] += count
+        if not histogram[indent]:
+          del histogram[indent]
+          if not histogram:
+            del histograms[level]
+
+    common_indentation = self.get_common_indentation(histograms)
+    if common_indentation != self.common_indentation:
+      self.common_indentation = common_indentation
+      return self.check_range(0, len(self.line_levels))
+    before = [d for d in diagnostics if d.line < first]
+    after = [d._replace(line=d.line + shift) for d in diagnostics if d.line >= old_dirty_end]
+    return before + list(self.check_range(first, edit.dirty_end)) + after
+
+  def count(self, counts, line_levels, line_indents, count):
+    """Adds count to counts[level, indent] for each level of the lines"""
+    for _levels, indent in izip(line_levels, line_indents):
+      if _levels is not None:
+        for level in _levels:
+          key = (level, indent)
+          counts[key] = counts.get(key, 0) + count
+
+  def get_histograms(self, levels, line_indents):
+    """Counts how far the lines at each indent level are indented,
+       as {level: Counter({indent: lines})}"""
+    counts = {}
+    # lines with a single level, counted as (level, indent) pairs at once
+    for pair in izip(levels.level, line_indents):
+      counts[pair] = counts.get(pair, 0) + 1
+    histograms = {}
+    for (level, indent), count in counts.iteritems():
+      self.budget.check()
+      if level != NO_LEVEL: # ignored lines, and those in the side table
+        histograms.setdefault(level, Counter())[indent] += count
+
+    # lines ignored because they are comments aren't in the side table
+    for line_no, _levels in levels.other.iteritems():
+      self.budget.check()
       for level in _levels:
-        try:
-          expected_indents.append(common_indentation[level])
-        except KeyError:
-          continue
-
-      indent = get_indent(line) 
-      if expected_indents and indent not in expected_indents:
+        histograms.setdefault(level, Counter())[line_indents[line_no]] += 1
+    return histograms
+
+  def get_common_indentation(self, histograms):
+    """Finds how far each level is indented in most of the lines
+
+    Levels are taken from the shallowest up, and each has to be deeper
+    than the one below it: a level gets the most common of its indents
+    that are deeper, or if there are none, its most common indent. Ties
+    go to the smaller indent."""
+    common_indentation = {}
+    last_indentation = None
+    for level in sorted(histograms):
+      self.budget.check()
+      modes = sorted(histograms[level].iteritems(), key=lambda (indent, count): (-count, indent))
+      most_common = modes[0][0]
+      if level > 0 and last_indentation is not None:
+        # TODO(fil): pass error when indent is not deeper
+        for indent, count in modes:
+          if indent > last_indentation:
+            most_common = indent
+            break
+      common_indentation[level] = last_indentation = most_common
+    return common_indentation
+
+  def get_indent_unit(self, code, common_indentation=None):
+    """Infers what a file indents with: "tabs", "N spaces", or None if
+       nothing is indented"""
+    if common_indentation is None:
+      histograms = self.get_histograms(code.levels, code.table.indent)
+      common_indentation = self.get_common_indentation(histograms)
+    steps = Counter(indent - common_indentation[level - 1]
+                    for level, indent in common_indentation.iteritems()
+                    if level > 0 and level - 1 in common_indentation and
+                       indent > common_indentation[level - 1])
+    if not steps:
+      return None
+    step = min(steps.iteritems(), key=lambda (step, count): (-count, step))[0]
+    indented_with = Counter(match.group(1) for match in INDENTED_LINE_RE.finditer(code.text))
+    if indented_with["\t"] > indented_with[" "]:
+      return "tabs"
+    return "%i spaces" % step
+
+  def check_line(self, line_no, _levels, indent, common_indentation):
+    """The Diagnostic of a line, if it isn't at any of its levels"""
+    expected_indents = []
+    for level in _levels:
+      try:
+        expected_indents.append(common_indentation[level])
+      except KeyError:
+        continue
 
-        error = "expected indent %i, got %i" % (expected_indents[0], indent)
-        self.add_to_annotations(line_no, error, annotations)
+    if expected_indents and indent not in expected_indents:
+      error = "expected indent %i, got %i" % (expected_indents[0], indent)
+      return self.diagnostic(line_no, error, indent)
 
 @deadline(1)
 class FeatureLineLength(Feature):
   """Finds lines that are too long"""
 
+  requires = ("lines",)
+  local = True
+
   def __repr__(self):
     return "Line length"
 
-  def compute(self, code, annotations):
-    for line_no, line in enumerate(code.lines):
+  def check_lines(self, code, start, end):
+    for line_no, line in enumerate(code.lines[start:end], start):
+      self.budget.check()
       if len(line.rstrip()) > LINE_LENGTH_THRESHOLD:
         error = "line is too long"
-        self.add_to_annotations(line_no, error, annotations)
+        yield self.diagnostic(line_no, error, LINE_LENGTH_THRESHOLD)
+
+  def check_vectorized(self, code):
+    for line_no in vectorized.long_lines(code, LINE_LENGTH_THRESHOLD):
+      error = "line is too long"
+      yield self.diagnostic(line_no, error, LINE_LENGTH_THRESHOLD)
 
 
 @deadline(1)
@@ -126,54 +309,102 @@ class FeatureInconsistentBrackets(Feature):
   def __repr__(self):
     return "Consistent bracket placement"
 
-  def compute(self, code, annotations):
-    iterator = re.finditer(r"(\)\s*?{)", code.text)
-    occurences = []
-
-    for occurence in iterator:
-      occurences.append(occurence)
-
-    if not occurences:
+  def check(self, code):
+    # the spans and placements of the occurences, kept for update
+    self.spans = []
+    self.placements = []
+    self.length = len(code.text)
+    self.scan(code.text, 0, len(code.text), self.spans, self.placements)
+    return self.check_occurences(code)
+
+  def update(self, code, edit, diagnostics):
+    """The diagnostics after an edit (see annotator.Code.edit): only the
+       edited lines are scanned again, and the rest of the occurences are
+       moved along with the text"""
+    text = code.text
+    delta = len(text) - self.length
+    self.length = len(text)
+    start = code.get_offset_for_line(edit.first)
+    if edit.new_end < len(code.lines):
+      end = code.get_offset_for_line(edit.new_end)
+    else:
+      end = len(text)
+    # an occurence can reach past the edited lines over whitespace
+    while start > 0 and text[start - 1].isspace():
+      start -= 1
+    if start > 0 and text[start - 1] == ")":
+      start -= 1
+    while end < len(text) and text[end].isspace():
+      end += 1
+    if end < len(text) and text[end] == "{":
+      end += 1
+
+    spans, placements = [], []
+    for (span_start, span_end), placement in izip(self.spans, self.placements):
+      if span_end <= start:
+        spans.append((span_start, span_end))
+        placements.append(placement)
+    self.scan(text, start, end, spans, placements)
+    for (span_start, span_end), placement in izip(self.spans, self.placements):
+      if span_start >= end - delta:
+        spans.append((span_start + delta, span_end + delta))
+        placements.append(placement)
+    self.spans, self.placements = spans, placements
+    return self.check_occurences(code)
+
+  def scan(self, text, start, end, spans, placements):
+    """Appends the span and the placement (the occurence without its
+       indentation) of each occurence from start to end of text"""
+    for occurence in BRACKET_RE.finditer(text, start, end):
+      self.budget.check()
+      spans.append(occurence.span())
+      placements.append(BRACKET_NEWLINE_RE.sub(")\n",
+                        BRACKET_INDENT_RE.sub("\n", occurence.group())))
+
+  def check_occurences(self, code):
+    """Yields the Diagnostics of the occurences that aren't placed like
+       most of them"""
+    if not self.placements:
       return
-
-    # process occurences to remove whitespace after first newline, find most common
-    processed_occurences = map(lambda x: re.sub(r"\)[\ \t\r\f]*?\n", ")\n",
-                                          re.sub(r"\n[\ \t\r\f]*", "\n", x.group())), occurences)
-
-    most_common = max(set(processed_occurences), key=processed_occurences.count)
+    most_common = max(set(self.placements), key=self.placements.count)
 
     # annotate the cases that don't conform to the common
-    errors = []
-    for index, occurence in enumerate(occurences):
-      if processed_occurences[index] != most_common:
+    spans = []
+    for span, placement in izip(self.spans, self.placements):
+      self.budget.check()
+      if placement != most_common:
 
         # allow exception if it's flush left. some people start code blocks with a { on the next line
         # when all other code is ) { style
         # if flush left is not appropriate, the indent checker will catch it instead
-        match = occurences[index].group()
-        if match.count("\n{") == 1:
+        if code.text[span[0]:span[1]].count("\n{") == 1:
           continue
 
-        # look up the corresponding line to the occurence
-        span = occurence.span()
-        start, end = code.get_lines_for_span(span)
-        error = "inconsistent bracket placement"
-        self.add_to_annotations(end, error, annotations) 
-    return occurences 
+        spans.append(span)
+
+    # look up the corresponding lines to the occurences
+    lines = code.get_lines_for_spans(spans)
+    for (start, end), (start_char, end_char) in zip(lines, spans):
+      error = "inconsistent bracket placement"
+      column = end_char - 1 - code.get_offset_for_line(end) # the {
+      yield self.diagnostic(end, error, column)
 
 
 @deadline(1)
 class FeatureExcessiveWhitespace(Feature):
   """Finds places where there is a large amount of unnecessary whitespace"""
 
+  requires = ("whitespace",)
+
   def __repr__(self):
     return "Excessive whitespace"
 
-  def compute(self, code, annotations):
+  def check(self, code):
     start_line = 0
     whitespace_run = 0
-    for line_no, line in enumerate(code.lines):
-      if is_whitespace_line(line):
+    for line_no, whitespace in enumerate(code.table.whitespace):
+      self.budget.check()
+      if whitespace:
         if whitespace_run > 0:
           whitespace_run += 1 
         else:
@@ -183,119 +414,259 @@ class FeatureExcessiveWhitespace(Feature):
         # end of run
         if whitespace_run > MAX_WHITESPACE_LINES:
           error = "Excess whitespace"
-          self.add_to_annotations(start_line, error, annotations)
+          yield self.diagnostic(start_line, error)
         whitespace_run = 0
 
+  def check_vectorized(self, code):
+    whitespace = vectorized.flags(code.table.whitespace)
+    starts, ends = vectorized.runs(whitespace)
+    # runs at the end of the file never end, so aren't reported
+    long_runs = (ends - starts > MAX_WHITESPACE_LINES) & (ends < len(whitespace))
+    for start_line in starts[long_runs].tolist():
+      error = "Excess whitespace"
+      yield self.diagnostic(start_line, error)
+
 
 @deadline(1)
 class FeatureInlineComments(Feature):
   """Finds places where inline comments don't conform"""
 
+  requires = ("lines", "comment", "indent")
+  local = True
+
   def __repr__(self):
     return "Poorly formatted inline comment"
 
-  def compute(self, code, annotations):
-    for line_no, line in enumerate(code.lines):
-      _line = line.strip()
+  def check_lines(self, code, start, end):
+    table = code.table
+    for line_no in xrange(start, end):
+      self.budget.check()
+      if not table.comment[line_no]:
+        continue
+      _line = code.lines[line_no][table.indent[line_no]:]
       if _line.startswith("//"):
         if _line[2:3] != " ":
           error = "Need single space after // for inline comment"
-          self.add_to_annotations(line_no, error, annotations)
+          yield self.diagnostic(line_no, error, table.indent[line_no])
+
+  def check_vectorized(self, code):
+    table = code.table
+    comments = numpy.flatnonzero(vectorized.flags(table.comment)).tolist()
+    for line_no in comments:
+      self.budget.check()
+      _line = code.lines[line_no][table.indent[line_no]:]
+      if _line.startswith("//"):
+        if _line[2:3] != " ":
+          error = "Need single space after // for inline comment"
+          yield self.diagnostic(line_no, error, table.indent[line_no])
 
 
 @deadline(1)
 class FeatureCommentAtTop(Feature):
   """Finds files that are missing a comment at the top"""
 
+  requires = ("whitespace", "comment")
+
   def __repr__(self):
     return "Comment missing at top of file"
 
-  def compute(self, code, annotations):
-    for line_no, line in enumerate(code.lines):
-      _line = line.strip()
-      if not _line:
+  def check(self, code):
+    table = code.table
+    for line_no in xrange(len(table)):
+      self.budget.check()
+      if table.whitespace[line_no]:
         continue
-      if not is_comment(_line):
+      if not table.comment[line_no]:
         error = "Each file should have a comment at the top"
-        self.add_to_annotations(0, error, annotations)
+        yield self.diagnostic(0, error)
       return
 
 
 @deadline(1)
-class FeatureSpaceAfterKeyword(Feature):
+class FeatureSpaceAfterKeyword(RuleFeature):
   """Finds keywords that don't have a space after them"""
 
+  requires = ("stripped", "indent")
+  source = "stripped"
+  rules = RuleSet([(keyword, r"\b%s\(" % keyword) for keyword in ["if", "for", "while"]])
+
   def __repr__(self):
     return "Keyword missing a space after"
 
-  def compute(self, code, annotations):
-    keywords = ["if", "for", "while"]
-    for line_no, line in enumerate(code.stripped):
-      for keyword in keywords:
-        if re.match(r"\b%s\(" % keyword, line):
-          error = "The keyword '%s' should have a space after, to not confuse with a function" % keyword
-          self.add_to_annotations(line_no, error, annotations)
+  def on_match(self, code, line_no, keyword, match):
+    error = "The keyword '%s' should have a space after, to not confuse with a function" % keyword
+    return self.diagnostic(line_no, error, code.table.indent[line_no] + match.start())
 
 
 @deadline(1)
 class FeatureNotEnoughWhitespace(Feature):
   """Finds places where there are runs of unindented, unbroken code"""
 
+  requires = ("levels", "whitespace", "comment")
+
   #TODO(fil): don't penalize for top level, just level > 0
 
   def __repr__(self):
     return "Not enough whitespace"
 
-  def compute(self, code, annotations):
+  def check(self, code):
     start_line = 0
     no_whitespace_run = 0
     levels = None
+    whitespace = code.table.whitespace
+    comment = code.table.comment
 
-    for line_no, line in enumerate(code.lines):
+    for line_no, level in enumerate(code.levels):
+      self.budget.check()
 
-      level = code.levels[line_no] 
       if no_whitespace_run > 0:
-        if not code.levels[line_no]:
+        if not level:
           if no_whitespace_run > MAX_NON_WHITESPACE_LINES:
             error = "Not enough whitespace"
-            self.add_to_annotations(start_line, error, annotations)
+            yield self.diagnostic(start_line, error)
           no_whitespace_run = 0
           continue
 
         levels = levels & set(level) # check for consistent indent
-        if len(levels) == 0 or is_whitespace_line(line):
+        if len(levels) == 0 or whitespace[line_no]:
           if no_whitespace_run > MAX_NON_WHITESPACE_LINES:
             error = "Not enough whitespace"
-            self.add_to_annotations(start_line, error, annotations)
+            yield self.diagnostic(start_line, error)
           no_whitespace_run = 0
         else:
-          if 0 not in code.levels[line_no]:
+          if 0 not in level:
             no_whitespace_run += 1
           
-      elif not is_whitespace_line(line) and not is_comment(line) and level:
+      elif not whitespace[line_no] and not comment[line_no] and level:
         levels = set(level)
         no_whitespace_run = 1
         start_line = line_no
 
+  def check_vectorized(self, code):
+    # the set of levels of a run can only change where the levels of the
+    # lines change, so this goes through blocks of lines with the same
+    # levels instead of the lines
+    other = code.levels.other
+    single = vectorized.single_levels(code)
+    num_lines = len(single)
+    multi = numpy.zeros(num_lines, dtype=bool)
+    multi[sorted(other)] = True
+    valid = (single != NO_LEVEL) | multi
+    changes = numpy.ones(num_lines, dtype=bool)
+    changes[1:] = (single[1:] != single[:-1]) | multi[1:] | multi[:-1] | ~valid[:-1]
+    starts = numpy.flatnonzero(valid & changes)
+    # blocks end at the next change, or the next line without a level
+    boundaries = numpy.flatnonzero(changes | ~valid)
+    ends = numpy.append(boundaries, num_lines)[
+      numpy.searchsorted(boundaries, starts, side="right")]
+    # runs start at lines with a level that aren't comments: find the first
+    # such line in each block, and the first after the block's first line
+    comment = vectorized.flags(code.table.comment)
+    run_starts = numpy.append(numpy.flatnonzero(valid & ~comment), num_lines)
+    first_starts = run_starts[numpy.searchsorted(run_starts, starts)].tolist()
+    second_starts = run_starts[numpy.searchsorted(run_starts, starts + 1)].tolist()
+
+    no_whitespace_run = 0
+    last_end = -1
+    level_sets = {} # level -> set of just that level
+    blocks = zip(starts.tolist(), ends.tolist(), single[starts].tolist(),
+                 first_starts, second_starts)
+    for start, end, level, first_start, second_start in blocks:
+      self.budget.check()
+      if level == NO_LEVEL:
+        level = frozenset(other[start])
+      elif level in level_sets:
+        level = level_sets[level]
+      else:
+        level = level_sets[level] = frozenset([level])
+
+      if no_whitespace_run > 0:
+        if start == last_end:
+          levels = levels & level # check for consistent indent
+          if levels:
+            if 0 not in level:
+              no_whitespace_run += end - start
+            last_end = end
+            continue
+          first_start = second_start # the line that ended the run can't start one
+        # the run ended at a line without a level, or at another level
+        if no_whitespace_run > MAX_NON_WHITESPACE_LINES:
+          error = "Not enough whitespace"
+          yield self.diagnostic(start_line, error)
+        no_whitespace_run = 0
+
+      if first_start < end:
+        start_line = first_start
+        levels = level
+        no_whitespace_run = 1
+        if 0 not in level:
+          no_whitespace_run += end - start_line - 1
+      last_end = end
+
+    # lines after the last block have no level, so end the last run; a run
+    # going to the end of the file never ends, so isn't reported
+    if no_whitespace_run > MAX_NON_WHITESPACE_LINES and last_end < num_lines:
+      error = "Not enough whitespace"
+      yield self.diagnostic(start_line, error)
+
 @deadline(1)
-class FeatureInconsistentParamSpacing:
-  """Finds whether spacing within parameters is consistent"""
+class FeatureInconsistentParamSpacing(Feature):
+  """Finds whether spacing within parameters is consistent
+
+  Finds the lines with parameter or argument lists in the parse tree, or
+  if the code doesn't parse, just the lines with commas in parentheses.
+  Whichever of "a, b" and "a,b" is less common is reported."""
+
+  requires = ("ast", "lines")
 
   def __repr__(self):
     return "Consistent parameter spacing"
 
-  def compute(self, code, annotations):
-    pass
+  def check(self, code):
+    if code.ast is not None:
+      line_nos = sorted(parsing.list_lines(code.ast))
+    else:
+      line_nos = xrange(len(code.lines))
+
+    commas = [] # (line no., column, spaced)
+    for line_no in line_nos:
+      self.budget.check()
+      if line_no < len(code.lines):
+        commas.extend((line_no, column, spaced)
+                      for column, spaced in get_comma_spacing(code.lines[line_no]))
+
+    num_spaced = sum(1 for _, _, spaced in commas if spaced)
+    spaced_is_common = num_spaced * 2 >= len(commas) # a tie goes to "a, b"
+    last_line_no = None
+    for line_no, column, spaced in commas:
+      if spaced != spaced_is_common and line_no != last_line_no:
+        last_line_no = line_no
+        yield self.diagnostic(line_no, "inconsistent spacing after comma", column)
 
 @deadline(1)
-class FeatureMultipleStatementsPerLine:
-  """Whether there are multiple statements per line"""
+class FeatureMultipleStatementsPerLine(Feature):
+  """Whether there are multiple statements per line
+
+  Counts the statements that start on each line of the parse tree, or if
+  the code doesn't parse, the semicolons on each line."""
+
+  requires = ("ast", "stripped", "indent")
 
   def __repr__(self):
     return "Multiple statements per line"
 
-  def compute(self, code, annotations):
-    pass
+  def check(self, code):
+    if code.ast is not None:
+      statements = parsing.statement_lines(code.ast)
+      line_nos = sorted(line_no for line_no, num_statements in statements.iteritems()
+                        if num_statements > 1 and 0 <= line_no < len(code.table))
+    else:
+      line_nos = (line_no for line_no, stripped in enumerate(code.stripped)
+                  if get_num_statements(stripped) > 1)
+    for line_no in line_nos:
+      self.budget.check()
+      yield self.diagnostic(line_no, "put each statement on a line of its own",
+                            code.table.indent[line_no])
 
 # the features to run
 production_feature_list = [FeatureIndentation,
@@ -306,6 +677,14 @@ production_feature_list = [FeatureIndentation,
                 FeatureCommentAtTop]
 
 test_feature_list = [
-                FeatureSpaceAfterKeyword
+                FeatureSpaceAfterKeyword,
+                FeatureInconsistentParamSpacing,
+                FeatureMultipleStatementsPerLine
                 ]
 #                FeatureNotEnoughWhitespace]
+
+def get_fingerprint(feature_list):
+  """Identifies a feature list and the thresholds it runs with, for caching"""
+  names = ",".join(feature.__name__ for feature in feature_list)
+  return "%s|%s|%s|%s|%s" % (FEATURES_VERSION, names, LINE_LENGTH_THRESHOLD,
+                             MAX_WHITESPACE_LINES, MAX_NON_WHITESPACE_LINES)
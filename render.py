@@ -5,9 +5,7 @@
 __author__ = "Fil Zembowicz (fil@filosophy.org)"
 
 from annotator import annotate, get_text, Code
-from mako.template import Template
-from mako.runtime import Context
-from StringIO import StringIO
+from utils.templates import render as render_template
 import sys
 
 def main(): 
@@ -19,15 +17,9 @@ def main():
   print render(filename)
 
 def render(filename):
-  code = Code(filename)
+  code = Code(filename=filename)
   annotations = annotate(code)
-
-  template = Template(filename="templates/annotated.txt")
-  buf = StringIO()
-  ctx = Context(buf, lines=code.lines, annotations=annotations)
-  template.render_context(ctx)
-  return buf.getvalue()
+  return render_template("annotated.txt", lines=code.lines, annotations=annotations)
 
 if __name__ == "__main__":
   main()
-
@@ -4,41 +4,189 @@
 
 __author__ = "Fil Zembowicz (fil@filosophy.org)"
 
-from annotator import annotate, get_text, Code
-from mako.template import Template
-from mako.runtime import Context
+from annotator import annotate, get_text, Code, annotate_json, read_ndjson
+from utils.archives import iter_tar, iter_zip, ArchiveTooLarge
+from utils.batch import call_safely
+from utils.profiling import Profile, profile
+from utils.templates import render, stream_annotated
+import sys, json, tarfile, zipfile, zlib, threading, multiprocessing
 from StringIO import StringIO
-import sys
-from flask import Flask, request
+from flask import Flask, Response, request
+
+MAX_CONTENT_LENGTH = 1024 * 1024 # largest request body accepted, in bytes
+MAX_ARCHIVE_BYTES = 8 * MAX_CONTENT_LENGTH # bytes a posted archive may unpack into
+MAX_ARCHIVE_MEMBERS = 1024 # entries a posted archive may have
+MAX_PENDING = 64 # requests queued or running in the pool before turning more away
+REQUEST_TIMEOUT = 30 # seconds to wait for the pool before giving up on a request
+WORKERS = None # annotation processes, defaults to the number of cores
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+
+class Busy(Exception):
+  """Raised when the pool already has MAX_PENDING requests"""
+
+class AnnotationPool:
+  """A bounded pool of processes that annotate code for the request threads
+
+  Annotating is CPU bound, so it runs in worker processes, while the
+  (threaded) server only waits on the results. At most max_pending
+  requests are handed to the pool at once; submit() raises Busy past
+  that instead of letting the queue grow without bound.
+
+  The workers report their utils.profiling.Profile with each result,
+  which is merged into profile."""
+
+  def __init__(self, processes=WORKERS, max_pending=MAX_PENDING):
+    self.processes = processes
+    self.pending = threading.BoundedSemaphore(max_pending)
+    self.pool = None
+    self.lock = threading.Lock()
+    self.profile = Profile()
+    self.num_pending = 0 # requests queued or running
+    self.rejected = 0 # requests turned away with Busy
+
+  def get_pool(self):
+    with self.lock:
+      if self.pool is None:
+        self.pool = multiprocessing.Pool(self.processes)
+      return self.pool
+
+  def release(self, result):
+    _, value, error = result
+    with self.lock:
+      self.num_pending -= 1
+      if not error:
+        self.profile.merge(value[1])
+    self.pending.release()
+
+  def submit(self, func, item, timeout=REQUEST_TIMEOUT):
+    """Runs func(item) in the pool and returns its result
+
+    Raises Busy if the pool is full, multiprocessing.TimeoutError if the
+    result isn't in after timeout seconds, and RuntimeError if func
+    raised. A slot in the pool is only freed once the work is actually
+    done, even if the request gave up on it."""
+    if not self.pending.acquire(False):
+      with self.lock:
+        self.rejected += 1
+      raise Busy()
+    pool = self.get_pool()
+    with self.lock:
+      self.num_pending += 1
+    try:
+      result = pool.apply_async(call_safely, ((run_profiled, (func, item)),),
+                                callback=self.release)
+    except:
+      with self.lock:
+        self.num_pending -= 1
+      self.pending.release()
+      raise
+    _, value, error = result.get(timeout)
+    if error:
+      raise RuntimeError(error)
+    return value[0]
+
+  def metrics(self):
+    """The pool's load and profile as a JSON-ready dict"""
+    with self.lock:
+      metrics = self.profile.as_dict()
+      metrics["pending"] = self.num_pending
+      metrics["rejected"] = self.rejected
+    return metrics
+
+  def close(self):
+    with self.lock:
+      if self.pool is not None:
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+def run_profiled(job):
+  """Pool worker: runs func(item), returns its result and the profile of the run"""
+  func, item = job
+  profile.clear()
+  return func(item), profile
+
+pool = AnnotationPool()
+
+def annotate_text(text):
+  """Annotates pasted code, returns its lines and annotations"""
+  code = Code(text=text)
+  return code.lines, annotate(code)
+
+def annotate_batch(files):
+  """Annotates (name, text) pairs, returns a JSON record for each"""
+  return list(annotate_json(files, processes=1))
+
+def get_batch_files():
+  """Gets the (name, text) pairs posted to /annotate/batch: as multipart
+     file uploads, a tar or zip archive, or NDJSON {"file": ..., "code": ...}
+     lines"""
+  if request.files:
+    return [(f.filename, f.read()) for _, f in request.files.items(multi=True)]
+  # archives are unpacked here, in the request thread, so only so far
+  limits = dict(max_member_bytes=MAX_CONTENT_LENGTH, max_bytes=MAX_ARCHIVE_BYTES,
+                max_members=MAX_ARCHIVE_MEMBERS)
+  if request.mimetype in ("application/x-tar", "application/gzip",
+                          "application/x-gzip"):
+    return list(iter_tar(request.stream, **limits))
+  if request.mimetype in ("application/zip", "application/x-zip-compressed"):
+    # zip archives have their index at the end, so need to be seekable
+    return list(iter_zip(StringIO(request.get_data()), **limits))
+  return list(read_ndjson(request.get_data().splitlines()))
 
 @app.route("/")
 def main():
   
-  template = Template(filename="templates/index.txt")
-  return template.render()
+  return render("index.txt")
 
 @app.route("/annotate", methods=["POST"])
 def process():
   if "code" in request.form and request.form["code"]:
     code_input = request.form["code"]
-    code = Code(text=code_input)
-    annotations = annotate(code)
-    
-    template = Template(filename="templates/annotated.txt",
-                        default_filters=['decode.utf8'],
-                        input_encoding='utf-8',
-                        output_encoding='utf8')
-    return template.render(lines=code.lines, annotations=annotations)
+    try:
+      lines, annotations = pool.submit(annotate_text, code_input)
+    except Busy:
+      return "too many submissions right now, try again in a bit", 429, \
+             {"Retry-After": "5"}
+    except multiprocessing.TimeoutError:
+      return "annotating your code took too long", 504
+    return Response(stream_annotated(lines, annotations), mimetype="text/html")
   else:
     return "make sure you pasted code"    
 
+@app.route("/annotate/batch", methods=["POST"])
+def process_batch():
+  try:
+    files = get_batch_files()
+  except ArchiveTooLarge as e:
+    return "archive too large: %s" % e, 413
+  except (ValueError, KeyError, tarfile.TarError, zipfile.BadZipfile, zlib.error, IOError,
+          EOFError):
+    return "expected .c files, a tar or zip archive or NDJSON", 400
+  try:
+    records = pool.submit(annotate_batch, files)
+  except Busy:
+    return "too many submissions right now, try again in a bit", 429, \
+           {"Retry-After": "5"}
+  except multiprocessing.TimeoutError:
+    return "annotating your code took too long", 504
+  return Response((json.dumps(record) + "\n" for record in records),
+                  mimetype="application/x-ndjson")
+
+@app.route("/metrics")
+def metrics():
+  return Response(json.dumps(pool.metrics()), mimetype="application/json")
+
 def main():
-  if len(sys.argv) > 1 and sys.argv[1] == "debug":
-    app.run(debug=True)
-  else:
-   app.run(debug=False)
+  try:
+    if len(sys.argv) > 1 and sys.argv[1] == "debug":
+      app.run(debug=True, threaded=True)
+    else:
+     app.run(debug=False, threaded=True)
+  finally:
+    pool.close()
 
 if __name__ == "__main__":
   main()
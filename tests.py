@@ -9,6 +9,12 @@ __author__ = "Fil Zembowicz (fil@filosophy.org)"
 
 import unittest
 
+def _half(n):
+  """Batch worker used by the batch tests"""
+  if n % 2:
+    raise ValueError("odd")
+  return n / 2
+
 class testTextHelpers(unittest.TestCase):
   """A test class for text processing utility functions"""
 
@@ -53,6 +59,31 @@ class testTextHelpers(unittest.TestCase):
     self.assertEqual(is_incomplete_statement(""), True)
     self.assertEqual(is_incomplete_statement("printf('hey');"), False)
 
+  def test_lines(self):
+    from annotator import get_linebreak_indices
+    from utils.source import Lines
+    for text in ["", "a", "a\n", "\nint a;\n\n  b;"]:
+      lines = Lines(text, get_linebreak_indices(text))
+      expected = text.split("\n")
+      self.assertEqual(list(lines), expected)
+      self.assertEqual(len(lines), len(expected))
+      self.assertEqual([lines[i] for i in range(-len(expected), len(expected))], expected * 2)
+      self.assertEqual(lines[1:3], expected[1:3])
+      self.assertEqual(lines, expected)
+      self.assertRaises(IndexError, lambda: lines[len(expected)])
+
+  def test_map_text(self):
+    import os, tempfile
+    from utils.source import map_text
+    for text in ["", "int a;\n  b;\n", "int a;\r\n  b;\r\n", "a;\rb;"]:
+      fd, filename = tempfile.mkstemp(".c")
+      os.write(fd, text)
+      os.close(fd)
+      try:
+        self.assertEqual(map_text(filename)[:], open(filename, "rU").read())
+      finally:
+        os.remove(filename)
+
 class testCodeHelpers(unittest.TestCase):
   """A test class for code parsing utilities"""
   
@@ -63,12 +94,858 @@ class testCodeHelpers(unittest.TestCase):
     self.assertEqual(len(indices), 4)
     self.assertEqual(indices, [5, 6, 29, 52])
 
+  def test_lines_for_spans(self):
+    from annotator import Code
+    code = Code(text="Begin\n\nThis is the third line\nAnd this is the fourth\nEnd of file")
+    self.assertEqual(code.get_line_for_offset(0), 0)
+    self.assertEqual(code.get_line_for_offset(5), 0)
+    self.assertEqual(code.get_line_for_offset(6), 1)
+    self.assertEqual(code.get_line_for_offset(60), 4)
+    self.assertEqual(code.get_offset_for_line(2), 7)
+    self.assertEqual(code.get_lines_for_span((7, 30)), (2, 2))
+    self.assertEqual(code.get_lines_for_span((7, 31)), (2, 3))
+    spans = [(0, 3), (7, 40), (54, 57), (1, 2)]
+    self.assertEqual(code.get_lines_for_spans(spans),
+                     [code.get_lines_for_span(span) for span in spans])
+
+  def test_lazy_views(self):
+    from annotator import Code, annotate, get_required_views, IncrementalAnnotator, \
+                          iter_annotations
+    from features import FeatureLineLength, FeatureIndentation, FeatureCommentAtTop
+
+    # views are built as the features get to them, so stopping early skips them
+    code = Code(text="int x;\n")
+    results = iter_annotations(code, [FeatureCommentAtTop, FeatureIndentation])
+    next(results)
+    results.close()
+    self.assertFalse(code.has("levels"))
+
+    code = Code(filename="test/vigenere.c")
+    self.assertFalse(code.has("lines"))
+    annotate(code, [FeatureLineLength])
+    self.assertTrue(code.has("lines"))
+    self.assertFalse(code.has("table") or code.has("levels"))
+    self.assertEqual(get_required_views([FeatureLineLength, FeatureIndentation]),
+                     set(["lines", "levels", "indent"]))
+    self.assertRaises(AttributeError, lambda: code.missing)
+
+    # edits before the levels are read leave them to be computed afresh
+    annotator = IncrementalAnnotator(code, [FeatureLineLength])
+    annotator.edit(0, 0, "{\n")
+    self.assertFalse(code.has("levels"))
+    self.assertEqual(code.levels, Code(text=code.text).levels)
+
+  def test_bracket_line(self):
+    from annotator import Code, annotate
+    from features import FeatureInconsistentBrackets
+    code = Code(text="f()\n{\n}\ng()\n{\n}\nh() {\n}")
+    annotations = annotate(code, [FeatureInconsistentBrackets])
+    self.assertEqual(annotations, {6: ["inconsistent bracket placement"]})
+
+class testLexer(unittest.TestCase):
+  """Testing the single-pass line classification"""
+
+  def test_matches_line_helpers(self):
+    from utils.lexer import lex
+    from utils.line_features import strip, get_indent, is_comment, is_paren, is_whitespace_line
+    lines = ["int main(void)", "{", "    // comment", "\t\tx = 3; /* set x */", "   ", "  }  "]
+    table = lex(lines)
+    self.assertEqual(len(table), len(lines))
+    for line_no, line in enumerate(lines):
+      self.assertEqual(table.stripped[line_no], strip(line))
+      self.assertEqual(table.indent[line_no], get_indent(line))
+      self.assertEqual(table.comment[line_no], is_comment(line))
+      self.assertEqual(table.paren[line_no], is_paren(line))
+      self.assertEqual(table.whitespace[line_no], is_whitespace_line(line))
+
+  def test_multiline_comment(self):
+    from utils.lexer import lex
+    table = lex(["/*", " * inside", " */", "int a;", "", "if (a)"])
+    self.assertEqual(list(table.ignore), [False, True, True, False, True, False])
+    self.assertEqual(table.keyword, [None, None, None, None, None, "if"])
+
+  def test_indent_levels(self):
+    from utils.code_features import IndentLevels
+    levels = IndentLevels(5)
+    for line_no, level in enumerate([[0], None, [1, 2], [-1], [3]]):
+      levels[line_no] = level
+    self.assertEqual(list(levels), [[0], None, [1, 2], [-1], [3]])
+    self.assertEqual(levels[2], [1, 2])
+    self.assertEqual(levels[-1], [3])
+    self.assertEqual(levels[1:4], [None, [1, 2], [-1]])
+    levels.splice(1, 2, 3)
+    self.assertEqual(levels, [[0], None, None, None, [1, 2], [-1], [3]])
+    levels[4] = [2]
+    self.assertEqual(levels.other, {})
+
+class testBatch(unittest.TestCase):
+  """Testing the process pool batch engine"""
+
+  def test_ordered_results(self):
+    from utils.batch import run_batch
+    for processes in [1, 2]:
+      results = list(run_batch(_half, range(10), processes=processes, chunksize=3))
+      self.assertEqual([item for item, result, error in results], range(10))
+      self.assertEqual([result for item, result, error in results if not error], [0, 1, 2, 3, 4])
+
+  def test_failures_isolated(self):
+    from utils.batch import run_batch
+    results = list(run_batch(_half, range(6), processes=2, ordered=False))
+    self.assertEqual(len(results), 6)
+    errors = sorted(item for item, result, error in results if error)
+    self.assertEqual(errors, [1, 3, 5])
+
+  def test_annotate_files(self):
+    from annotator import annotate_files, Code, annotate
+    files = ["test/vigenere.c", "test/missing.c"]
+    results = list(annotate_files(files, processes=2))
+    self.assertEqual(results[0][1], annotate(Code(filename="test/vigenere.c")))
+    self.assertTrue("IOError" in results[1][2])
+
+  def test_archives(self):
+    import tarfile, zipfile, tempfile, shutil, os
+    from annotator import find_json_files, annotate_json
+    from utils.archives import iter_archives, ArchiveError
+    text = open("test/vigenere.c").read()
+    tmp = tempfile.mkdtemp()
+    try:
+      tar = tarfile.open(os.path.join(tmp, "a.tar.gz"), "w:gz")
+      tar.add("test/vigenere.c", "alice/vigenere.c")
+      tar.add("README.md", "alice/README.md")
+      tar.close()
+      archive = zipfile.ZipFile(os.path.join(tmp, "b.zip"), "w", zipfile.ZIP_DEFLATED)
+      archive.write("test/vigenere.c", "bob/vigenere.c")
+      archive.writestr("bob/", "")
+      archive.close()
+      paths = [os.path.join(tmp, "a.tar.gz"), "test/test.c", os.path.join(tmp, "b.zip")]
+      expected = [(os.path.join(tmp, "a.tar.gz", "alice/vigenere.c"), text),
+                  ("test/test.c", None),
+                  (os.path.join(tmp, "b.zip", "bob/vigenere.c"), text)]
+      for processes in [1, 2]:
+        self.assertEqual(list(find_json_files(paths, processes=processes)), expected)
+
+      bad = os.path.join(tmp, "c.tgz")
+      open(bad, "w").write("not an archive")
+      for processes in [1, 2]:
+        archives = iter_archives([bad, paths[0]], processes)
+        _, entries = next(archives)
+        self.assertRaises(ArchiveError, list, entries)
+        self.assertEqual(len(list(next(archives)[1])), 1)
+
+        # one error record for the unreadable archive, and the rest still run
+        files = list(find_json_files([bad, "test/test.c"], processes=processes))
+        self.assertEqual(files[0][0], bad)
+        self.assertEqual(str(files[0][1]).count(bad), 1)
+        records = list(annotate_json(files, processes=1))
+        self.assertEqual([record["file"] for record in records], [bad, "test/test.c"])
+        self.assertTrue("ArchiveError" in records[0]["error"])
+        self.assertTrue("diagnostics" in records[1])
+
+      # what is read out of archives can be limited
+      from utils.archives import iter_tar, iter_zip, ArchiveTooLarge
+      limited = [(iter_tar, open(paths[0], "rb")), (iter_zip, open(paths[2], "rb"))]
+      for iter_entries, f in limited:
+        for limits in [dict(max_member_bytes=len(text) - 1), dict(max_bytes=len(text) - 1),
+                       dict(max_members=1)]:
+          f.seek(0)
+          self.assertRaises(ArchiveTooLarge, list, iter_entries(f, **limits))
+        f.seek(0)
+        # the README is decompressed to get past it, so it counts too
+        self.assertEqual(len(list(iter_entries(f, max_bytes=len(text) +
+                                                 os.path.getsize("README.md")))), 1)
+        f.close()
+    finally:
+      shutil.rmtree(tmp)
+
+  def test_incremental_render(self):
+    import tempfile, shutil, os
+    from annotator import render_features, MANIFEST_NAME
+    from utils.manifest import Manifest
+    tmp = tempfile.mkdtemp()
+    try:
+      base, target = os.path.join(tmp, "psets"), os.path.join(tmp, "html")
+      os.makedirs(os.path.join(base, "alice"))
+      for name in ["alice/test.c", "vigenere.c"]:
+        shutil.copy(os.path.join("test", os.path.basename(name)), os.path.join(base, name))
+      render_features(base, target, processes=1, cache_dir=None)
+      self.assertEqual(sorted(Manifest(os.path.join(target, MANIFEST_NAME)).entries),
+                       ["alice/test.c", "vigenere.c"])
+
+      # unchanged files aren't rendered again, even if touched
+      open(os.path.join(target, "vigenere.html"), "w").write("old")
+      open(os.path.join(base, "alice/test.c"), "a").write("int x;\n")
+      os.utime(os.path.join(base, "vigenere.c"), (0, 0))
+      render_features(base, target, processes=1, cache_dir=None)
+      self.assertEqual(open(os.path.join(target, "vigenere.html")).read(), "old")
+      self.assertTrue("int x;" in open(os.path.join(target, "alice/test.html")).read())
+
+      # the pages of removed files are deleted
+      os.remove(os.path.join(base, "alice/test.c"))
+      render_features(base, target, processes=1, cache_dir=None)
+      self.assertFalse(os.path.exists(os.path.join(target, "alice/test.html")))
+      self.assertEqual(Manifest(os.path.join(target, MANIFEST_NAME)).entries.keys(),
+                       ["vigenere.c"])
+
+      # also when everything is rendered again, and the manifest remembers
+      # the pages it hasn't deleted yet
+      shutil.copy("test/test.c", os.path.join(base, "b.c"))
+      render_features(base, target, processes=1, cache_dir=None)
+      os.remove(os.path.join(base, "b.c"))
+      render_features(base, target, processes=1, cache_dir=None, incremental=False)
+      self.assertFalse(os.path.exists(os.path.join(target, "b.html")))
+      self.assertEqual(Manifest(os.path.join(target, MANIFEST_NAME)).entries.keys(),
+                       ["vigenere.c"])
+
+      # a file that can't be rendered any more loses its old page
+      open(os.path.join(base, "vigenere.c"), "a").write("// \xff\n")
+      render_features(base, target, processes=1, cache_dir=None)
+      self.assertFalse(os.path.exists(os.path.join(target, "vigenere.html")))
+    finally:
+      shutil.rmtree(tmp)
+
+class testDeadline(unittest.TestCase):
+  """Testing the cooperative feature time budgets"""
+
+  def test_budget(self):
+    from utils.deadline import Budget, TimedOutExc
+    budget = Budget(None)
+    for i in range(1000):
+      budget.check()
+    budget = Budget(0, "Slow", "slow.c")
+    try:
+      for i in range(1000):
+        budget.check()
+      self.fail("budget did not run out")
+    except TimedOutExc as e:
+      self.assertEqual((e.feature, e.filename), ("Slow", "slow.c"))
+
+  def test_timeout_skips_feature(self):
+    from annotator import Code, annotate
+    from features import Feature, FeatureCommentAtTop
+    from utils.deadline import deadline
+
+    @deadline(0)
+    class FeatureSlow(Feature):
+      def __repr__(self):
+        return "Slow"
+      def check(self, code):
+        yield self.diagnostic(0, "slow")
+        while True:
+          self.budget.check()
+
+    timeouts = []
+    code = Code(text="int a;")
+    annotations = annotate(code, [FeatureSlow, FeatureCommentAtTop], timeouts)
+    self.assertEqual(annotations, {0: ["slow", "Each file should have a comment at the top"]})
+    self.assertEqual([e.feature for e in timeouts], ["Slow"])
+
+class testCache(unittest.TestCase):
+  """Testing the annotation cache"""
+
+  def setUp(self):
+    import tempfile
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.directory)
+
+  def test_tiers(self):
+    from utils.cache import Cache
+    cache = Cache(self.directory, memory_items=1)
+    cache.put("aa11", {1: ["x"]})
+    cache.put("bb22", {2: ["y"]})
+    self.assertEqual(cache.memory.keys(), ["bb22"])
+    self.assertEqual(cache.get("aa11"), {1: ["x"]})
+    self.assertEqual(Cache(self.directory).get("bb22"), {2: ["y"]})
+    self.assertEqual(cache.get("cc33"), None)
+
+  def test_eviction(self):
+    import os
+    from utils.cache import Cache
+    cache = Cache(self.directory, max_bytes=2000)
+    for i in range(20):
+      cache.put("%04i" % i, "x" * 200)
+      os.utime(cache.path("%04i" % i), (i, i))
+    self.assertTrue(cache.disk_usage() <= 2000)
+    self.assertEqual(Cache(self.directory).get("0019"), "x" * 200)
+    self.assertEqual(Cache(self.directory).get("0000"), None)
+
+  def test_annotate_uses_cache(self):
+    import features
+    from annotator import Code, annotate
+    from utils.cache import Cache
+    cache = Cache(self.directory)
+    code = Code(filename="test/vigenere.c")
+    expected = annotate(code)
+    self.assertEqual(annotate(code, cache=cache), expected)
+    self.assertEqual(len(cache.memory), 1)
+    self.assertEqual(annotate(code, cache=cache), expected)
+    self.assertEqual(len(cache.memory), 1)
+
+    # changing a threshold changes the key
+    threshold = features.LINE_LENGTH_THRESHOLD
+    features.LINE_LENGTH_THRESHOLD = 10
+    try:
+      self.assertNotEqual(annotate(code, cache=cache), expected)
+    finally:
+      features.LINE_LENGTH_THRESHOLD = threshold
+    self.assertEqual(len(cache.memory), 2)
+
+class testRules(unittest.TestCase):
+  """Testing the combined regex rule sets"""
+
+  def test_dispatch(self):
+    from utils.rules import RuleSet
+    rules = RuleSet([("if", r"if\("), ("for", r"for\((int)?"), ("call", r"\w+\(")])
+    lines = ["if(a)", "for(int i", "x = 3;", "f(x);", " if(a)"]
+    results = [(line_no, name) for line_no, name, match in rules.scan(lines)]
+    self.assertEqual(results, [(0, "if"), (1, "for"), (3, "call")])
+    self.assertEqual(rules.match("for(int")[1].group(3), "int")
+
+class testStreaming(unittest.TestCase):
+  """Testing the streaming diagnostics API"""
+
+  def test_matches_annotate(self):
+    from annotator import Code, annotate, iter_annotations
+    from features import test_feature_list, production_feature_list
+    code = Code(filename="test/vigenere.c")
+    feature_list = production_feature_list + test_feature_list
+    annotations = {}
+    for diagnostic in iter_annotations(code, feature_list):
+      annotations.setdefault(diagnostic.line, []).append(diagnostic.message)
+    self.assertEqual(annotations, annotate(code, feature_list))
+
+  def test_diagnostic_fields(self):
+    from annotator import Code, iter_annotations
+    from features import FeatureSpaceAfterKeyword
+    code = Code(text="int main(void)\n{\n    if(a)\n}")
+    diagnostics = list(iter_annotations(code, [FeatureSpaceAfterKeyword]))
+    self.assertEqual(len(diagnostics), 1)
+    self.assertEqual((diagnostics[0].line, diagnostics[0].column), (2, 4))
+    self.assertEqual(diagnostics[0].feature, "Keyword missing a space after")
+    self.assertEqual(diagnostics[0].severity, "warning")
+
+  def test_stop_early(self):
+    import tempfile, shutil
+    from annotator import Code, iter_annotations
+    from utils.cache import Cache
+    directory = tempfile.mkdtemp()
+    try:
+      cache = Cache(directory)
+      code = Code(text="x;\n\n\n\n\n\nx;\n//x\n" + "x" * 200)
+      diagnostics = iter_annotations(code, cache=cache)
+      diagnostics.next()
+      diagnostics.close()
+      self.assertEqual(len(cache.memory), 0)
+      self.assertEqual(len(list(iter_annotations(code, cache=cache))), 4)
+      self.assertEqual(len(cache.memory), 1)
+    finally:
+      shutil.rmtree(directory)
+
+class testGate(unittest.TestCase):
+  """Testing early-exit gate mode"""
+
+  def test_verdict(self):
+    from annotator import Code, gate
+    code = Code(text="x;\n\n\n\n\n\nx;\n//x\n" + "x" * 200)
+    result = gate(code, 10)
+    self.assertTrue(result.passed)
+    self.assertEqual(len(result.diagnostics), 4)
+    result = gate(code, 1)
+    self.assertFalse(result.passed)
+    self.assertEqual(len(result.diagnostics), 2)
+
+  def test_order_by_cost(self):
+    import annotator
+    from features import FeatureIndentation, FeatureLineLength, FeatureCommentAtTop
+    costs = annotator.FEATURE_COSTS.copy()
+    try:
+      annotator.FEATURE_COSTS.clear()
+      annotator.record_cost(FeatureIndentation, 2.0, 1)
+      annotator.record_cost(FeatureLineLength, 1.0, 1)
+      ordered = annotator.order_by_cost([FeatureIndentation, FeatureLineLength, FeatureCommentAtTop])
+      self.assertEqual(ordered, [FeatureCommentAtTop, FeatureLineLength, FeatureIndentation])
+      annotator.record_cost(FeatureLineLength, 11.0, 1)
+      self.assertEqual(annotator.FEATURE_COSTS["FeatureLineLength"], 3.0)
+
+      # building the views a feature needs is part of its cost
+      import time
+      annotator.FEATURE_COSTS.clear()
+      code = annotator.Code(text="int x;\n")
+      code.prepare = lambda views: time.sleep(0.05)
+      list(annotator.run_feature(FeatureCommentAtTop, code))
+      self.assertTrue(annotator.FEATURE_COSTS["FeatureCommentAtTop"] >= 0.05 / len(code.lines))
+    finally:
+      annotator.FEATURE_COSTS.clear()
+      annotator.FEATURE_COSTS.update(costs)
+
+class testProfiling(unittest.TestCase):
+  """Testing per-feature profiling"""
+
+  def test_profile(self):
+    from annotator import Code, annotate
+    from features import FeatureIndentation, FeatureLineLength
+    from utils.profiling import Profile, profile
+    profile.clear()
+    annotate(Code(filename="test/vigenere.c"), [FeatureIndentation, FeatureLineLength])
+    annotate(Code(filename="test/test.c"), [FeatureIndentation, FeatureLineLength])
+    self.assertEqual(profile.files, 2)
+    self.assertEqual(sorted(profile.features), ["FeatureIndentation", "FeatureLineLength"])
+    stats = profile.features["FeatureIndentation"]
+    self.assertEqual((stats.runs, stats.lines, stats.timeouts), (2, 95, 0))
+    self.assertEqual(sorted(entry[1:3] for entry in profile.slowest),
+                     [("test/test.c", 22), ("test/vigenere.c", 73)])
+
+    merged = Profile()
+    merged.merge(profile)
+    merged.merge(profile)
+    self.assertEqual(merged.features["FeatureLineLength"].lines, 190)
+    slowest = merged.as_dict()["slowest"]
+    self.assertEqual(len(slowest), 4)
+    # the peak of the process so far, which never goes down
+    self.assertTrue(all(entry["process_peak_rss"] <= merged.peak_rss for entry in slowest))
+    self.assertTrue("FeatureIndentation" in merged.report())
+
+class testBenchmark(unittest.TestCase):
+  """Testing the synthetic corpus and the benchmark comparison"""
+
+  def test_generate(self):
+    from annotator import Code, annotate
+    from benchmark import generate, PATHOLOGIES
+    for pathology in PATHOLOGIES:
+      text = generate(300, pathology)
+      self.assertEqual(text, generate(300, pathology))
+      code = Code(text=text)
+      self.assertTrue(300 <= len(code.lines) < 400)
+      annotate(code)
+    self.assertTrue(generate(3000, "brackets").count(") {") > 900)
+
+  def test_compare(self):
+    from benchmark import compare
+    baseline = {"plain": {"stages": {"code": {"median": 0.010},
+                                     "render": {"median": 0.010}}}}
+    results = {"plain": {"stages": {"code": {"median": 0.0124},
+                                    "render": {"median": 0.020},
+                                    "new": {"median": 1.0}}},
+               "new": {"stages": {"code": {"median": 1.0}}}}
+    self.assertEqual(compare(results, baseline), [("plain", "render", 0.010, 0.020)])
+
+class testVectorized(unittest.TestCase):
+  """Testing that the numpy backend gives the same results"""
+
+  def test_same_diagnostics(self):
+    import glob
+    from annotator import Code, iter_annotations
+    from benchmark import generate, PATHOLOGIES
+    from features import production_feature_list, test_feature_list, FeatureNotEnoughWhitespace, \
+                         FeatureLineLength
+    texts = [open(filename).read() for filename in glob.glob("test/*.c")]
+    texts += [generate(500, pathology) for pathology in PATHOLOGIES]
+    texts += ["", "\n\n\n\n\nx", "x" * 130 + " \t\n" + "y" * 121 + "  "]
+    for text in texts:
+      code = Code(text=text)
+      for feature in production_feature_list + test_feature_list + [FeatureNotEnoughWhitespace]:
+        self.assertEqual(list(iter_annotations(code, [feature], backend="numpy")),
+                         list(iter_annotations(code, [feature])))
+    for text in [u"\xe9" * 119 + u"  ", u"\xe9" * 121 + u"\n" + u"x" * 121 + u"\u3000"]:
+      code = Code(text=text)
+      self.assertEqual(list(iter_annotations(code, [FeatureLineLength], backend="numpy")),
+                       list(iter_annotations(code, [FeatureLineLength])))
+
+  def test_unknown_backend(self):
+    from annotator import Code, annotate
+    self.assertRaises(ValueError, annotate, Code(text="int x;"), backend="fortran")
+
+class testEval(unittest.TestCase):
+  """Testing the grade correlation analytics"""
+
+  def test_table(self):
+    import os, tempfile
+    import numpy
+    from eval import ErrorTable, load_table
+    rows = [("pset1", "a", "a/x.c", 3.0, [0, 4, 1]),
+            ("pset1", "b", "b/x.c", 2.0, [0, 6, 1]),
+            ("pset2", "a", "a/y.c", float("nan"), [0, 9, 9]),
+            ("pset2", "b", "b/y.c", 1.0, [0, 9, 2])]
+    table = ErrorTable(["A", "B", "C"], rows)
+    r = table.correlations()
+    self.assertTrue(numpy.isnan(r[0]))
+    graded = [0, 1, 3]
+    expected = numpy.corrcoef([4, 6, 9], table.grade[graded])[0, 1]
+    self.assertAlmostEqual(r[1], expected)
+    self.assertEqual(table.percentiles([50]).tolist(), [[0, 7.5, 1.5]])
+    self.assertEqual(table.grade_means(), {1.0: 11, 2.0: 7, 3.0: 5})
+    self.assertTrue("mean errors per grade" in table.report())
+
+    fd, filename = tempfile.mkstemp(".npz")
+    os.close(fd)
+    try:
+      table.save(filename)
+      loaded = load_table(filename)
+      self.assertEqual(loaded.features, ["A", "B", "C"])
+      self.assertEqual(loaded.counts.tolist(), table.counts.tolist())
+      self.assertEqual(loaded.student.tolist(), ["a", "b", "a", "b"])
+    finally:
+      os.remove(filename)
+
+  def test_grades(self):
+    import os, shutil, tempfile
+    from utils.grades import open_grades
+    tmp = tempfile.mkdtemp()
+    try:
+      csv_file, snapshot = os.path.join(tmp, "grades.csv"), os.path.join(tmp, "grades.marshal")
+      open(csv_file, "w").write("pset1,3,x,alice\npset1,NULL,x,bob\npset2,4,x,alice\n")
+      os.utime(csv_file, (1000, 1000))
+      store = open_grades(csv_file, snapshot)
+      self.assertEqual(store["pset2", "alice"], "4")
+      self.assertEqual(store.for_pset("pset1"), {"alice": "3", "bob": "NULL"})
+      self.assertRaises(KeyError, lambda: store["pset2", "bob"])
+      self.assertEqual(list(store.join([("pset1", "bob", 1), ("pset3", "bob", 2)])),
+                       [(("pset1", "bob", 1), "NULL"), (("pset3", "bob", 2), None)])
+      self.assertTrue(os.path.exists(snapshot))
+
+      # the snapshot is used while the CSV's size and mtime are the same
+      open(csv_file, "r+").write("pset1,2")
+      os.utime(csv_file, (1000, 1000))
+      self.assertEqual(open_grades(csv_file, snapshot)["pset1", "alice"], "3")
+      os.utime(csv_file, (0, 0))
+      self.assertEqual(open_grades(csv_file, snapshot)["pset1", "alice"], "2")
+      self.assertEqual(len(open_grades(csv_file, snapshot)), 3)
+    finally:
+      shutil.rmtree(tmp)
+
+  def test_eval_pset(self):
+    import os, shutil, tempfile
+    from eval import eval_pset
+    from features import FeatureLineLength, FeatureIndentation
+    base = tempfile.mkdtemp()
+    try:
+      for student, name in [("alice", "vigenere.c"), ("bob", "test.c")]:
+        os.makedirs(os.path.join(base, student))
+        shutil.copy(os.path.join("test", name), os.path.join(base, student, "x.c"))
+      spec = {"base_dir": base, "files": ["x.c", "missing.c"]}
+      table = eval_pset(spec, {"alice": "3", "bob": "NULL"}, processes=1,
+                        feature_list=[FeatureLineLength, FeatureIndentation], cache_dir=None)
+      self.assertEqual(table.student.tolist(), ["alice", "bob"])
+      self.assertEqual(table.features, ["Line length", "Indentation"])
+      self.assertEqual(table.graded().tolist(), [True, False])
+      self.assertEqual(table.counts[0, 1], 1) # vigenere.c has one misindented line
+    finally:
+      shutil.rmtree(base)
+
+class testTemplates(unittest.TestCase):
+  """Testing the shared template registry"""
+
+  def test_stream_matches_render(self):
+    from annotator import Code, annotate
+    from utils.templates import get_template, render, stream_annotated
+    code = Code(filename="test/vigenere.c")
+    annotations = annotate(code)
+    html = render("annotated.txt", lines=code.lines, annotations=annotations)
+    chunks = list(stream_annotated(code.lines, annotations, lines_per_chunk=10))
+    self.assertEqual(len(chunks), 10)
+    self.assertEqual("".join(chunks), html)
+    self.assertTrue(get_template("annotated.txt") is get_template("annotated.txt"))
+
+class testIncremental(unittest.TestCase):
+  """Testing incremental re-annotation of edited code"""
+
+  def assertMatchesFresh(self, code, annotator):
+    from annotator import Code, annotate
+    fresh = Code(text=code.text)
+    for attr in ["lines", "linebreak_indices", "levels", "ignore_lines", "stripped"]:
+      self.assertEqual(getattr(code, attr), getattr(fresh, attr))
+    self.assertEqual(annotator.annotate(), annotate(fresh, annotator.feature_list))
+
+  def test_edits(self):
+    from annotator import Code, IncrementalAnnotator
+    from features import production_feature_list, test_feature_list
+    code = Code(filename="test/vigenere.c")
+    annotator = IncrementalAnnotator(code, production_feature_list + test_feature_list)
+    edits = [("    if(argc", "    if (argc"),      # within a line
+             ("    {\n        printf", "    {\n/*\n        printf"), # opens a comment
+             ("    // exit program if a", "*/\n    // exit program if a"),
+             ("    string message", "    x;\n\n\n\n\n    string message"),
+             ("int\nmain", "int main")]
+    for old, new in edits:
+      start = code.text.find(old)
+      annotator.edit(start, start + len(old), new)
+      self.assertMatchesFresh(code, annotator)
+
+  def test_only_affected_features_rerun(self):
+    from annotator import Code, IncrementalAnnotator
+    from features import FeatureIndentation, FeatureLineLength
+    code = Code(filename="test/vigenere.c")
+    annotator = IncrementalAnnotator(code, [FeatureIndentation, FeatureLineLength])
+    start = code.text.find("Error. Input one")
+    self.assertEqual(annotator.edit(start, start, "x" * 200), [FeatureLineLength])
+    self.assertEqual(annotator.edit(start, start, "\n"), [FeatureIndentation, FeatureLineLength])
+    self.assertMatchesFresh(code, annotator)
+
+  def test_updates(self):
+    from annotator import Code, IncrementalAnnotator
+    from features import FeatureIndentation, FeatureInconsistentBrackets
+    code = Code(text="f()\n{\n  x;\n}\ng() {\n}\nh()\n{\n  y;\n}\n")
+    annotator = IncrementalAnnotator(code, [FeatureIndentation, FeatureInconsistentBrackets])
+    instances = dict(annotator.instances)
+    edits = [("g() {", "g()\n{"),                # brackets now all alike
+             ("  y", "      y"),                  # a misindented line
+             ("f()", "k(a) {\n}\nm(b) {\n}\nf()"), # most brackets go the other way
+             ("  x", "\tx")]
+    for old, new in edits:
+      start = code.text.find(old)
+      annotator.edit(start, start + len(old), new)
+      self.assertMatchesFresh(code, annotator)
+    self.assertEqual(annotator.instances, instances) # updated, not run afresh
+
+class testServer(unittest.TestCase):
+  """Testing the annotation service"""
+
+  def setUp(self):
+    import server
+    self.pool = server.pool
+    server.pool = server.AnnotationPool(processes=1, max_pending=1)
+    self.client = server.app.test_client()
+
+  def tearDown(self):
+    import server
+    server.pool.close()
+    server.pool = self.pool
+
+  def test_annotate(self):
+    from annotator import Code, annotate
+    from utils.templates import render
+    text = open("test/vigenere.c").read()
+    response = self.client.post("/annotate", data={"code": text})
+    self.assertEqual(response.status_code, 200)
+    code = Code(text=text)
+    html = render("annotated.txt", lines=code.lines, annotations=annotate(code))
+    self.assertEqual(response.data, html)
+
+  def test_metrics(self):
+    import json
+    self.client.post("/annotate", data={"code": open("test/vigenere.c").read()})
+    metrics = json.loads(self.client.get("/metrics").data)
+    self.assertEqual(metrics["files"], 1)
+    self.assertEqual(metrics["pending"], 0)
+    self.assertEqual(metrics["features"]["FeatureIndentation"]["runs"], 1)
+    self.assertEqual(metrics["features"]["FeatureIndentation"]["lines"], 73)
+
+  def test_limits(self):
+    import server
+    server.pool.pending.acquire() # the one slot is taken
+    response = self.client.post("/annotate", data={"code": "int x;"})
+    self.assertEqual(response.status_code, 429)
+    server.pool.pending.release()
+    self.assertEqual(server.pool.metrics()["rejected"], 1)
+    response = self.client.post("/annotate",
+                                data={"code": "x" * (server.MAX_CONTENT_LENGTH + 1)})
+    self.assertEqual(response.status_code, 413)
+
+  def test_batch(self):
+    import json, tarfile, zipfile, server
+    from StringIO import StringIO
+    from annotator import Code, get_record
+    text = open("test/vigenere.c").read()
+    expected = json.loads(json.dumps(get_record("vigenere.c", Code(text=text))))
+
+    ndjson = json.dumps({"file": "vigenere.c", "code": text})
+    multipart = {"a": (StringIO(text), "vigenere.c"), "b": (StringIO(text), "vigenere.c")}
+    archive = StringIO()
+    tar = tarfile.open(fileobj=archive, mode="w")
+    tar.add("test/vigenere.c", "vigenere.c")
+    tar.close()
+    zipped = StringIO()
+    zip_archive = zipfile.ZipFile(zipped, "w")
+    zip_archive.write("test/vigenere.c", "vigenere.c")
+    zip_archive.close()
+    requests = [(2, dict(data=ndjson + "\n\n" + ndjson, content_type="application/x-ndjson")),
+                (1, dict(data=zipped.getvalue(), content_type="application/zip")),
+                (2, dict(data=multipart, content_type="multipart/form-data")),
+                (1, dict(data=archive.getvalue(), content_type="application/x-tar"))]
+    for num_files, request in requests:
+      response = self.client.post("/annotate/batch", **request)
+      self.assertEqual(response.status_code, 200)
+      records = [json.loads(line) for line in response.data.splitlines()]
+      self.assertEqual(records, [expected] * num_files)
+
+    for data in ["{", '{"file": "a.c", "code": 5}', "[]"]:
+      response = self.client.post("/annotate/batch", data=data,
+                                  content_type="application/x-ndjson")
+      self.assertEqual(response.status_code, 400)
+    response = self.client.post("/annotate/batch", data="\x1f\x8b" + "junk" * 10,
+                                content_type="application/gzip")
+    self.assertEqual(response.status_code, 400)
+
+    # archives that unpack into more than the server allows
+    bomb = StringIO()
+    tar = tarfile.open(fileobj=bomb, mode="w:gz")
+    info = tarfile.TarInfo("bomb.c")
+    info.size = server.MAX_ARCHIVE_BYTES + 1
+    tar.addfile(info, StringIO("\0" * info.size))
+    tar.close()
+    self.assertTrue(len(bomb.getvalue()) < server.MAX_CONTENT_LENGTH)
+    response = self.client.post("/annotate/batch", data=bomb.getvalue(),
+                                content_type="application/gzip")
+    self.assertEqual(response.status_code, 413)
+    many = StringIO()
+    zip_archive = zipfile.ZipFile(many, "w")
+    for i in range(server.MAX_ARCHIVE_MEMBERS + 1):
+      zip_archive.writestr("%i.c" % i, "")
+    zip_archive.close()
+    response = self.client.post("/annotate/batch", data=many.getvalue(),
+                                content_type="application/zip")
+    self.assertEqual(response.status_code, 413)
+
 class testIndent(unittest.TestCase):
   """Testing indentation calculation"""
 
   def setUp(self):
     pass
 
+  def test_common_indentation(self):
+    from collections import Counter
+    from features import FeatureIndentation
+    feature = FeatureIndentation()
+    # ties go to the smaller indent, and each level has to be deeper
+    histograms = {0: Counter({0: 5, 2: 5}), 1: Counter({0: 9, 4: 3, 2: 3}),
+                  2: Counter({1: 4}), 4: Counter({8: 1})}
+    self.assertEqual(feature.get_common_indentation(histograms), {0: 0, 1: 2, 2: 1, 4: 8})
+
+  def test_indent_unit(self):
+    from annotator import Code
+    from features import FeatureIndentation
+    feature = FeatureIndentation()
+    self.assertEqual(feature.get_indent_unit(Code(filename="test/vigenere.c")), "4 spaces")
+    tabs = "int\nmain(void)\n{\n\tif (x)\n\t{\n\t\tx--;\n\t}\n}\n"
+    self.assertEqual(feature.get_indent_unit(Code(text=tabs)), "tabs")
+    self.assertEqual(feature.get_indent_unit(Code(text="int x;\n")), None)
+
+    # cached with the diagnostics, so a cache hit doesn't build the levels
+    import tempfile, shutil
+    from annotator import get_record
+    from utils.cache import Cache
+    tmp = tempfile.mkdtemp()
+    try:
+      text = open("test/vigenere.c").read()
+      record = get_record("vigenere.c", Code(text=text), cache=Cache(tmp))
+      self.assertEqual(record["indent_unit"], "4 spaces")
+      code = Code(text=text)
+      self.assertEqual(get_record("vigenere.c", code, cache=Cache(tmp)), record)
+      self.assertFalse(code.has("levels"))
+    finally:
+      shutil.rmtree(tmp)
+
+class testParsing(unittest.TestCase):
+  """Testing the parse tree features, with and without a parse tree"""
+
+  CODE = "\n".join(["#include <stdio.h>",
+                    "int main(void)",
+                    "{",
+                    "    int x = 1, y = 2; x++;",
+                    "    printf(\"%d, %d\", x, y);",
+                    "    printf(\"%d\",x);",
+                    "    for (int i = 0; i < 3; i++) x++;",
+                    "    if (x) return 1;",
+                    "}", ""])
+
+  def test_line_helpers(self):
+    from utils.line_features import get_num_statements, get_comma_spacing
+    self.assertEqual(get_num_statements("for (i = 0; i < n; i++) a++; b++;"), 2)
+    self.assertEqual(get_num_statements("printf(\";;\");"), 1)
+    self.assertEqual(get_comma_spacing("f(a,b, \"x,y\", c); // g(a,b)"),
+                     [(3, False), (5, True), (12, True)])
+    self.assertEqual(get_comma_spacing("int a,b;"), [])
+
+  def test_features(self):
+    from annotator import Code, annotate, preprocess
+    from features import FeatureInconsistentParamSpacing, FeatureMultipleStatementsPerLine
+    from utils import parsing
+    feature_list = [FeatureInconsistentParamSpacing, FeatureMultipleStatementsPerLine]
+    expected = {3: ["put each statement on a line of its own"],
+                5: ["inconsistent spacing after comma"]}
+    code = Code(text=self.CODE)
+    if parsing.available():
+      self.assertTrue(code.ast is not None)
+      self.assertTrue(parsing.get_ast(self.CODE, preprocess) is code.ast) # cached
+    self.assertEqual(annotate(code, feature_list), expected)
+    broken = Code(text=self.CODE + "}\n")
+    self.assertEqual(broken.ast, None)
+    self.assertEqual(annotate(broken, feature_list), expected)
+    unicode_code = Code(text=self.CODE.decode("utf8").replace(u"%d\",x", u"caf\xe9 %d\",x"))
+    self.assertEqual(annotate(unicode_code, feature_list), expected)
+    # includes that could make cpp read a file, or fail, aren't parsed
+    for include in ("#import <cs50.h>", "#include_next \"/dev/zero\"",
+                    "#include \\\n  <stdio.h>", "%:include <stdio.h>"):
+      code = Code(text=include + "\n" + self.CODE)
+      self.assertEqual(annotate(code, feature_list),
+                       dict((line + include.count("\n") + 1, messages)
+                            for line, messages in expected.iteritems()))
+    for include in ("#/**/include \"/etc/passwd\"", "#inc\\\nlude \"/etc/passwd\""):
+      self.assertRaises(ValueError, parsing.prepare_source, include + "\n" + self.CODE)
+      self.assertEqual(Code(text=include + "\n" + self.CODE).ast, None)
+    self.assertEqual(parsing.prepare_source("// #include <math.h>\nchar *s = \"#include\";\n"),
+                     parsing.PRELUDE + "// #include <math.h>\nchar *s = \"#include\";\n")
+    self.assertEqual(Code(text="/* nothing but a comment */\n").ast, None)
+
+  def test_preprocessor(self):
+    import tempfile, shutil, time
+    from annotator import annotate_json
+    from features import FeatureMultipleStatementsPerLine, test_feature_list
+    from utils.preprocessor import Preprocessor, PreprocessError
+    from utils.cache import Cache
+    tmp = tempfile.mkdtemp()
+    try:
+      preprocessor = Preprocessor(cache=Cache(tmp))
+      output = preprocessor.preprocess("#define X 1\nint x = X;\n")
+      self.assertTrue("int x = 1;" in output)
+      self.assertEqual(preprocessor.preprocess("#define X 1\nint x = X;\n"), output)
+      self.assertEqual(preprocessor.runs, 1)
+      # shared on disk with other processes, but not with other include paths
+      self.assertEqual(Preprocessor(cache=Cache(tmp)).preprocess("#define X 1\nint x = X;\n"), output)
+      other = Preprocessor(cpp_args=["-I" + tmp], cache=Cache(tmp))
+      self.assertNotEqual(other.key("int x;\n"), preprocessor.key("int x;\n"))
+      # failed runs raise, and aren't cached
+      broken = "int x;\n#include <missing.h>\n"
+      self.assertRaises(PreprocessError, preprocessor.preprocess, broken)
+      self.assertEqual(preprocessor.lookup(preprocessor.key(broken)), None)
+      slow = Preprocessor(cpp_path="sh", cpp_args=["-c", "sleep 5", "sh"], timeout=0.1)
+      start = time.time()
+      self.assertRaises(PreprocessError, slow.preprocess, "int x;\n")
+      self.assertTrue(time.time() - start < 2)
+
+      sources = {"a": "int a;\n", "b": None, "c": "int c;\n"}
+      results = list(preprocessor.prefetch(["a", "b", "c"], sources.get))
+      self.assertEqual([item for item, _, _ in results], ["a", "b", "c"])
+      self.assertEqual(results[1], ("b", None, None))
+      self.assertTrue("int c;" in results[2][2])
+
+      records = list(annotate_json([("code.c", self.CODE), ("missing.c", None)],
+                                   [FeatureMultipleStatementsPerLine], processes=1,
+                                   cache_dir=tmp))
+      self.assertEqual(records[0]["diagnostics"][0]["line"], 3)
+      self.assertTrue("error" in records[1])
+
+      # annotate_files preprocesses ahead too, and the workers use that
+      import os, annotator
+      c_file = os.path.join(tmp, "code.c")
+      open(c_file, "w").write(self.CODE + "// %r\n" % time.time())
+      shared = annotator.preprocessor
+      runs = shared.runs
+      handed = []
+      shared.put = lambda source, output: handed.append(output) or \
+                                          Preprocessor.put(shared, source, output)
+      try:
+        results = list(annotator.annotate_files([c_file], test_feature_list, processes=1))
+      finally:
+        del shared.put
+      self.assertEqual(results[0][1][3], ["put each statement on a line of its own"])
+      self.assertEqual(len(handed), 1)
+      self.assertEqual(shared.runs, runs + 1)
+    finally:
+      shutil.rmtree(tmp)
+
 class testMustPass(unittest.TestCase):
   """Testing that "perfect" assignments pass all tests"""
 
@@ -79,6 +956,21 @@ def suite():
   suite = unittest.TestSuite()
   suite.addTest(unittest.makeSuite(testTextHelpers))
   suite.addTest(unittest.makeSuite(testCodeHelpers))
+  suite.addTest(unittest.makeSuite(testLexer))
+  suite.addTest(unittest.makeSuite(testBatch))
+  suite.addTest(unittest.makeSuite(testDeadline))
+  suite.addTest(unittest.makeSuite(testCache))
+  suite.addTest(unittest.makeSuite(testRules))
+  suite.addTest(unittest.makeSuite(testStreaming))
+  suite.addTest(unittest.makeSuite(testGate))
+  suite.addTest(unittest.makeSuite(testProfiling))
+  suite.addTest(unittest.makeSuite(testBenchmark))
+  suite.addTest(unittest.makeSuite(testVectorized))
+  suite.addTest(unittest.makeSuite(testEval))
+  suite.addTest(unittest.makeSuite(testTemplates))
+  suite.addTest(unittest.makeSuite(testIncremental))
+  suite.addTest(unittest.makeSuite(testServer))
+  suite.addTest(unittest.makeSuite(testParsing))
   suite.addTest(unittest.makeSuite(testIndent))
   suite.addTest(unittest.makeSuite(testMustPass))
   return suite
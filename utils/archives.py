@@ -0,0 +1,153 @@
+import os, tarfile, zipfile
+from batch import run_batch
+
+# what archives are recognized by, see is_archive
+ARCHIVE_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".zip")
+
+# how much is read out of an archive, so a small archive can't unpack into
+# more than memory holds; None for no limit
+MAX_MEMBER_BYTES = 16 * 1024 * 1024 # bytes of each file read
+MAX_BYTES = None # bytes of all the files read
+MAX_MEMBERS = None # entries of any kind in the archive
+
+class ArchiveError(Exception):
+  """Raised when an archive can't be read"""
+
+class ArchiveTooLarge(ArchiveError):
+  """Raised when an archive unpacks into more than its limits allow"""
+
+def is_archive(path):
+  """Whether a path names a tar or zip archive, going by its extension"""
+  return os.path.basename(path).lower().endswith(ARCHIVE_EXTENSIONS)
+
+def iter_tar(fileobj, extensions=(".c",), max_member_bytes=MAX_MEMBER_BYTES,
+             max_bytes=MAX_BYTES, max_members=MAX_MEMBERS):
+  """Yields (name, text) for each file in a tar archive read from fileobj
+
+  The archive is read as a stream (it may be compressed), so fileobj need
+  not support seeking. Only files ending in one of extensions are read.
+  Raises ArchiveTooLarge once a file is bigger than max_member_bytes, the
+  files read add up to more than max_bytes, or there are more than
+  max_members entries."""
+  limits = Limits(max_member_bytes, max_bytes, max_members)
+  archive = tarfile.open(fileobj=fileobj, mode="r|*")
+  try:
+    for member in archive:
+      limits.count_member()
+      if member.isfile() and member.name.endswith(tuple(extensions)):
+        yield member.name, limits.read(archive.extractfile(member), member.name)
+      else:
+        limits.skip(member.size) # decompressed all the same, to get past it
+  finally:
+    archive.close()
+
+def iter_zip(fileobj, extensions=(".c",), max_member_bytes=MAX_MEMBER_BYTES,
+             max_bytes=MAX_BYTES, max_members=MAX_MEMBERS):
+  """Yields (name, text) for each file in a zip archive read from fileobj
+
+  Unlike a tar archive, fileobj has to support seeking, since the index
+  of a zip archive is at its end. Only files ending in one of extensions
+  are read, one at a time. The limits are as for iter_tar."""
+  limits = Limits(max_member_bytes, max_bytes, max_members)
+  archive = zipfile.ZipFile(fileobj)
+  try:
+    for info in archive.infolist():
+      limits.count_member()
+      if not info.filename.endswith("/") and info.filename.endswith(tuple(extensions)):
+        yield info.filename, limits.read(archive.open(info), info.filename)
+  finally:
+    archive.close()
+
+class Limits:
+  """Counts what is read out of an archive against the limits of
+     iter_tar and iter_zip"""
+
+  def __init__(self, max_member_bytes, max_bytes, max_members):
+    self.max_member_bytes = max_member_bytes
+    self.max_bytes = max_bytes
+    self.max_members = max_members
+    self.bytes = 0
+    self.members = 0
+
+  def count_member(self):
+    self.members += 1
+    if self.max_members is not None and self.members > self.max_members:
+      raise ArchiveTooLarge("more than %i entries" % self.max_members)
+
+  def skip(self, size):
+    """Counts size bytes decompressed but not read"""
+    self.bytes += size
+    self.check_bytes()
+
+  def check_bytes(self):
+    if self.max_bytes is not None and self.bytes > self.max_bytes:
+      raise ArchiveTooLarge("more than %i bytes of files" % self.max_bytes)
+
+  def read(self, f, name):
+    """Reads a file out of the archive, no further than the limits"""
+    limit = self.max_member_bytes
+    if self.max_bytes is not None:
+      left = self.max_bytes - self.bytes
+      limit = left if limit is None else min(limit, left)
+    text = f.read() if limit is None else f.read(limit + 1)
+    f.close()
+    self.bytes += len(text)
+    if self.max_member_bytes is not None and len(text) > self.max_member_bytes:
+      raise ArchiveTooLarge("%s: more than %i bytes" % (name, self.max_member_bytes))
+    self.check_bytes()
+    return text
+
+def iter_archive(path, extensions=(".c",)):
+  """Yields (name, text) for each file in a tar or zip archive on disk,
+     without extracting it. Raises ArchiveError if it can't be read"""
+  f = open(path, "rb")
+  try:
+    if zipfile.is_zipfile(f):
+      f.seek(0)
+      entries = iter_zip(f, extensions)
+    else:
+      f.seek(0)
+      entries = iter_tar(f, extensions)
+    for entry in entries:
+      yield entry
+  except ArchiveTooLarge as e:
+    raise ArchiveTooLarge("%s: %s" % (path, e))
+  except (tarfile.TarError, zipfile.BadZipfile, zipfile.LargeZipFile, EOFError, IOError,
+          ValueError) as e:
+    raise ArchiveError("%s: %s" % (path, e))
+  finally:
+    f.close()
+
+def read_archive(path):
+  """Batch worker: the (name, text) pairs of the .c files in an archive,
+     or the ArchiveError if it can't be read"""
+  try:
+    return list(iter_archive(path))
+  except ArchiveError as e:
+    return e
+
+def _fail(error):
+  """Entries of an archive that couldn't be read"""
+  raise error
+  yield
+
+def iter_archives(paths, processes=1):
+  """Yields (path, entries) for each archive in paths, in order, where
+     entries are the (name, text) pairs of its .c files
+
+  With processes=1 each archive is streamed, and its entries have to be
+  read before moving on to the next archive. Otherwise the archives are
+  decompressed in parallel by a pool of processes, each reading whole
+  archives. Reading the entries of an archive that can't be read raises
+  ArchiveError, and the archives after it can still be read."""
+  if processes == 1:
+    for path in paths:
+      yield path, iter_archive(path)
+    return
+  results = run_batch(read_archive, paths, processes=processes, chunksize=1)
+  for path, entries, error in results:
+    if error:
+      entries = _fail(ArchiveError("%s: %s" % (path, error.strip().splitlines()[-1])))
+    elif isinstance(entries, ArchiveError):
+      entries = _fail(entries)
+    yield path, entries
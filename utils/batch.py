@@ -0,0 +1,48 @@
+import multiprocessing, traceback
+
+DEFAULT_CHUNKSIZE = 8 # work units handed to a worker at a time
+
+def call_safely(job):
+  """Runs a single (func, item) work unit, isolating failures to that unit
+
+  Returns (item, result, error), see run_batch."""
+  func, item = job
+  try:
+    return item, func(item), None
+  except Exception:
+    return item, None, traceback.format_exc()
+
+def run_batch(func, items, processes=None, chunksize=DEFAULT_CHUNKSIZE,
+              ordered=True, initializer=None, initargs=()):
+  """Maps func over items in a pool of worker processes.
+
+  Yields (item, result, error) tuples as results come in; error is the
+  formatted traceback if func raised, and None otherwise. Results are in
+  the order of items if ordered is True, else in order of completion.
+
+  func must be a module-level function so it can be sent to the workers.
+  processes defaults to the number of cores; with processes=1 everything
+  runs in the current process."""
+  jobs = ((func, item) for item in items)
+
+  if processes == 1:
+    if initializer:
+      initializer(*initargs)
+    for job in jobs:
+      yield call_safely(job)
+    return
+
+  pool = multiprocessing.Pool(processes, initializer, initargs)
+  try:
+    if ordered:
+      results = pool.imap(call_safely, jobs, chunksize)
+    else:
+      results = pool.imap_unordered(call_safely, jobs, chunksize)
+    for result in results:
+      yield result
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
@@ -0,0 +1,113 @@
+import os, hashlib, tempfile, cPickle
+from collections import OrderedDict
+
+MAX_BYTES = 256 * 1024 * 1024 # size of the on-disk store before evicting
+MEMORY_ITEMS = 1024 # entries kept in the in-memory tier
+
+def hash_text(text):
+  """Hex digest of a piece of (possibly unicode) text"""
+  if isinstance(text, unicode):
+    text = text.encode("utf-8")
+  return hashlib.sha1(text).hexdigest()
+
+class Cache:
+  """A key -> value cache with an in-memory LRU tier in front of an on-disk store.
+
+  Values are pickled to one file per key under directory. Reading an entry
+  touches its file, so evicting the least recently modified files keeps the
+  store under max_bytes in LRU order. Several processes can share a
+  directory: files are written to a temporary name and renamed into place."""
+
+  def __init__(self, directory, max_bytes=MAX_BYTES, memory_items=MEMORY_ITEMS):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.memory_items = memory_items
+    self.memory = OrderedDict()
+    self.size = None # bytes on disk, found on first write
+
+  def path(self, key):
+    return os.path.join(self.directory, key[:2], key)
+
+  def get(self, key, default=None):
+    """Returns the value for key, or default if it isn't cached"""
+    if key in self.memory:
+      value = self.memory.pop(key)
+      self.memory[key] = value
+      return value
+
+    path = self.path(key)
+    try:
+      f = open(path, "rb")
+      try:
+        value = cPickle.load(f)
+      finally:
+        f.close()
+      os.utime(path, None)
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+      return default
+
+    self.remember(key, value)
+    return value
+
+  def put(self, key, value):
+    """Stores value under key in both tiers"""
+    self.remember(key, value)
+
+    path = self.path(key)
+    dirname = os.path.dirname(path)
+    try:
+      if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    except OSError:
+      # another process got there first
+      if not os.path.isdir(dirname):
+        raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=dirname)
+    f = os.fdopen(fd, "wb")
+    try:
+      cPickle.dump(value, f, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      f.close()
+    os.rename(tmp_path, path)
+
+    if self.size is None:
+      self.size = self.disk_usage()
+    else:
+      self.size += os.path.getsize(path)
+    if self.size > self.max_bytes:
+      self.evict()
+
+  def remember(self, key, value):
+    """Puts a value in the in-memory tier, dropping the oldest if full"""
+    self.memory.pop(key, None)
+    self.memory[key] = value
+    while len(self.memory) > self.memory_items:
+      self.memory.popitem(last=False)
+
+  def entries(self):
+    """Yields (mtime, size, path) for each file in the on-disk store"""
+    for path, dirs, files in os.walk(self.directory):
+      for filename in files:
+        full_path = os.path.join(path, filename)
+        try:
+          stat = os.stat(full_path)
+        except OSError:
+          continue
+        yield stat.st_mtime, stat.st_size, full_path
+
+  def disk_usage(self):
+    return sum(size for mtime, size, path in self.entries())
+
+  def evict(self):
+    """Removes least recently used files until the store is under 3/4 of max_bytes"""
+    entries = sorted(self.entries())
+    self.size = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+      if self.size <= self.max_bytes * 3 / 4:
+        break
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+      self.size -= size
@@ -1,38 +1,140 @@
-import re
-from line_features import is_whitespace_line, is_comment, strip, is_paren, is_incomplete_statement
+from array import array
+from lexer import lex
 
-KEYWORDS = ["for", "if", "else", "while"];
+NO_LEVEL = -2 ** 31 # level stored for ignored lines, and lines in the side table
+STATE_SIZE = 4 # ints in the parser state after each line, see update_indent_levels
 
-def get_indent_levels(lines):
+class IndentLevels:
+  """The indent levels of the lines of a file, see get_indent_levels
+
+  Reads like a list: levels[line_no] is None for ignored lines, and
+  otherwise the list of levels the line may be at. Almost every line has
+  exactly one, which is kept in an int array; the few others are in a
+  small side table. The parser state after each line, which is needed
+  to resume from the middle of a file, is kept in an int array as well.
+  """
+
+  def __init__(self, num_lines=0):
+    self.level = array("i", [NO_LEVEL]) * num_lines
+    self.other = {} # line no. -> levels of lines without exactly one level
+    self.states = array("i", [0]) * (STATE_SIZE * num_lines)
+
+  def __len__(self):
+    return len(self.level)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      start, stop, step = index.indices(len(self))
+      if step != 1:
+        return [self[line_no] for line_no in xrange(start, stop, step)]
+      levels = [None if level == NO_LEVEL else [level] for level in self.level[start:stop]]
+      for line_no, _levels in self.other.iteritems():
+        if start <= line_no < stop:
+          levels[line_no - start] = _levels
+      return levels
+    if index < 0:
+      index += len(self)
+    level = self.level[index]
+    if level != NO_LEVEL:
+      return [level]
+    return self.other.get(index)
+
+  def __setitem__(self, line_no, levels):
+    if levels is not None and len(levels) == 1:
+      self.level[line_no] = levels[0]
+      self.other.pop(line_no, None)
+    else:
+      self.level[line_no] = NO_LEVEL
+      if levels is None:
+        self.other.pop(line_no, None)
+      else:
+        self.other[line_no] = levels
+
+  def __iter__(self):
+    # building the whole list at once is quicker than a generator
+    levels = [None if level == NO_LEVEL else [level] for level in self.level]
+    for line_no, _levels in self.other.iteritems():
+      levels[line_no] = _levels
+    return iter(levels)
+
+  def __eq__(self, other):
+    return list(self) == list(other)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def get_state(self, line_no):
+    """The parser state after a line"""
+    offset = STATE_SIZE * line_no
+    return tuple(self.states[offset:offset + STATE_SIZE])
+
+  def splice(self, start, end, num_lines):
+    """Replaces lines start to end (exclusive) with num_lines unset lines"""
+    shift = num_lines - (end - start)
+    self.level[start:end] = array("i", [NO_LEVEL]) * num_lines
+    self.states[STATE_SIZE * start:STATE_SIZE * end] = \
+      array("i", [0]) * (STATE_SIZE * num_lines)
+    if self.other:
+      other = {}
+      for line_no, levels in self.other.iteritems():
+        if line_no < start:
+          other[line_no] = levels
+        elif line_no >= end:
+          other[line_no + shift] = levels
+      self.other = other
+
+def get_indent_levels(lines, table=None):
   """Finds the allowed indentation levels
-  
-  The dictionary returned maps line number (0-indexed) 
+
+  The dictionary returned maps line number (0-indexed)
   to the appropriate level of indentation of that line.
   'Level of indentation' is not the actual amount of whitespace,
   but rather just how many units indented the line should be.
-  This allows for a more generic indentation validator in 
+  This allows for a more generic indentation validator in
   feature_indentation() that is agnostic to number of tabs, etc.
-  """
-  levels = {}
 
+  If the LineTable for the lines is already known, pass it in
+  as table to avoid lexing the lines again.
+  """
+  if table is None:
+    table = lex(lines)
+  levels = IndentLevels(len(table))
+  update_indent_levels(table, levels)
+  return dict(enumerate(levels))
+
+def update_indent_levels(table, levels, start=0, stop=None):
+  """(Re)computes the indent levels of the lines from start on, in place
+
+  levels is an IndentLevels, which also holds the parser state after each
+  line to resume from. If stop is given, stops at the first line from stop
+  on whose level and state come out unchanged, since the lines after it
+  can't have changed either. Returns the number of the line after the
+  last one updated.
+  """
   depth = 0
   statement_depth = 0     # for bracket-free shorthand
 
   # for switch statements
   case_adjust = 0         # indent applied to next row
   switch_parens = 0       # keep track of parens to see if switch is ended
-  is_switch = False       # 
+  is_switch = False       #
   was_break = False
 
-  ignore = get_ignore_lines(lines) # find whitespace, comments
+  if start > 0:
+    depth, statement_depth, switch_parens, is_switch = levels.get_state(start - 1)
+  states = levels.states
+  level_array = levels.level
+  other = levels.other
+
+  ignore = table.ignore # find whitespace, comments
 
-  for line_no, line in enumerate(lines):
+  for line_no in xrange(start, len(table)):
 
-    stripped = strip(line)
+    stripped = table.stripped[line_no]
 
     # indentation due to parens
-    num_close_parens = len(re.findall(r"}", stripped))
-    num_open_parens = len(re.findall(r"{", stripped))
+    num_close_parens = table.closes[line_no]
+    num_open_parens = table.opens[line_no]
     if num_open_parens == num_close_parens:
       num_close_parens = num_open_parens = 0
     depth -= num_close_parens
@@ -41,13 +143,13 @@ def get_indent_levels(lines):
     if is_switch:
       switch_parens += num_open_parens - num_close_parens
 
-    if re.match("case.*:$", stripped) or re.match("default.*:$", stripped):
+    if table.case[line_no]:
       if is_switch:
         depth -= 1
         case_adjust = 1
       else:
         is_switch = True
-        case_adjust = 1 
+        case_adjust = 1
 
     # end of switch statement
     if switch_parens < 0:
@@ -57,30 +159,30 @@ def get_indent_levels(lines):
 
     # compute the actual indent level
     if ignore[line_no]:
-      levels[line_no] = None
+      level = None
     else:
       new_depth = None
-      if "{" in line:
+      if table.brace[line_no]:
         new_depth = depth
         statement_depth = 0
       else:
         new_depth = depth + statement_depth
 
-      levels[line_no] = [new_depth]
+      level = [new_depth]
 
       # allow for some uncertainty in some cases
       # comments in switch -- allow to be one less
-      if is_switch and is_comment(line):
-        levels[line_no] += [new_depth - 1]
+      if is_switch and table.comment[line_no]:
+        level += [new_depth - 1]
       # parens by themselves -- allow to be indented one
       # TODO: remove this according to cs50 guidelines
-      if is_paren(line):
-        levels[line_no] += [new_depth + 1]
+      if table.paren[line_no]:
+        level += [new_depth + 1]
       # line starts with } and ends with {, asjust to be one lessj
       if stripped.startswith("}") and stripped.endswith("{"):
-        levels[line_no].remove(new_depth)
-        levels[line_no] += [new_depth - 1]
-        
+        level.remove(new_depth)
+        level += [new_depth - 1]
+
     # adjustments to next line below
 
     # open parens: next line should be indented
@@ -89,39 +191,32 @@ def get_indent_levels(lines):
     case_adjust = 0
 
     # look for bracked-free shorthand
-    if is_incomplete_statement(stripped) and not "{" in stripped:
-      for keyword in KEYWORDS:
-        if stripped.startswith(keyword):
-          statement_depth += 1
-          break
+    if table.incomplete[line_no] and not "{" in stripped:
+      if table.keyword[line_no] is not None:
+        statement_depth += 1
     else:
       statement_depth = 0
 
-  return levels
- 
-def get_ignore_lines(lines):
-  """Finds the lines of code to ignore indent in"""
-  ignore = {}
-  multiline = False
-  for line_no, line in enumerate(lines):
-    # whitespace line
-    if is_whitespace_line(line):
-      ignore[line_no] = True 
-    # new multiline comment
-    elif re.match(r"\s*/\*", line):
-      multiline = True
-      ignore[line_no] = False # this line should be inline
-    # continuing multiline comment
-    elif multiline:
-      ignore[line_no] = True
-      if re.search(r"\*/", line):
-        multiline = False
-    # single line comment -- want these to be aligned
-    elif re.match(r"\s*?//", line): 
-      ignore[line_no] = False
+    offset = STATE_SIZE * line_no
+    if stop is not None and line_no >= stop and levels[line_no] == level and \
+       states[offset] == depth and states[offset + 1] == statement_depth and \
+       states[offset + 2] == switch_parens and states[offset + 3] == is_switch:
+      return line_no
+    if level is not None and len(level) == 1:
+      level_array[line_no] = level[0]
+      if other:
+        other.pop(line_no, None)
     else:
-      ignore[line_no] = False
-
-  return ignore
+      levels[line_no] = level
+    states[offset] = depth
+    states[offset + 1] = statement_depth
+    states[offset + 2] = switch_parens
+    states[offset + 3] = is_switch
 
+  return len(table)
 
+def get_ignore_lines(lines, table=None):
+  """Finds the lines of code to ignore indent in"""
+  if table is None:
+    table = lex(lines)
+  return dict((line_no, bool(ignore)) for line_no, ignore in enumerate(table.ignore))
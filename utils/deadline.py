@@ -1,25 +1,72 @@
-import signal
+import time
 
 class TimedOutExc(Exception):
-  pass
-
-def deadline(timeout, *args):
-  """A decorator that creates a max execution time for a function"""
-  def decorate(f):
-    def handler(signum, frame):
-      raise TimedOutExc()
-
-    def new_f(*args):
-      
-      try:
-        signal.signal(signal.SIGALRM, handler)
-        signal.alarm(timeout)
-        return f(*args)
-      except ValueError:
-        return f(*args)
-
-    new_f.__name__ = f.__name__
-    return new_f
-  return decorate
+  """Raised when a feature runs past its time budget"""
+
+  def __init__(self, feature=None, filename=None, elapsed=None):
+    Exception.__init__(self, feature, filename, elapsed)
+    self.feature = feature
+    self.filename = filename
+    self.elapsed = elapsed
+
+  def __str__(self):
+    message = "%s timed out" % (self.feature or "execution")
+    if self.filename:
+      message += " on %s" % self.filename
+    if self.elapsed is not None:
+      message += " after %.2fs" % self.elapsed
+    return message
+
+class Budget:
+  """A cooperative time budget for a single run of a feature.
+
+  Unlike an alarm signal this works from any thread or process: the
+  code being limited calls check() from its loops, which raises
+  TimedOutExc once more than timeout seconds have passed. A timeout
+  of None never expires."""
+
+  CHECK_INTERVAL = 64 # calls to check() between looking at the clock
+
+  def __init__(self, timeout=None, feature=None, filename=None):
+    self.timeout = timeout
+    self.feature = feature
+    self.filename = filename
+    self.start = time.time()
+    self.cpu_start = time.clock()
+    self.calls = 0
 
+  def elapsed(self):
+    return time.time() - self.start
 
+  def cpu_elapsed(self):
+    """CPU seconds used by the process under the budget so far"""
+    return time.clock() - self.cpu_start
+
+  def pause(self):
+    """Stops the clock, e.g. while a generator under the budget is suspended"""
+    self.paused = time.time()
+    self.cpu_paused = time.clock()
+
+  def resume(self):
+    self.start += time.time() - self.paused
+    self.cpu_start += time.clock() - self.cpu_paused
+
+  def check(self):
+    """Raises TimedOutExc if the budget is used up"""
+    if self.timeout is None:
+      return
+    self.calls += 1
+    if self.calls % self.CHECK_INTERVAL:
+      return
+    elapsed = self.elapsed()
+    if elapsed > self.timeout:
+      raise TimedOutExc(self.feature, self.filename, elapsed)
+
+def deadline(timeout):
+  """A class decorator that gives a feature a max execution time in seconds
+
+  annotate() gives each run of the feature a Budget of this many seconds."""
+  def decorate(cls):
+    cls.timeout = timeout
+    return cls
+  return decorate
@@ -0,0 +1,93 @@
+import os, csv, marshal, hashlib, tempfile
+
+SNAPSHOT_DIR = os.path.expanduser("~/.style-annotator/grades") # parsed grades files
+SNAPSHOT_VERSION = 1 # bump when the format of the snapshots changes
+
+# columns of the grades CSV
+PSET_COLUMN = 0
+GRADE_COLUMN = 1
+STUDENT_COLUMN = 3
+
+class GradeStore:
+  """The grades of all students for all psets, indexed by (pset, student)
+
+  store[pset, student] is the grade as it appears in the CSV (which may
+  be "NULL"), and raises KeyError if there is none. Grades are kept as
+  {pset: {student: grade}}, so the grades of a pset can be had at once."""
+
+  def __init__(self, psets=None):
+    self.psets = psets or {}
+
+  def __getitem__(self, key):
+    pset, student = key
+    return self.psets[pset][student]
+
+  def get(self, pset, student, default=None):
+    return self.psets.get(pset, {}).get(student, default)
+
+  def __len__(self):
+    return sum(len(grades) for grades in self.psets.itervalues())
+
+  def for_pset(self, pset):
+    """{student: grade} for a single pset"""
+    return self.psets.get(pset, {})
+
+  def join(self, rows, default=None):
+    """Yields (row, grade) for each (pset, student, ...) row of rows, as
+       they come, with default for the rows without a grade"""
+    for row in rows:
+      yield row, self.get(row[0], row[1], default)
+
+def read_grades_csv(csv_file):
+  """Parses a grades CSV, one row at a time, into a GradeStore"""
+  psets = {}
+  f = open(csv_file, "rbU")
+  try:
+    for row in csv.reader(f):
+      psets.setdefault(row[PSET_COLUMN], {})[str(row[STUDENT_COLUMN])] = row[GRADE_COLUMN]
+  finally:
+    f.close()
+  return GradeStore(psets)
+
+def get_snapshot_path(csv_file):
+  """Where the snapshot of a grades CSV is kept"""
+  key = hashlib.sha1(os.path.abspath(csv_file)).hexdigest()
+  return os.path.join(SNAPSHOT_DIR, key + ".marshal")
+
+def open_grades(csv_file, snapshot=None):
+  """Loads the grades in a CSV into a GradeStore
+
+  The first time, the CSV is parsed and a marshal snapshot of the parsed
+  grades is saved to snapshot (by default under SNAPSHOT_DIR). Later
+  calls load the snapshot instead, as long as the CSV's size and mtime
+  are the same as when it was taken."""
+  if snapshot is None:
+    snapshot = get_snapshot_path(csv_file)
+  st = os.stat(csv_file)
+  stamp = (SNAPSHOT_VERSION, st.st_size, st.st_mtime)
+  try:
+    f = open(snapshot, "rb")
+    try:
+      saved_stamp, psets = marshal.load(f)
+    finally:
+      f.close()
+    if saved_stamp == stamp:
+      return GradeStore(psets)
+  except (IOError, EOFError, ValueError, TypeError):
+    pass
+
+  store = read_grades_csv(csv_file)
+  dirname = os.path.dirname(snapshot) or "."
+  try:
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname)
+    f = os.fdopen(fd, "wb")
+    try:
+      marshal.dump((stamp, store.psets), f)
+    finally:
+      f.close()
+    os.rename(tmp_path, snapshot)
+  except (IOError, OSError):
+    pass # the snapshot only saves time next time
+  return store
@@ -0,0 +1,172 @@
+import re
+from array import array
+
+KEYWORDS = ["for", "if", "else", "while"];
+
+INDENT_RE = re.compile(r"\s*")
+COMMENT_START_RE = re.compile(r"//|/\*")
+
+# per-line fields that depend on nothing but the line itself
+FIELDS = ("stripped", "indent", "whitespace", "comment", "opens", "closes", "brace",
+          "paren", "incomplete", "keyword", "case", "comment_start", "comment_end")
+
+# array typecodes of the numeric and boolean fields; the others are lists
+TYPECODES = {"indent": "i", "opens": "i", "closes": "i", "whitespace": "b",
+             "comment": "b", "brace": "b", "paren": "b", "incomplete": "b",
+             "case": "b", "comment_start": "b", "comment_end": "b"}
+
+def flags(num_lines):
+  """An array of num_lines false flags"""
+  return array("b", [0]) * num_lines
+
+class LineTable:
+  """Per-line classification of a file, produced by a single lexing pass.
+
+  Each attribute is indexed by line number (0-based). Numbers and flags
+  are kept in arrays (see TYPECODES), so flags read as 0 or 1:
+    stripped      -- line without whitespace or comments
+    indent        -- length of leading whitespace
+    whitespace    -- whether the line is empty
+    comment       -- whether the line starts with a comment
+    opens         -- number of { in the stripped line
+    closes        -- number of } in the stripped line
+    brace         -- whether the raw line contains a {
+    paren         -- whether the line is just a bracket
+    incomplete    -- whether the stripped line doesn't end in a semicolon
+    keyword       -- the keyword the stripped line starts with, or None
+    case          -- whether the line is a case / default label
+    comment_start -- whether the line starts with /*
+    comment_end   -- whether the line contains */
+    ignore        -- whether the line should be ignored for indentation
+                     (whitespace, or inside a multiline comment)
+    multiline     -- whether a multiline comment is open after the line
+  """
+
+  def __init__(self, rows=()):
+    columns = zip(*rows) or [()] * len(FIELDS)
+    for name, column in zip(FIELDS, columns):
+      if name in TYPECODES:
+        setattr(self, name, array(TYPECODES[name], column))
+      else:
+        setattr(self, name, list(column))
+    self.ignore = flags(len(self.indent))
+    self.multiline = flags(len(self.indent))
+
+  def __len__(self):
+    return len(self.indent)
+
+  def splice(self, start, end, table):
+    """Replaces lines start to end (exclusive) with the lines of another table
+
+    The ignore and multiline flags of the new lines are left unset;
+    recompute them with update_ignore."""
+    for name in FIELDS:
+      getattr(self, name)[start:end] = getattr(table, name)
+    self.ignore[start:end] = flags(len(table))
+    self.multiline[start:end] = flags(len(table))
+
+class StrippedLines:
+  """The stripped lines of a LineTable, with the ignored ones empty
+
+  Reads like a list of strings, but is computed from the table when read,
+  so it stays up to date as the table is edited."""
+
+  def __init__(self, table):
+    self.table = table
+
+  def __len__(self):
+    return len(self.table)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      start, stop, step = index.indices(len(self.table))
+      ignore = self.table.ignore
+      return ["" if ignore[line_no] else stripped for line_no, stripped in
+              zip(xrange(start, stop, step), self.table.stripped[start:stop:step])]
+    if self.table.ignore[index]:
+      return ""
+    return self.table.stripped[index]
+
+  def __iter__(self):
+    for ignore, stripped in zip(self.table.ignore, self.table.stripped):
+      yield "" if ignore else stripped
+
+  def __eq__(self, other):
+    return list(self) == list(other)
+
+  def __ne__(self, other):
+    return not self == other
+
+def classify(line):
+  """Finds the per-line fields (see FIELDS) of a single line"""
+  indent = INDENT_RE.match(line).end()
+  rest = line[indent:]
+
+  match = COMMENT_START_RE.search(line)
+  if match:
+    stripped = line[:match.start()].strip()
+  else:
+    stripped = line.strip()
+
+  keyword = None
+  for _keyword in KEYWORDS:
+    if stripped.startswith(_keyword):
+      keyword = _keyword
+      break
+
+  comment_start = rest.startswith("/*")
+  return (stripped,
+          indent,
+          not rest,
+          comment_start or rest.startswith("//"),
+          stripped.count("{"),
+          stripped.count("}"),
+          "{" in line,
+          rest[:1] in ("{", "}") and INDENT_RE.match(rest, 1).end() == len(rest),
+          not stripped.endswith(";"),
+          keyword,
+          (stripped.startswith("case") or stripped.startswith("default"))
+            and stripped.endswith(":"),
+          comment_start,
+          "*/" in line)
+
+def update_ignore(table, start=0, stop=None):
+  """(Re)computes the ignore and multiline flags of the lines from start on
+
+  If stop is given, stops at the first line from stop on whose flags come
+  out unchanged, since the lines after it can't have changed either.
+  Returns the number of the line after the last one updated."""
+  whitespace = table.whitespace
+  comment_start = table.comment_start
+  comment_end = table.comment_end
+  ignore = table.ignore
+  multiline_after = table.multiline
+
+  multiline = start > 0 and multiline_after[start - 1]
+  for line_no in xrange(start, len(table)):
+    # whitespace, comments
+    if whitespace[line_no]:
+      _ignore = True
+    elif comment_start[line_no]:
+      multiline = True
+      _ignore = False # this line should be inline
+    elif multiline:
+      _ignore = True
+      if comment_end[line_no]:
+        multiline = False
+    else:
+      _ignore = False
+
+    if stop is not None and line_no >= stop and \
+       ignore[line_no] == _ignore and multiline_after[line_no] == multiline:
+      return line_no
+    ignore[line_no] = _ignore
+    multiline_after[line_no] = multiline
+
+  return len(table)
+
+def lex(lines):
+  """Scans the lines of a file once and returns a LineTable"""
+  table = LineTable([classify(line) for line in lines])
+  update_ignore(table)
+  return table
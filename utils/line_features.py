@@ -1,37 +1,73 @@
-
 import re
+from lexer import INDENT_RE, COMMENT_START_RE
+
+STRIP_RE = re.compile(r"(.*?)(?://|/\*|$)")
+COMMENT_RE = re.compile(r"^\s*?(?://|/\*)")
+PAREN_RE = re.compile(r"^\s*[\{\}]\s*$")
+WHITESPACE_LINE_RE = re.compile(r"^\s*$")
+STATEMENT_END_RE = re.compile(r";\s*$")
+STRING_RE = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'')
 
 def strip(line):
   """Strips all leading / training whitespace / comments from a line"""
-  return re.match(r"(.*?)(?://|/\*|$)",line).groups()[0].strip()
+  return STRIP_RE.match(line).groups()[0].strip()
 
 def is_comment(line):
   """Whether a line is a comment"""
-  return re.match(r"^\s*?(?://|/\*)",line) is not None
+  return COMMENT_RE.match(line) is not None
 
 def is_paren(line):
   """Finds whether a line is a paren"""
-  return re.match("^\s*[\{\}]\s*$", line) is not None
+  return PAREN_RE.match(line) is not None
 
 def is_whitespace_line(line):
   """Finds whether a line is empty"""
-  return re.match("^\s*$", line) is not None
+  return WHITESPACE_LINE_RE.match(line) is not None
 
 def get_indent(line):
   """Finds the length of leading whitespace"""
-  return re.match(r"\s*", line).end()
-
-def is_whitespace_line(line):
-  """Finds whether a line is empty"""
-  return re.match("^\s*$", line) is not None
+  return INDENT_RE.match(line).end()
 
 def is_incomplete_statement(line):
   """Whether line ends in semicolon"""
-  return re.search(r";\s*$", line) is None
+  return STATEMENT_END_RE.search(line) is None
+
+def blank_strings(line):
+  """Replaces the insides of string and char literals with x's, so their
+     contents don't count as code. The length stays the same"""
+  return STRING_RE.sub(lambda match: match.group()[0] + "x" * (len(match.group()) - 2) +
+                                     match.group()[-1], line)
 
 def get_num_statements(line):
-  """Finds how many statements are in a line, counting semicolons"""
-  #TODO(fil)
+  """Finds how many statements are in a (stripped) line, counting
+     semicolons outside of parentheses, so a for loop counts as one"""
   num_statements = 0
+  depth = 0
+  for char in blank_strings(line):
+    if char == "(":
+      depth += 1
+    elif char == ")":
+      depth = max(depth - 1, 0)
+    elif char == ";" and depth == 0:
+      num_statements += 1
   return num_statements
 
+def get_comma_spacing(line):
+  """Finds the commas between parentheses in a line, e.g. between the
+     arguments of a call. Returns a list of (column, whether whitespace
+     follows the comma); commas at the end of the line are left out"""
+  line = blank_strings(line)
+  match = COMMENT_START_RE.search(line)
+  if match:
+    line = line[:match.start()]
+  line = line.rstrip()
+  commas = []
+  depth = 0
+  for column, char in enumerate(line):
+    if char == "(":
+      depth += 1
+    elif char == ")":
+      depth = max(depth - 1, 0)
+    elif char == "," and depth > 0 and column + 1 < len(line):
+      commas.append((column, line[column + 1] in " \t"))
+  return commas
@@ -0,0 +1,90 @@
+import os, json, hashlib, tempfile
+
+MANIFEST_VERSION = 1 # bump when the format of the manifest changes
+CHUNK_SIZE = 64 * 1024 # bytes read at a time when hashing a file
+
+def hash_file(path):
+  """Hex digest of the contents of a file, see cache.hash_text"""
+  digest = hashlib.sha1()
+  f = open(path, "rb")
+  try:
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), ""):
+      digest.update(chunk)
+  finally:
+    f.close()
+  return digest.hexdigest()
+
+class Manifest:
+  """What was produced from each file of a source tree on the last run,
+  so the next run can skip the files that haven't changed.
+
+  Maps the path of each source file (relative to the tree) to a dict of
+  its size, mtime, content hash, the fingerprint of the features it was
+  run with and the output it was written to. A file counts as unchanged
+  if its size and mtime are the same; if only its mtime changed, its
+  contents are hashed to make sure. The manifest is a JSON file, saved
+  by writing a temporary file and renaming it into place."""
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.entries = {}
+    try:
+      f = open(filename)
+      try:
+        saved = json.load(f)
+      finally:
+        f.close()
+    except (IOError, ValueError):
+      return
+    if saved.get("version") == MANIFEST_VERSION:
+      self.entries = saved["entries"]
+
+  def stat(self, path):
+    """The (size, mtime) of a file, as stored in the manifest"""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime
+
+  def is_fresh(self, relpath, path, fingerprint):
+    """Whether the file at path is unchanged since it was recorded under
+       relpath, and was run with the features identified by fingerprint"""
+    entry = self.entries.get(relpath)
+    if entry is None or entry["fingerprint"] != fingerprint:
+      return False
+    try:
+      size, mtime = self.stat(path)
+    except OSError:
+      return False
+    if size != entry["size"]:
+      return False
+    if mtime != entry["mtime"]:
+      if hash_file(path) != entry["hash"]:
+        return False
+      entry["mtime"] = mtime # touched, but the same
+    return True
+
+  def record(self, relpath, path, fingerprint, output, stat=None):
+    """Records that path was run with fingerprint and written to output
+       (None if there was nothing to write). Pass the stat taken before
+       reading the file, so a change while it was read is caught next time"""
+    size, mtime = stat or self.stat(path)
+    self.entries[relpath] = {"size": size, "mtime": mtime, "hash": hash_file(path),
+                             "fingerprint": fingerprint, "output": output}
+
+  def remove_missing(self, relpaths):
+    """Forgets the files that aren't in relpaths, returns their entries"""
+    removed = {}
+    for relpath in set(self.entries) - set(relpaths):
+      removed[relpath] = self.entries.pop(relpath)
+    return removed
+
+  def save(self):
+    dirname = os.path.dirname(self.filename) or "."
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname)
+    f = os.fdopen(fd, "w")
+    try:
+      json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f)
+    finally:
+      f.close()
+    os.rename(tmp_path, self.filename)
@@ -0,0 +1,160 @@
+import re
+from collections import OrderedDict
+from cache import hash_text
+
+try:
+  from pycparser import c_parser, c_ast
+except ImportError:
+  c_parser = c_ast = None
+
+CACHE_ITEMS = 64 # parse trees kept in memory, by the hash of the code
+
+# types from headers that are left out, since pycparser can't parse the
+# system headers; declared ahead of the code so it still parses
+PRELUDE = """typedef char* string;
+typedef int bool;
+typedef unsigned long size_t;
+typedef long ssize_t;
+typedef struct _FILE FILE;
+typedef signed char int8_t;
+typedef unsigned char uint8_t;
+typedef short int16_t;
+typedef unsigned short uint16_t;
+typedef int int32_t;
+typedef unsigned int uint32_t;
+typedef long long int64_t;
+typedef unsigned long long uint64_t;
+typedef uint8_t BYTE;
+typedef uint32_t DWORD;
+typedef int32_t LONG;
+typedef uint16_t WORD;
+#line 1
+"""
+
+# the directives that read another file: #include, #include_next and
+# #import, also spelled %:, and with the lines they continue onto
+INCLUDE_RE = re.compile(r"^[ \t]*(?:#|%:)[ \t]*(?:include|include_next|import)\b"
+                        r"(?:.*\\[ \t\r]*\n)*.*$", re.M)
+# how cpp sees the code: lines joined where they end in a backslash,
+# then the comments (whitespace) and literals (that can't hold directives)
+CONTINUATION_RE = re.compile(r"\\[ \t\r\f\v]*(?:\r\n|\r|\n)")
+TOKEN_RE = re.compile(r"/\*.*?(?:\*/|\Z)|//[^\n]*|\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*'", re.S)
+DIRECTIVE_RE = re.compile(r"^\s*(?:#|%:)\s*(?:include|include_next|import)\b", re.M)
+
+PRELUDE_ITEMS = PRELUDE.count(";") # declarations of PRELUDE at the top of a tree
+
+# labels, which aren't statements of their own
+LABEL_TYPES = ("Case", "Default", "Label")
+
+_cache = OrderedDict() # hash of the code -> parse tree, or None if it didn't parse
+
+def available():
+  """Whether pycparser is installed, so code can be parsed"""
+  return c_parser is not None
+
+def prepare_source(text):
+  """The code to hand to the preprocessor: without its #includes (the
+     lines are kept, empty, so the line numbers stay the same), after
+     PRELUDE, as utf-8. Raises ValueError if it reads another file some
+     other way, so cpp never gets to read what a submission names"""
+  source = INCLUDE_RE.sub(lambda match: "\n" * match.group().count("\n"), text[:])
+  if DIRECTIVE_RE.search(TOKEN_RE.sub(_blank_token, CONTINUATION_RE.sub("", source).replace("\r", "\n"))):
+    raise ValueError("code includes a file in a way that can't be left out")
+  source = PRELUDE + source
+  if isinstance(source, unicode):
+    source = source.encode("utf8")
+  return source
+
+def _blank_token(match):
+  """A comment as the space cpp takes it for, a literal as an empty one"""
+  token = match.group()
+  if token[0] == "/":
+    return " "
+  return token[0] * 2
+
+def get_ast(text, preprocess=None):
+  """Parses code into a pycparser tree, or returns None if it doesn't
+     parse, has nothing but PRELUDE in it, or pycparser isn't installed
+
+  The code is run through preprocess (a function from code to code, e.g.
+  annotator.preprocess) after prepare_source. Trees are cached by the
+  hash of the code, so the same code is only parsed once."""
+  if not available():
+    return None
+  key = hash_text(text[:])
+  if key in _cache:
+    ast = _cache.pop(key)
+  else:
+    try:
+      source = prepare_source(text)
+      if preprocess is not None:
+        source = preprocess(source)
+      ast = c_parser.CParser().parse(source, "<code>")
+    except Exception:
+      # a ParseError, an AssertionError on unbalanced braces, a
+      # ValueError for an include that can't be left out, a
+      # PreprocessError if cpp fails...: the features fall back to the lines
+      ast = None
+    if ast is not None and len(ast.ext) <= PRELUDE_ITEMS:
+      ast = None # the code was lost somewhere, so look at the lines instead
+  _cache[key] = ast
+  while len(_cache) > CACHE_ITEMS:
+    _cache.popitem(last=False)
+  return ast
+
+def iter_nodes(node, types):
+  """Yields the nodes under node (and node itself) that are of one of
+     types, a tuple of pycparser.c_ast class names"""
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    if type(node).__name__ in types:
+      yield node
+    stack.extend(child for _, child in reversed(node.children()))
+
+def start_of(node):
+  """Where a statement starts, as (line, column). Declarations of several
+     variables at once are split up by pycparser, but share their type"""
+  if type(node).__name__ == "Decl":
+    for child in iter_nodes(node, ("IdentifierType", "Struct", "Union", "Enum")):
+      if child.coord:
+        return child.coord.line, child.coord.column
+  return node.coord.line, node.coord.column
+
+def statement_lines(ast):
+  """Maps each line (0-based) to the number of statements that start on
+     it, counting the statements of blocks and cases. The body of an if
+     or a loop without braces doesn't count, so "if (x) return;" is one"""
+  starts = set()
+  for node in iter_nodes(ast, ("Compound", "Case", "Default")):
+    if type(node).__name__ == "Compound":
+      statements = node.block_items or []
+    else:
+      statements = node.stmts or []
+    for statement in statements:
+      if statement.coord is None:
+        continue
+      if type(statement).__name__ in ("Compound", "EmptyStatement") + LABEL_TYPES:
+        continue
+      starts.add(start_of(statement))
+  lines = {}
+  for line, column in starts:
+    lines[line - 1] = lines.get(line - 1, 0) + 1
+  return lines
+
+def list_lines(ast):
+  """The lines (0-based) on which a call's arguments or a function's
+     parameters follow each other"""
+  lines = set()
+  for node in iter_nodes(ast, ("FuncCall", "FuncDecl")):
+    if node.args is None:
+      continue
+    if type(node).__name__ == "FuncCall":
+      items = node.args.exprs
+    else:
+      items = node.args.params
+    items = [item for item in items if item.coord and item.coord.line > 0]
+    for previous, item in zip(items, items[1:]):
+      if previous.coord.line == item.coord.line:
+        lines.add(item.coord.line - 1)
+  return lines
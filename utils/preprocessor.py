@@ -0,0 +1,171 @@
+import os, collections, tempfile, time
+from subprocess import Popen
+from cache import hash_text
+
+AHEAD = 4 # cpp processes prefetch runs ahead of the item being yielded
+MEMORY_ITEMS = 256 # preprocessed files kept in memory
+TIMEOUT = 2 # seconds cpp gets for a file before it's killed
+
+class PreprocessError(Exception):
+  """cpp failed on some code, or took longer than its timeout"""
+
+class Preprocessor:
+  """Runs the C preprocessor on code, caching the output
+
+  Outputs are cached by the hash of the code and of the preprocessor's
+  command line, including the mtimes of its -I directories, so changing
+  the include path misses the cache. The last MEMORY_ITEMS are kept in
+  memory, and if cache is a utils.cache.Cache, on disk as well, where
+  other processes can find them. Failed runs aren't cached.
+
+  cpp reads and writes temporary files rather than pipes, so it can be
+  started and left to run in the background, see prefetch."""
+
+  def __init__(self, cpp_path="cpp", cpp_args=(), cache=None, ahead=AHEAD,
+               timeout=TIMEOUT):
+    self.command = [cpp_path] + list(cpp_args)
+    self.cache = cache
+    self.ahead = ahead
+    self.timeout = timeout
+    self.memory = collections.OrderedDict()
+    self.fingerprint = get_fingerprint(self.command)
+    self.runs = 0 # cpp processes started, for testing
+
+  def key(self, source):
+    return hash_text("cpp|%s|%s" % (self.fingerprint, hash_text(source)))
+
+  def lookup(self, key):
+    """The cached output for a key, or None"""
+    if key in self.memory:
+      output = self.memory.pop(key)
+      self.memory[key] = output
+      return output
+    if self.cache is not None:
+      output = self.cache.get(key)
+      if output is not None:
+        self.remember(key, output)
+      return output
+
+  def remember(self, key, output):
+    self.memory[key] = output
+    while len(self.memory) > MEMORY_ITEMS:
+      self.memory.popitem(last=False)
+
+  def put(self, source, output):
+    """Adds an output computed elsewhere, e.g. by prefetch in another process"""
+    self.remember(self.key(source), output)
+
+  def start(self, source):
+    """Starts preprocessing source in the background, unless its output is
+       cached. Pass what's returned to finish for the output. Raises
+       OSError if cpp can't be run"""
+    key = self.key(source)
+    output = self.lookup(key)
+    if output is not None:
+      return key, output, None
+    fin = tempfile.TemporaryFile()
+    devnull = open(os.devnull, "w")
+    fout = tempfile.TemporaryFile()
+    try:
+      fin.write(source)
+      fin.seek(0)
+      process = Popen(self.command + ["-"], stdin=fin, stdout=fout, stderr=devnull)
+    except:
+      fout.close()
+      raise
+    finally:
+      # cpp has its own copies of these
+      fin.close()
+      devnull.close()
+    self.runs += 1
+    return key, fout, process
+
+  def finish(self, started):
+    """Waits for a preprocessing started by start, returns the output.
+       Raises PreprocessError if cpp fails or runs out of time, which
+       kills it"""
+    key, output, process = started
+    if process is None:
+      return output
+    fout = output
+    try:
+      returncode = wait(process, self.timeout)
+      if returncode is None:
+        raise PreprocessError("cpp took longer than %s seconds" % self.timeout)
+      if returncode != 0:
+        raise PreprocessError("cpp exited with status %d" % returncode)
+      fout.seek(0)
+      output = fout.read()
+    finally:
+      fout.close()
+    self.remember(key, output)
+    if self.cache is not None:
+      self.cache.put(key, output)
+    return output
+
+  def preprocess(self, source):
+    """The preprocessed source, from the cache if it's there. Raises
+       PreprocessError if cpp fails"""
+    return self.finish(self.start(source))
+
+  def prefetch(self, items, get_source):
+    """Yields (item, source, output) for each of items, in order, where
+       source is get_source(item) preprocessed into output. Items for which
+       get_source returns None are yielded with None for both, as are items
+       for which cpp couldn't be run
+
+    cpp runs on up to self.ahead items ahead of the one being yielded, so
+    whatever is done with an item overlaps with preprocessing the next."""
+    pending = collections.deque()
+    for item in items:
+      source = get_source(item)
+      started = None
+      if source is not None:
+        try:
+          started = self.start(source)
+        except OSError:
+          pass # whoever needs the output can try again, and handle the error
+      pending.append((item, source, started))
+      if len(pending) > self.ahead:
+        yield self._finish_pending(pending)
+    while pending:
+      yield self._finish_pending(pending)
+
+  def _finish_pending(self, pending):
+    item, source, started = pending.popleft()
+    if started is None:
+      return item, source, None
+    try:
+      return item, source, self.finish(started)
+    except PreprocessError:
+      return item, source, None
+
+def wait(process, timeout):
+  """Waits up to timeout seconds for process to exit, and returns its
+     return code, or kills it and returns None if it doesn't"""
+  deadline = time.time() + timeout
+  delay = 0.0005
+  while process.poll() is None:
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      try:
+        process.kill()
+      except OSError:
+        pass # exited just now
+      process.wait()
+      return None
+    time.sleep(min(delay, remaining))
+    delay = min(delay * 2, 0.05)
+  return process.returncode
+
+def get_fingerprint(command):
+  """Identifies a preprocessor command line, and the state of the
+     directories on its include path"""
+  parts = list(command)
+  for arg in command:
+    if arg.startswith("-I"):
+      try:
+        parts.append(str(os.stat(arg[2:]).st_mtime))
+      except OSError:
+        parts.append("missing")
+  return hash_text("|".join(parts))
@@ -0,0 +1,119 @@
+import heapq, resource, cProfile
+
+SLOWEST_FILES = 10 # files kept in the slowest files list
+
+class FeatureStats:
+  """Totals for one feature across the files it ran on"""
+
+  def __init__(self):
+    self.runs = 0
+    self.lines = 0
+    self.wall = 0.0
+    self.cpu = 0.0
+    self.timeouts = 0
+
+  def add(self, other):
+    self.runs += other.runs
+    self.lines += other.lines
+    self.wall += other.wall
+    self.cpu += other.cpu
+    self.timeouts += other.timeouts
+
+class Profile:
+  """Collects where annotation time goes: per feature wall and CPU time,
+  lines processed and timeouts, and per file time. Memory is only known
+  per process: ru_maxrss is the peak of the process so far, so the peak
+  kept with each slow file is that of the process that annotated it, as
+  of when it was done, not the memory the file took by itself.
+
+  Profiles can be sent between processes and merged, so workers can
+  report what they did to the process that started them."""
+
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    self.features = {} # feature name -> FeatureStats
+    self.files = 0
+    self.wall = 0.0
+    self.peak_rss = 0 # in kB
+    self.slowest = [] # heap of (seconds, filename, num_lines, process peak_rss so far)
+
+  def record_feature(self, name, wall, cpu, num_lines, timed_out=False):
+    if name not in self.features:
+      self.features[name] = FeatureStats()
+    stats = self.features[name]
+    stats.runs += 1
+    stats.lines += num_lines
+    stats.wall += wall
+    stats.cpu += cpu
+    stats.timeouts += bool(timed_out)
+
+  def record_file(self, filename, wall, num_lines):
+    rss = peak_rss()
+    self.files += 1
+    self.wall += wall
+    self.peak_rss = max(self.peak_rss, rss)
+    self.add_slow_file((wall, filename, num_lines, rss))
+
+  def add_slow_file(self, entry):
+    if len(self.slowest) < SLOWEST_FILES:
+      heapq.heappush(self.slowest, entry)
+    else:
+      heapq.heappushpop(self.slowest, entry)
+
+  def merge(self, other):
+    """Adds the measurements of another Profile to this one"""
+    for name, stats in other.features.iteritems():
+      self.features.setdefault(name, FeatureStats()).add(stats)
+    self.files += other.files
+    self.wall += other.wall
+    self.peak_rss = max(self.peak_rss, other.peak_rss)
+    for entry in other.slowest:
+      self.add_slow_file(entry)
+
+  def as_dict(self):
+    """The profile as JSON-ready dicts and lists"""
+    features = {}
+    for name, stats in self.features.iteritems():
+      features[name] = {"runs": stats.runs, "lines": stats.lines,
+                        "wall": stats.wall, "cpu": stats.cpu,
+                        "timeouts": stats.timeouts}
+    slowest = [{"file": filename, "wall": wall, "lines": num_lines, "process_peak_rss": rss}
+               for wall, filename, num_lines, rss in sorted(self.slowest, reverse=True)]
+    return {"files": self.files, "wall": self.wall, "peak_rss": self.peak_rss,
+            "features": features, "slowest": slowest}
+
+  def report(self):
+    """A plain text summary, most expensive features first"""
+    lines = ["%-40s %6s %9s %9s %9s %9s %8s" % ("feature", "runs", "lines", "wall s",
+                                                "cpu s", "us/line", "timeouts")]
+    by_cost = sorted(self.features.iteritems(), key=lambda (name, stats): -stats.wall)
+    for name, stats in by_cost:
+      lines.append("%-40s %6i %9i %9.3f %9.3f %9.2f %8i" % (
+        name[:40], stats.runs, stats.lines, stats.wall, stats.cpu,
+        1e6 * stats.wall / max(stats.lines, 1), stats.timeouts))
+    lines.append("")
+    lines.append("%i files in %.3fs, peak memory %i kB" % (self.files, self.wall,
+                                                           self.peak_rss))
+    if self.slowest:
+      lines.append("slowest files, with the peak memory of their process so far:")
+      for wall, filename, num_lines, rss in sorted(self.slowest, reverse=True):
+        lines.append("  %8.3fs %7i lines %9i kB  %s" % (wall, num_lines, rss, filename))
+    return "\n".join(lines)
+
+# shared by everything that annotates in this process
+profile = Profile()
+
+def peak_rss():
+  """Peak resident memory of this process so far, in kB"""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_profiled(func, *args, **kwargs):
+  """Runs func under cProfile, returns (result, profiler)
+
+  Save the stats with profiler.dump_stats(filename) to look at them
+  later with pstats."""
+  profiler = cProfile.Profile()
+  result = profiler.runcall(func, *args, **kwargs)
+  return result, profiler
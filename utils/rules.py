@@ -0,0 +1,31 @@
+import re
+
+class RuleSet:
+  """Named regex rules compiled once into a single alternation.
+
+  rules is a list of (name, pattern). Each line is tried against all of
+  the rules with one regex match, and the name of the rule that matched
+  is reported with the match object."""
+
+  def __init__(self, rules):
+    self.names = [name for name, pattern in rules]
+    alternation = "|".join("(?P<_%i>%s)" % (index, pattern)
+                           for index, (name, pattern) in enumerate(rules))
+    self.regex = re.compile(alternation)
+
+  def match(self, line):
+    """Returns (name, match) for the first rule matching line, or None"""
+    match = self.regex.match(line)
+    if match is None:
+      return None
+    return self.names[int(match.lastgroup[1:])], match
+
+  def scan(self, lines, start=0, end=None):
+    """Yields (line_no, name, match) for each line a rule matches,
+    optionally only from line start to end (exclusive)"""
+    match_line = self.match
+    for line_no, line in enumerate(lines[start:end], start):
+      result = match_line(line)
+      if result is not None:
+        name, match = result
+        yield line_no, name, match
@@ -0,0 +1,82 @@
+import mmap
+
+def map_text(filename):
+  """Maps a file into memory, returning an mmap that reads like a string
+
+  The file's pages are shared with the OS page cache instead of being
+  copied into a string. Files with carriage returns are read into a
+  string with universal newlines instead, so either way the text only
+  has \\n line endings."""
+  f = open(filename, "rb")
+  try:
+    try:
+      text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError: # empty file
+      return ""
+  finally:
+    f.close()
+  if text.find("\r") != -1:
+    text.close()
+    return open(filename, "rU").read()
+  return text
+
+class Lines:
+  """The lines of a text (a string or mmap) as a read-only sequence
+
+  Lines are sliced out of the text when they are asked for, rather than
+  kept as a second copy of the text. linebreak_indices are the indices
+  of the \\n in the text (see annotator.get_linebreak_indices)."""
+
+  def __init__(self, text, linebreak_indices):
+    self.text = text
+    self.linebreak_indices = linebreak_indices
+
+  def __len__(self):
+    return len(self.linebreak_indices) + 1
+
+  def __getitem__(self, index):
+    breaks = self.linebreak_indices
+    if isinstance(index, slice):
+      start, stop, step = index.indices(len(breaks) + 1)
+      if step != 1:
+        return [self[line_no] for line_no in xrange(start, stop, step)]
+      return list(self.iter_lines(start, stop))
+    if index < 0:
+      index += len(breaks) + 1
+    if not 0 <= index <= len(breaks):
+      raise IndexError("line index out of range")
+    if index:
+      start = breaks[index - 1] + 1
+    else:
+      start = 0
+    if index < len(breaks):
+      return self.text[start:breaks[index]]
+    return self.text[start:]
+
+  def __iter__(self):
+    return self.iter_lines(0, len(self))
+
+  def iter_lines(self, start, stop):
+    """Yields lines start to stop (exclusive)"""
+    text = self.text
+    breaks = self.linebreak_indices
+    if start >= stop:
+      return
+    if start:
+      offset = breaks[start - 1] + 1
+    else:
+      offset = 0
+    for end in breaks[start:stop]:
+      yield text[offset:end]
+      offset = end + 1
+    if stop > len(breaks):
+      yield text[offset:]
+
+  def __eq__(self, other):
+    return list(self) == list(other)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return repr(list(self))
@@ -0,0 +1,41 @@
+import os
+from mako.lookup import TemplateLookup
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            "templates")
+MODULE_DIR = os.path.expanduser("~/.style-annotator/templates") # compiled templates, per user
+LINES_PER_CHUNK = 200 # lines of code rendered per chunk when streaming
+
+# shared by everything that renders, so each template is only compiled once
+# per process, and after that only loaded from MODULE_DIR
+lookup = TemplateLookup(directories=[TEMPLATE_DIR],
+                        module_directory=MODULE_DIR,
+                        default_filters=['decode.utf8'],
+                        input_encoding='utf-8',
+                        output_encoding='utf8')
+
+def get_template(name):
+  """Gets a compiled template by filename, e.g. "annotated.txt" """
+  return lookup.get_template(name)
+
+def render(name, **data):
+  """Renders a template to a (utf8) string"""
+  return get_template(name).render(**data)
+
+def stream_annotated(lines, annotations, lines_per_chunk=LINES_PER_CHUNK):
+  """Renders annotated code, yielding the page in (utf8) chunks
+
+  The chunks add up to render("annotated.txt", ...), but the first can be
+  sent before the rest of the page is rendered."""
+  template = get_template("annotated.txt")
+  yield template.get_def("header").render()
+  code_lines = template.get_def("code_lines")
+  for start in xrange(0, len(lines), lines_per_chunk):
+    end = min(start + lines_per_chunk, len(lines))
+    yield code_lines.render(lines, annotations, start, end)
+  yield template.get_def("footer").render()
+
+def write_annotated(out, lines, annotations):
+  """Renders annotated code straight to a file object"""
+  for chunk in stream_annotated(lines, annotations):
+    out.write(chunk)
@@ -0,0 +1,97 @@
+from collections import Counter
+from code_features import NO_LEVEL
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+WHITESPACE = [ord(char) for char in " \t\n\r\x0b\x0c"] # what str.rstrip() strips
+
+def available():
+  """Whether the vectorized (numpy) backend can be used"""
+  return numpy is not None
+
+def column(values, dtype):
+  """A numpy copy of an array.array column of a LineTable or IndentLevels
+
+  Copied rather than viewed, since the array may be resized by an edit
+  while the copy is still around."""
+  return numpy.frombuffer(values, dtype=dtype).copy()
+
+def flags(values):
+  """A boolean numpy array of a column of flags"""
+  return column(values, numpy.int8) != 0
+
+def line_lengths(code):
+  """The length of each line of code, without slicing out the lines"""
+  breaks = numpy.array(code.linebreak_indices, dtype=numpy.int64)
+  starts = numpy.concatenate(([0], breaks + 1))
+  ends = numpy.concatenate((breaks, [len(code.text)]))
+  return ends - starts
+
+def long_lines(code, threshold):
+  """The line nos. of the lines of code that are longer than threshold
+     once stripped of trailing whitespace, like len(line.rstrip())
+
+     Only lines that end in whitespace are sliced out to be stripped,
+     unless the code is unicode."""
+  lengths = line_lengths(code)
+  ends = numpy.cumsum(lengths + 1) - 1 # the index of each linebreak
+  candidates = numpy.flatnonzero(lengths > threshold)
+  if isinstance(code.text, unicode):
+    # the buffer of unicode text isn't one byte per character, so strip them all
+    return [line_no for line_no in candidates.tolist()
+            if len(code.lines[line_no].rstrip()) > threshold]
+  chars = numpy.frombuffer(code.text, dtype=numpy.uint8)
+  is_whitespace = numpy.zeros(256, dtype=bool)
+  is_whitespace[WHITESPACE] = True
+  trailing = is_whitespace[chars[ends[candidates] - 1]]
+  long_lines = set(candidates[~trailing].tolist())
+  for line_no in candidates[trailing].tolist():
+    if len(code.lines[line_no].rstrip()) > threshold:
+      long_lines.add(line_no)
+  return sorted(long_lines)
+
+def indents(code):
+  return column(code.table.indent, numpy.intc)
+
+def single_levels(code):
+  """The level of each line that has exactly one, and NO_LEVEL for the
+     rest (see utils.code_features.IndentLevels)"""
+  return column(code.levels.level, numpy.intc)
+
+def runs(mask):
+  """Finds the runs of consecutive true values in a boolean array.
+     Returns arrays of their starts and (exclusive) ends"""
+  edges = numpy.diff(numpy.concatenate(([0], mask.view(numpy.int8), [0])))
+  return numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1)
+
+def lookup(keys, values, items, default):
+  """Maps each of items through {keys[i]: values[i]}, giving default for
+     items that aren't a key. keys must be sorted"""
+  if not len(keys):
+    return numpy.full(len(items), default, dtype=numpy.intc)
+  index = numpy.searchsorted(keys, items).clip(0, len(keys) - 1)
+  return numpy.where(keys[index] == items, values[index], default)
+
+def level_histograms(code):
+  """The number of lines at each indent, for each indent level, as
+     {level: Counter({indent: lines})}, see FeatureIndentation.get_histograms
+
+  The lines with a single level are counted all at once; the few others
+  one by one."""
+  levels = single_levels(code)
+  indents = column(code.table.indent, numpy.intc)
+  counted = levels != NO_LEVEL
+  # each (level, indent) pair as one int64, so they can be counted by unique
+  pairs = (levels[counted].astype(numpy.int64) << 32) | indents[counted]
+  pairs, counts = numpy.unique(pairs, return_counts=True)
+  histograms = {}
+  for level, indent, count in zip((pairs >> 32).tolist(),
+                                  (pairs & 0xffffffff).tolist(), counts.tolist()):
+    histograms.setdefault(level, Counter())[indent] += count
+  for line_no, _levels in code.levels.other.iteritems():
+    for level in _levels:
+      histograms.setdefault(level, Counter())[code.table.indent[line_no]] += 1
+  return histograms